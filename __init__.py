@@ -1,13 +1,30 @@
 """
 Control Thor Labs APT Devices without relying on the Thor Labs ActiveX control.
-All that is required is the pylibftdi wrapper to libftdi1 driver.
+All that is required is a transport to the controllers: the pylibftdi wrapper to libftdi1 driver by default, or the kernel's ftdi_sio
+/dev/ttyUSB* devices (see apttransport). The transport backend is only imported when a controller is opened through it.
+The names below are imported from their modules on first use, so that e.g. importing aptlib.aptcodec doesn't load the rest of the package.
 """
-import sys
-from .aptmotor import AptMotor
-from .aptpiezo import AptPiezo
+import importlib
 
-import pylibftdi
-pylibftdi.USB_PID_LIST.append(0xfaf0)
+# Name exported by the package -> module it is defined in
+_EXPORTS={"AptMotor":"aptmotor","moveMany":"aptmotor",
+          "AptPiezo":"aptpiezo",
+          "PRM1":"prm1",
+          "Z8XX":"z8xx",
+          "DeviceManager":"aptmanager",
+          "DeviceServer":"aptserver","DeviceClient":"aptserver","SharedState":"aptserver",
+          "LinkMetrics":"aptmetrics","prometheusText":"aptmetrics",
+          "WireCapture":"aptcapture","ReplayDevice":"aptcapture","readCapture":"aptcapture",
+          "MemoryTransport":"apttransport","listDevices":"apttransport","openTransport":"apttransport"}
 
-from .prm1 import PRM1
-from .z8xx import Z8XX
+__all__=sorted(_EXPORTS)
+
+def __getattr__(name):
+    if name not in _EXPORTS:
+        raise AttributeError("module " + repr(__name__) + " has no attribute " + repr(name))
+    value=getattr(importlib.import_module("."+_EXPORTS[name],__name__),name)
+    globals()[name]=value
+    return value
+
+def __dir__():
+    return sorted(set(globals())|set(_EXPORTS))
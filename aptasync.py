@@ -0,0 +1,277 @@
+""" asyncio front end for the APT devices.
+The synchronous device classes are wrapped and run with their background reader thread, which completes asyncio futures as replies
+arrive, so that awaiting a reply never blocks the event loop. Writes can block too (behind a batch written by another thread, or while a
+short USB write is retried for up to c.WRITE_TIMEOUT ms), so they are made by a writer thread of each device, in the order they were issued.
+Many controllers can therefore be driven from a single loop, and every awaitable supports cancellation and asyncio.wait_for/asyncio.timeout. """
+import asyncio
+import concurrent.futures
+import contextlib
+import functools
+import time
+from . import aptconsts as c
+from .aptdevice import AptDevice,MessageReceiptError
+from .aptmotor import AptMotor
+from .aptpiezo import AptPiezo,_Settle,_Zeroing
+
+def _resolve(future,message):
+    """ Complete future with a message handed over by the reader thread (None if the reader thread died) """
+    if future.done():
+        return
+    if message is None:
+        future.set_exception(MessageReceiptError("Reader thread stopped while waiting for a reply"))
+    else:
+        future.set_result(message)
+
+async def _wait(event,timeout):
+    """ Wait up to timeout s for an asyncio.Event to be set """
+    try:
+        await asyncio.wait_for(event.wait(),timeout)
+    except asyncio.TimeoutError:
+        pass
+
+class AsyncAptDevice(object):
+    """ Awaitable wrapper around an AptDevice. Create instances with `await AsyncAptDevice.open(...)`, which takes the same arguments
+    as the synchronous class, or wrap an existing device, in which case its reader thread is started """
+    deviceClass=AptDevice
+
+    def __init__(self,device):
+        self.device=device
+        # Single thread, so that the writes are made in the order they were issued
+        self._writer=concurrent.futures.ThreadPoolExecutor(1)
+        device.startReader()
+
+    @classmethod
+    async def open(cls,*args,**kwargs):
+        """ Connect to the device in a worker thread, so that the initialization doesn't block the event loop """
+        loop=asyncio.get_running_loop()
+        kwargs["reader"]=True
+        device=await loop.run_in_executor(None,functools.partial(cls.deviceClass,*args,**kwargs))
+        return cls(device)
+
+    async def close(self):
+        await self._write(self.device.close)
+        self._writer.shutdown(wait=False)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self,*exc):
+        await self.close()
+
+    @property
+    def channelAddresses(self):
+        return self.device.channelAddresses
+
+    def _write(self,fn,*args,**kwargs):
+        """ Call fn(*args,**kwargs), a device method which writes to the device, in the writer thread and return an asyncio future of its result """
+        return asyncio.get_running_loop().run_in_executor(self._writer,functools.partial(fn,*args,**kwargs))
+
+    async def writeMessage(self,*args,**kwargs):
+        """ Send a message """
+        await self._write(self.device.writeMessage,*args,**kwargs)
+
+    def request(self,txMessageID,rxMessageID,param1=0,param2=0,destID=c.GENERIC_USB_ID,sourceID=c.HOST_CONTROLLER_ID,dataPacket=None):
+        """ Send the REQ message txMessageID and return a future which completes with the GET reply rxMessageID, or with the error
+        if the request can't be written. Cancelling the future forgets the reply """
+        loop=asyncio.get_running_loop()
+        future=loop.create_future()
+        router=self.device.router
+        if router.error is not None:
+            raise router.error
+        waiter=self.device._replyWaiter(rxMessageID,param1,destID,dataPacket,lambda message: loop.call_soon_threadsafe(_resolve,future,message))
+        def forget(future):
+            if future.cancelled():
+                router.cancel(waiter)
+        future.add_done_callback(forget)
+        def sent(written):
+            if not written.cancelled() and written.exception() is not None:
+                router.cancel(waiter)
+                if not future.done():
+                    future.set_exception(written.exception())
+        self._write(self.device.writeMessage,txMessageID,param1,param2,destID,sourceID,dataPacket).add_done_callback(sent)
+        return future
+
+    async def query(self,txMessageID,rxMessageID,param1=0,param2=0,destID=c.GENERIC_USB_ID,sourceID=c.HOST_CONTROLLER_ID,dataPacket=None,waitTime=None):
+        """ Awaitable version of AptDevice.query. waitTime is in ms as for the synchronous version, and defaults to c.READ_TIMEOUT """
+        future=self.request(txMessageID,rxMessageID,param1,param2,destID,sourceID,dataPacket)
+        return await self._reply(future,c.READ_TIMEOUT if waitTime is None else waitTime,txMessageID,rxMessageID)
+
+    async def _reply(self,future,waitTime,txMessageID,rxMessageID):
+        """ Await the reply future for at most waitTime ms, raising MessageReceiptError on timeout like the synchronous query """
+        try:
+            return await asyncio.wait_for(future,waitTime/1000)
+        except asyncio.TimeoutError:
+            raise MessageReceiptError("Timeout querying apt device when sending messageID " + hex(txMessageID) + ".... Expected to receive messageID " + hex(rxMessageID))
+
+class AsyncAptMotor(AsyncAptDevice):
+    """ Awaitable version of AptMotor """
+    deviceClass=AptMotor
+
+    async def MoveHome(self,channel=0,wait=True):
+        """ Home the specified channel. If wait is True the homed message is awaited, otherwise a future for it is returned """
+        channelID,destAddress=self.channelAddresses[channel]
+        future=self.request(c.MGMSG_MOT_MOVE_HOME,c.MGMSG_MOT_MOVE_HOMED,channelID,destID=destAddress)
+        if not wait:
+            return future
+        await self._reply(future,c.QUERY_TIMEOUT,c.MGMSG_MOT_MOVE_HOME,c.MGMSG_MOT_MOVE_HOMED)
+
+    async def MoveJog(self,channel=0,direction=c.MOTOR_JOG_FORWARD):
+        """ Jog the specified channel in the specified direction and wait for the move completed message to be returned """
+        channelID,destAddress=self.channelAddresses[channel]
+        await self.query(c.MGMSG_MOT_MOVE_JOG,c.MGMSG_MOT_MOVE_COMPLETED,channelID,direction,destID=destAddress)
+
+    async def GetPosition(self,channel=0):
+        """ Get the position in mm """
+        channelID,destAddress=self.channelAddresses[channel]
+        response=await self.query(c.MGMSG_MOT_REQ_POSCOUNTER,c.MGMSG_MOT_GET_POSCOUNTER,channelID,destID=destAddress)
+        return self.device._encToPosition(response[-1][-1])
+
+    async def MoveAbsoluteEnc(self,channel=0,positionCh1=0.0,positionCh2=0,waitTime=c.QUERY_TIMEOUT,wait=True):
+        """ Move the specified channel to the specified absolute position. If wait is True the move completed message is awaited,
+        otherwise a future for it is returned """
+        channelID,destAddress=self.channelAddresses[channel]
+        posParam=self.device._positionToEnc(positionCh1)
+        future=self.request(c.MGMSG_MOT_MOVE_ABSOLUTE,c.MGMSG_MOT_MOVE_COMPLETED,0x06,destID=destAddress,dataPacket=(channelID,posParam))
+        if not wait:
+            return future
+        await self._reply(future,waitTime,c.MGMSG_MOT_MOVE_ABSOLUTE,c.MGMSG_MOT_MOVE_COMPLETED)
+
+    async def MoveAbsoluteEx(self,channel=0,positionCh1=0.0,positionCh2=0,wait=True):
+        """ Wrapper for MoveAbsoluteEx """
+        return await self.MoveAbsoluteEnc(channel,positionCh1,positionCh2,wait=wait)
+
+    async def LLMoveStop(self,channel=0):
+        """ Send the stop signal """
+        await self._write(self.device.LLMoveStop,channel)
+
+    async def setPosition(self,position,channel=0):
+        await self.MoveAbsoluteEnc(channel,position)
+
+    async def getPosition(self,channel=0):
+        return await self.GetPosition(channel)
+
+    async def zero(self,channel=0):
+        await self.MoveHome(channel)
+
+class AsyncAptPiezo(AsyncAptDevice):
+    """ Awaitable version of AptPiezo """
+    deviceClass=AptPiezo
+
+    @property
+    def maxExtension(self):
+        return self.device.maxExtension
+
+    async def SetControlMode(self,channel=0,controlMode=c.PIEZO_OPEN_LOOP_MODE):
+        await self._write(self.device.SetControlMode,channel,controlMode)
+
+    async def SetVoltOutput(self,channel=0,voltOutput=0.0):
+        await self._write(self.device.SetVoltOutput,channel,voltOutput)
+
+    async def SetPosOutput(self,channel=0,posOutput=10.0):
+        await self._write(self.device.SetPosOutput,channel,posOutput)
+
+    async def ZeroPosition(self,channel=0):
+        await self._write(self.device.ZeroPosition,channel)
+
+    async def _channelQuery(self,channel,txMessageID,rxMessageID):
+        """ Query a per channel value and return the data packet of the reply """
+        channelID,destAddress=self.channelAddresses[channel]
+        response=await self.query(txMessageID,rxMessageID,channelID,destID=destAddress)
+        dataPacket=response[-1]
+        assert dataPacket[0]==channelID, "inconsistent channel in response message from piezocontroller"
+        return dataPacket
+
+    async def GetVoltOutput(self,channel=0):
+        """ Get the output voltage of the APT Piezo device. Only applicable when in open-loop mode """
+        dataPacket=await self._channelQuery(channel,c.MGMSG_PZ_REQ_OUTPUTVOLTS,c.MGMSG_PZ_GET_OUTPUTVOLTS)
+        return self.device._fractionAsVoltage(dataPacket[1])
+
+    async def GetPosOutput(self,channel=0):
+        """ Get the current position of the APT Piezo device. Only applicable when in closed-loop mode"""
+        dataPacket=await self._channelQuery(channel,c.MGMSG_PZ_REQ_OUTPUTPOS,c.MGMSG_PZ_GET_OUTPUTPOS)
+        return self.device._fractionAsPosition(dataPacket[1])
+
+    async def GetMaxTravel(self,channel=0):
+        """ Get the maximum travel of the piezo actuator in microns """
+        dataPacket=await self._channelQuery(channel,c.MGMSG_PZ_REQ_MAXTRAVEL,c.MGMSG_PZ_GET_MAXTRAVEL)
+        return dataPacket[1]*c.PIEZO_TRAVEL_STEP
+
+    async def LLGetStatusBits(self,channel=0):
+        """ Get the 32 bit status flags of the channel """
+        dataPacket=await self._channelQuery(channel,c.MGMSG_PZ_REQ_PZSTATUSBITS,c.MGMSG_PZ_GET_PZSTATUSBITS)
+        return dataPacket[1]
+
+    async def isZeroing(self,channel):
+        """ Check to see if the piezo controller is in the middle of zeroing (6th bit True)"""
+        return (await self.LLGetStatusBits(channel)>>5) & 1
+
+    @contextlib.contextmanager
+    def _statusUpdates(self):
+        """ Context manager yielding an asyncio.Event which is set whenever a status update has been received (and cached in
+        self.device.status) """
+        loop=asyncio.get_running_loop()
+        changed=asyncio.Event()
+        listener=lambda message: loop.call_soon_threadsafe(changed.set)
+        self.device.router.addListener(c.MGMSG_PZ_GET_PZSTATUSUPDATE,listener)
+        try:
+            yield changed
+        finally:
+            self.device.router.removeListener(c.MGMSG_PZ_GET_PZSTATUSUPDATE,listener)
+
+    async def setPosition(self,channel,position,tolerance=1.01*c.PIEZO_POSITION_ACCURACY,dwell=0.0,timeout=c.PIEZO_MOVE_TIMEOUT):
+        """ Awaitable version of AptPiezo.setPosition: move to position (closed loop mode) and wait until the position pushed by the
+        status updates has stayed within tolerance um of the target for dwell s. Returns a SettleResult, or raises SettleTimeoutError """
+        device=self.device
+        device._checkTarget(position)
+        await self._write(device.startStatusUpdates)
+        with self._statusUpdates() as changed:
+            await self.SetPosOutput(channel,position)
+            settle=_Settle(device,channel,position,tolerance,dwell,timeout)
+            while True:
+                changed.clear()
+                result,timeToWait,request=settle.check()
+                if result is not None:
+                    return result
+                if request:
+                    await self._write(device._requestStatus,(channel,))
+                await _wait(changed,timeToWait)
+
+    async def getPosition(self,channel):
+        return await self.GetPosOutput(channel)
+
+    async def zero(self,channel):
+        """ Call the zero method and wait for it to finish. Returns the time (s) it took """
+        return (await self.zeroAll((channel,)))[channel]
+
+    async def zeroAll(self,channels=None,timeout=c.PIEZO_ZERO_TIMEOUT):
+        """ Awaitable version of AptPiezo.zeroAll: zero channels (all of them by default) at the same time and wait until each has
+        finished according to its status updates. Returns a dict of channel -> time (s) taken to zero, or raises ZeroTimeoutError """
+        device=self.device
+        channels=list(range(len(self.channelAddresses)) if channels is None else channels)
+        await self._write(device.startStatusUpdates)
+        loop=asyncio.get_running_loop()
+        with self._statusUpdates() as changed:
+            zeroing=_Zeroing(device,channels,timeout)
+            def statusBits(channel,message):
+                received=time.monotonic()
+                def update():
+                    zeroing.statusBits(channel,message,received)
+                    changed.set()
+                loop.call_soon_threadsafe(update)
+            waiters=await self._write(device._sendZero,channels,statusBits)
+            try:
+                while True:
+                    changed.clear()
+                    durations,timeToWait,request=zeroing.check()
+                    if durations is not None:
+                        return durations
+                    if request:
+                        await self._write(device._requestStatus,request)
+                    await _wait(changed,timeToWait)
+            finally:
+                for waiter in waiters:
+                    device.router.cancel(waiter)
+
+    async def moveToCenter(self,channel):
+        """ Moves the specified channel to half of its maximum extension"""
+        await self.setPosition(channel,self.maxExtension/2)
@@ -0,0 +1,485 @@
+""" Benchmarks for aptlib which run without any hardware attached, using fake devices and the aptsim simulator.
+Run with python -m aptlib.aptbench. Results can be written as JSON with --json and compared against a stored baseline with --baseline,
+in which case the exit status is 1 if any metric regressed by more than --tolerance. The exit status is also 1 if any benchmark failed,
+which includes the checks some of them make (e.g. a crossed reply in the concurrent query stress test) """
+from __future__ import print_function,division
+import argparse
+import contextlib
+import io
+import itertools
+import json
+import math
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+from struct import pack,unpack
+from . import aptconsts as c
+from . import aptcodec
+from .aptdevice import AptDevice
+from .aptmotor import AptMotor
+from .aptpiezo import AptPiezo
+from .aptsim import SimulatedDevice
+from .aptcapture import ReplayDevice
+from . import apttransport
+
+def _allPacketIDs():
+    """ Return the sorted list of message IDs with a fixed packet structure """
+    return sorted(set(msgID for msgIDs,fmt in c.PACKET_STRUCTS for msgID in msgIDs))
+
+def _samplePacket(msgID):
+    """ Return a data packet of zeros which is valid for msgID """
+    packet=aptcodec.packetStruct(msgID)
+    return packet.unpack(bytes(packet.size))
+
+def _rate(fn,duration):
+    """ Call fn repeatedly for roughly duration seconds and return the number of calls per second """
+    n=0
+    t0=time.perf_counter()
+    deadline=t0+duration
+    while True:
+        for _ in range(100):
+            fn()
+        n+=100
+        t=time.perf_counter()
+        if t>=deadline:
+            return n/(t-t0)
+
+def _legacyPacketStruct(msgID):
+    """ Equivalent of the original if/elif chain of getPacketStruct: sequential list membership tests in table order """
+    for msgIDs,fmt in c.PACKET_STRUCTS:
+        if msgID in msgIDs:
+            return fmt
+    raise Exception("Message " + hex(msgID) + " does not have a packet structure specified")
+
+def _formatStringRoundTrip(msgID,dataPacket):
+    """ Encode and decode a frame the way AptDevice did before aptcodec: if/elif format string lookup and struct parsing on every call """
+    def roundTrip():
+        dataPacketStr=pack(_legacyPacketStruct(msgID),*dataPacket)
+        message=pack(c.HEADER_FORMAT_WITH_DATA,msgID,len(dataPacketStr),c.GENERIC_USB_ID|0x80,c.HOST_CONTROLLER_ID)+dataPacketStr
+        header=unpack(c.HEADER_FORMAT_WITH_DATA,message[:c.NUM_HEADER_BYTES])
+        unpack(_legacyPacketStruct(header[0]),message[c.NUM_HEADER_BYTES:])
+    return roundTrip
+
+def _codecRoundTrip(msgID,dataPacket):
+    """ Encode and decode a frame with aptcodec into a reusable buffer """
+    buffer=bytearray(aptcodec.MAX_FRAME_BYTES)
+    view=memoryview(buffer)
+    def roundTrip():
+        length=aptcodec.encodeInto(buffer,msgID,dataPacket=dataPacket)
+        header=aptcodec.decodeHeader(view)
+        aptcodec.decodeDataPacket(header[0],view[c.NUM_HEADER_BYTES:length])
+    return roundTrip
+
+def benchCodec(duration=0.05,msgIDs=None):
+    """ Measure encode+decode frames per second for each message ID using the format string path and aptcodec.
+    Returns a dict of msgID -> (formatStringRate,codecRate) """
+    results={}
+    for msgID in (msgIDs or _allPacketIDs()):
+        dataPacket=_samplePacket(msgID)
+        results[msgID]=(_rate(_formatStringRoundTrip(msgID,dataPacket),duration),_rate(_codecRoundTrip(msgID,dataPacket),duration))
+    return results
+
+class _TimedFrameDevice(object):
+    """ Stand-in for pylibftdi.Device which makes one frame available at a time, interval seconds after it is armed """
+    def __init__(self,frame,interval):
+        self.frame=frame
+        self.interval=interval
+        self.availableAt=None
+        self.closed=False
+
+    def arm(self):
+        self.availableAt=time.monotonic()+self.interval
+        self._pending=self.frame
+
+    def read(self,length):
+        if self._pending and time.monotonic()>=self.availableAt:
+            data,self._pending=self._pending[:length],self._pending[length:]
+            return data
+        return b''
+
+    def close(self):
+        self.closed=True
+
+def _legacyReadMessage(device):
+    """ Read one frame the way AptDevice._read did before the receive buffer: bytes concatenation and a fixed 1 ms sleep """
+    def read(length,waitTime=c.READ_TIMEOUT):
+        data=bytes()
+        t0=time.time()
+        while len(data)<length:
+            data+=device.read(length-len(data))
+            if waitTime!=None and time.time()-t0>waitTime/1000:
+                break
+            time.sleep(0.001)
+        return data
+    headerRaw=read(c.NUM_HEADER_BYTES)
+    header=aptcodec.decodeHeader(headerRaw)
+    return aptcodec.decodeDataPacket(header[0],read(header[-1]))
+
+def _percentiles(samples):
+    samples=sorted(samples)
+    return {"p50":samples[len(samples)//2],"p90":samples[min(len(samples)-1,int(len(samples)*0.9))],"p99":samples[min(len(samples)-1,int(len(samples)*0.99))]}
+
+def benchReadLatency(frames=500,interval=200e-6,msgID=c.MGMSG_MOT_GET_DCSTATUSUPDATE):
+    """ Measure the latency between a frame becoming available on a fake device and readMessage returning it, for the
+    old read loop and the buffered reader. Returns {"legacy":{"p50":..,"p99":..},"buffered":{...}} in seconds """
+    frame=aptcodec.encode(msgID,dataPacket=_samplePacket(msgID))
+    device=_TimedFrameDevice(frame,interval)
+    apt=AptDevice.__new__(AptDevice)
+    apt._initBuffers()
+    apt.device=device
+    results={}
+    for name,readMessage in (("legacy",lambda: _legacyReadMessage(device)),("buffered",apt.readMessage)):
+        latencies=[]
+        for _ in range(frames):
+            device.arm()
+            readMessage()
+            latencies.append(time.monotonic()-device.availableAt)
+        results[name]=_percentiles(latencies)
+    return results
+
+def benchQueryLatency(queries=500,reader=False,metrics=False,serial=None,transport=None):
+    """ Measure the round trip time of AptDevice.query (MGMSG_MOT_REQ_POSCOUNTER) against a simulated controller with no link latency,
+    or against the controller with the given serial number opened through the transport backend (see apttransport), optionally with the
+    link metrics enabled. Returns {"p50":..,"p90":..,"p99":..} in seconds """
+    device=SimulatedDevice() if serial is None else apttransport.openTransport(serial,transport)
+    with _quiet():
+        apt=AptDevice(device=device,reader=reader)
+    if metrics:
+        apt.enableMetrics()
+    try:
+        latencies=[]
+        for _ in range(queries):
+            t0=time.perf_counter()
+            apt.query(c.MGMSG_MOT_REQ_POSCOUNTER,c.MGMSG_MOT_GET_POSCOUNTER,c.CHANNEL_1)
+            latencies.append(time.perf_counter()-t0)
+    finally:
+        apt.close()
+    return _percentiles(latencies)
+
+def benchReplay(queries=500,path=None):
+    """ Measure the round trip time of AptDevice.query replaying a capture log (see aptcapture) as fast as possible. Without path a session
+    of queries MGMSG_MOT_REQ_POSCOUNTER queries against the simulator is captured first; a log captured on real hardware can be given
+    instead, in which case its session has to start with the connection and be made of MGMSG_MOT_REQ_POSCOUNTER queries.
+    Returns {"p50":..,"p90":..,"p99":..} in seconds """
+    if path is None:
+        with tempfile.TemporaryDirectory() as directory:
+            path=os.path.join(directory,"session.aptw")
+            with _quiet():
+                apt=AptDevice(device=SimulatedDevice(),capture=path)
+            for _ in range(queries):
+                apt.query(c.MGMSG_MOT_REQ_POSCOUNTER,c.MGMSG_MOT_GET_POSCOUNTER,c.CHANNEL_1)
+            apt.close()
+            device=ReplayDevice(path,speed=None)
+    else:
+        device=ReplayDevice(path,speed=None)
+    with _quiet():
+        apt=AptDevice(device=device)
+    try:
+        latencies=[]
+        while not device.finished:
+            t0=time.perf_counter()
+            apt.query(c.MGMSG_MOT_REQ_POSCOUNTER,c.MGMSG_MOT_GET_POSCOUNTER,c.CHANNEL_1)
+            latencies.append(time.perf_counter()-t0)
+    finally:
+        apt.close()
+    if device.mismatches:
+        raise AssertionError(str(len(device.mismatches)) + " frames sent differ from the capture")
+    return _percentiles(latencies)
+
+@contextlib.contextmanager
+def _quiet():
+    """ Silence the connection messages printed by the device constructors """
+    with contextlib.redirect_stdout(io.StringIO()):
+        yield
+
+def benchConnect(repeats=20):
+    """ Measure the time taken by AptDevice.__init__, by _AptMotor.__init__ (PRM1-Z8 initialization sequence) and by a fast connect
+    from the identity cache against a simulated controller. Returns {"device":{percentiles},"motor":{...},"fast":{...}} in seconds """
+    results={}
+    with tempfile.TemporaryDirectory() as directory:
+        cachePath=os.path.join(directory,"devices.json")
+        for name,connect in (("device",lambda: AptDevice(device=SimulatedDevice())),
+                             ("motor",lambda: AptMotor(device=SimulatedDevice(),stageType="PRM1-Z8")),
+                             ("fast",lambda: AptDevice(device=SimulatedDevice(),fastConnect=True,cachePath=cachePath))):
+            durations=[]
+            for _ in range(repeats):
+                with _quiet():
+                    t0=time.perf_counter()
+                    apt=connect()
+                    durations.append(time.perf_counter()-t0)
+                apt.close()
+            results[name]=_percentiles(durations)
+    return results
+
+def benchPiezoSettle(moves=10,settleTime=0.005):
+    """ Measure the overhead of AptPiezo.setPosition: the time it takes to return beyond the time the simulated output (settling
+    exponentially with time constant settleTime) needs to come within the position accuracy. Returns percentiles in seconds """
+    with _quiet():
+        piezo=AptPiezo(device=SimulatedDevice(serial="81000001",model="TPZ001",kind="piezo",settleTime=settleTime))
+    try:
+        piezo.SetControlMode(0,c.PIEZO_CLOSED_LOOP_MODE)
+        tolerance=1.01*c.PIEZO_POSITION_ACCURACY
+        overheads=[]
+        position=0.0
+        for i in range(moves):
+            target=piezo.maxExtension*(0.25 if i%2 else 0.75)
+            ideal=settleTime*math.log(max(abs(target-position)/tolerance,1.0))
+            t0=time.perf_counter()
+            piezo.setPosition(0,target)
+            overheads.append(time.perf_counter()-t0-ideal)
+            position=target
+    finally:
+        piezo.close()
+    return _percentiles(overheads)
+
+def benchPiezoZero(zeros=3,zeroTime=0.2):
+    """ Measure the overhead of AptPiezo.zeroAll beyond the zeroTime s the simulated zeroing takes, with status updates already streaming
+    so that updates pushed before the zero command are still arriving after it. Raises AssertionError if zeroAll returns before the
+    zeroing can have finished. Returns percentiles in seconds """
+    with _quiet():
+        piezo=AptPiezo(device=SimulatedDevice(serial="81000001",model="TPZ001",kind="piezo",zeroTime=zeroTime,updateInterval=0.005))
+    try:
+        piezo.startStatusUpdates()
+        overheads=[]
+        for _ in range(zeros):
+            time.sleep(0.05)
+            t0=time.perf_counter()
+            duration=piezo.zeroAll()[0]
+            elapsed=time.perf_counter()-t0
+            assert duration>=zeroTime and elapsed>=zeroTime, "zeroing reported finished after %.4fs out of %gs"%(duration,zeroTime)
+            overheads.append(elapsed-zeroTime)
+    finally:
+        piezo.close()
+    return _percentiles(overheads)
+
+def benchConcurrentQueries(threads=8,queries=100,reader=False):
+    """ Stress test of queries from many threads on one AptDevice. A three bay simulated rack controller has a distinct position on each
+    bay, threads query the position counters of random bays and check that each reply is the one of the bay they asked, while another
+    thread homes bay 0 with a blocking MGMSG_MOT_MOVE_HOME. Raises AssertionError on a crossed reply. Returns the total queries per second
+    and the number of queries completed while the home was in progress """
+    sim=SimulatedDevice(serial="70000001",model="BSC103",latency=200e-6,jitter=200e-6,seed=0)
+    with _quiet():
+        apt=AptDevice(device=sim,reader=reader)
+    try:
+        expected={}
+        for channel,(channelID,destAddress) in enumerate(apt.channelAddresses):
+            sim.controller(destAddress).channels[channelID].position=1000.0*(channel+1)
+            expected[channel]=1000*(channel+1)
+        sim.controller(apt.channelAddresses[0][1]).channels[apt.channelAddresses[0][0]].position=200.0
+        homing=threading.Event()
+        duringHome=[0]
+        errors=[]
+        def home():
+            channelID,destAddress=apt.channelAddresses[0]
+            homing.set()
+            try:
+                apt.query(c.MGMSG_MOT_MOVE_HOME,c.MGMSG_MOT_MOVE_HOMED,channelID,destID=destAddress,waitTime=c.QUERY_TIMEOUT)
+            except Exception as e:
+                errors.append(e)
+            finally:
+                homing.clear()
+        def worker(seed):
+            rng=random.Random(seed)
+            try:
+                for _ in range(queries):
+                    channel=rng.randrange(1,len(apt.channelAddresses))
+                    channelID,destAddress=apt.channelAddresses[channel]
+                    response=apt.query(c.MGMSG_MOT_REQ_POSCOUNTER,c.MGMSG_MOT_GET_POSCOUNTER,channelID,destID=destAddress)
+                    assert response[4]==destAddress and response[-1][1]==expected[channel], "crossed reply on channel %d: %r"%(channel,response)
+                    if homing.is_set():
+                        duringHome[0]+=1
+            except Exception as e:
+                errors.append(e)
+        workers=[threading.Thread(target=home)]+[threading.Thread(target=worker,args=(seed,)) for seed in range(threads)]
+        t0=time.perf_counter()
+        for thread in workers:
+            thread.start()
+        for thread in workers:
+            thread.join()
+        elapsed=time.perf_counter()-t0
+        if errors:
+            raise errors[0]
+    finally:
+        apt.close()
+    return threads*queries/elapsed,duringHome[0]
+
+def benchScan(points=50):
+    """ Measure scan throughput in points per second against simulated controllers, for an AptMotor taking 10 um steps with fast velocity
+    parameters and for an AptPiezo taking 0.25 um steps in closed loop. Returns {"motor":pointsPerSecond,"piezo":pointsPerSecond} """
+    results={}
+    with _quiet():
+        motor=AptMotor(device=SimulatedDevice(),stageType="Z8XX")
+        piezo=AptPiezo(device=SimulatedDevice(serial="81000001",model="TPZ001",kind="piezo",settleTime=0.0005))
+    try:
+        motor.writeMessage(c.MGMSG_MOT_SET_VELPARAMS,dataPacket=(c.CHANNEL_1,0,motor._accelerationToEnc(1000),motor._velocityToEnc(100)))
+        piezo.SetControlMode(0,c.PIEZO_CLOSED_LOOP_MODE)
+        for name,device,step in (("motor",motor,0.01),("piezo",piezo,0.25)):
+            t0=time.perf_counter()
+            device.scan([step*(i+1) for i in range(points)],measure=lambda i,position: position)
+            results[name]=points/(time.perf_counter()-t0)
+    finally:
+        motor.close()
+        piezo.close()
+    return results
+
+def benchTelemetry(duration=0.2,chunkSize=64):
+    """ Benchmark TelemetryRecorder.append while saving to disk, then load the chunks back and check they hold every sample that wasn't
+    dropped for lack of a free chunk buffer, in order. Raises ImportError without numpy. Returns the samples appended per second """
+    import numpy as np
+    from .aptrecorder import TelemetryRecorder,loadTelemetry
+    with _quiet():
+        motor=AptMotor(device=SimulatedDevice(),stageType="Z8XX")
+    try:
+        with tempfile.TemporaryDirectory() as directory:
+            recorder=TelemetryRecorder(motor,capacity=4*chunkSize,path=directory,chunkSize=chunkSize)
+            # The motor's own status updates are recorded as channel 0: tag the benchmark samples with channel 1 and their sequence number
+            sequence=itertools.count()
+            with recorder:
+                rate=_rate(lambda: recorder.append(time.monotonic(),1,next(sequence),0.0,0),duration)
+            records=np.concatenate(loadTelemetry(directory,mmap=False))
+            expected=recorder.count-recorder.droppedChunks*chunkSize
+            assert len(records)==expected, "%d samples saved out of %d"%(len(records),expected)
+            positions=records["position"][records["channel"]==1]
+            assert (positions[1:]>positions[:-1]).all(), "samples out of order"
+    finally:
+        motor.close()
+    return rate
+
+def benchScalingFactors(duration=0.05):
+    """ Return the number of getMotorScalingFactors calls per second and of _positionToEnc conversions per second """
+    motor=AptMotor.__new__(AptMotor)
+    motor.device=_TimedFrameDevice(b"",0)
+    motor.controllerType,motor.stageType="TDC001","PRM1-Z8"
+    return _rate(lambda: c.getMotorScalingFactors("TDC001","PRM1-Z8"),duration),_rate(lambda: motor._positionToEnc(1.0),duration)
+
+def _metric(value,unit,better):
+    return {"value":value,"unit":unit,"better":better}
+
+def runSuite(duration=0.05,serial=None,transports=()):
+    """ Run all the benchmarks and return a flat dict of metric name -> {"value","unit","better"} where better is "higher" or "lower".
+    A benchmark which fails is reported as {"error":repr(exception)} under its name instead of aborting the suite, and one which needs a
+    missing optional dependency (numpy) as {"skipped":reason}. With serial the query
+    latency of that controller is also measured through each of the transport backends, to pick the fastest one on this machine """
+    results={}
+    def run(name,benchmark):
+        try:
+            benchmark()
+        except ImportError as e:
+            results[name]={"skipped":str(e)}
+        except Exception as e:
+            results[name]={"error":repr(e)}
+    def codec():
+        rates=benchCodec(duration)
+        for msgID,(before,after) in rates.items():
+            results["codec.%#06x"%msgID]=_metric(after,"frames/s","higher")
+            results["codec.%#06x.before"%msgID]=_metric(before,"frames/s","higher")
+        # Harmonic means, i.e. the rate of a stream with one frame of each message
+        after=len(rates)/sum(1/after for before,after in rates.values())
+        before=len(rates)/sum(1/before for before,after in rates.values())
+        results["codec.all"]=_metric(after,"frames/s","higher")
+        results["codec.all.before"]=_metric(before,"frames/s","higher")
+        results["codec.all.speedup"]=_metric(after/before,"x","higher")
+    def percentiles(prefix,values):
+        for key,value in values.items():
+            results[prefix+"."+key]=_metric(value,"s","lower")
+    run("codec",codec)
+    run("read",lambda: percentiles("read",benchReadLatency()["buffered"]))
+    run("query",lambda: percentiles("query",benchQueryLatency()))
+    run("query.reader",lambda: percentiles("query.reader",benchQueryLatency(reader=True)))
+    run("query.replay",lambda: percentiles("query.replay",benchReplay()))
+    run("query.metrics",lambda: percentiles("query.metrics",benchQueryLatency(metrics=True)))
+    def connect():
+        for name,values in benchConnect().items():
+            percentiles("connect."+name,values)
+    run("connect",connect)
+    def scan():
+        for name,rate in benchScan().items():
+            results["scan."+name]=_metric(rate,"points/s","higher")
+    run("scan",scan)
+    run("telemetry",lambda: results.update({"telemetry":_metric(benchTelemetry(),"samples/s","higher")}))
+    def concurrency():
+        for name,reader in (("concurrent",False),("concurrent.reader",True)):
+            rate,duringHome=benchConcurrentQueries(reader=reader)
+            results["query."+name]=_metric(rate,"queries/s","higher")
+            results["query."+name+".duringHome"]=_metric(duringHome,"queries","higher")
+    run("query.concurrent",concurrency)
+    run("piezo.settle",lambda: percentiles("piezo.settle",benchPiezoSettle()))
+    run("piezo.zero",lambda: percentiles("piezo.zero",benchPiezoZero()))
+    def scaling():
+        factors,conversions=benchScalingFactors(duration)
+        results["scaling"]=_metric(factors,"calls/s","higher")
+        results["scaling.convert"]=_metric(conversions,"calls/s","higher")
+    run("scaling",scaling)
+    for transport in transports:
+        run("hardware."+transport,lambda: percentiles("hardware."+transport,benchQueryLatency(serial=serial,transport=transport)))
+    return results
+
+def compare(results,baseline,tolerance=0.2):
+    """ Compare results against baseline results. Returns a list of (name,baselineValue,value,change) for the metrics which got worse by
+    more than the fraction tolerance, where change is the fractional change in the bad direction. Metrics which failed to run but are in
+    the baseline are reported with value None """
+    regressions=[]
+    for name,reference in sorted(baseline.items()):
+        if "value" not in reference:
+            continue
+        current=results.get(name)
+        if current is None or "value" not in current:
+            regressions.append((name,reference["value"],None,None))
+            continue
+        if reference["better"]=="higher":
+            change=(reference["value"]-current["value"])/reference["value"]
+        else:
+            change=(current["value"]-reference["value"])/reference["value"]
+        if change>tolerance:
+            regressions.append((name,reference["value"],current["value"],change))
+    return regressions
+
+def main(argv=None):
+    parser=argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--duration",type=float,default=0.05,help="seconds spent on each throughput measurement")
+    parser.add_argument("--json",help="write the results to this file")
+    parser.add_argument("--baseline",help="JSON results of a previous run to compare against")
+    parser.add_argument("--tolerance",type=float,default=0.2,help="fractional change in the bad direction reported as a regression")
+    parser.add_argument("--serial",help="also measure the query latency of the controller with this serial number")
+    parser.add_argument("--transports",default="pylibftdi,serial",help="comma separated transport backends to measure the controller through")
+    args=parser.parse_args(argv)
+    results=runSuite(args.duration,args.serial,args.transports.split(",") if args.serial else ())
+    print("%-36s %16s %10s"%("metric","value","unit"))
+    for name,result in sorted(results.items()):
+        if "error" in result:
+            print("%-36s %27s"%(name,"failed: "+result["error"]))
+        elif "skipped" in result:
+            print("%-36s %27s"%(name,"skipped: "+result["skipped"]))
+        elif result["unit"]=="s":
+            print("%-36s %16.1f %10s"%(name,result["value"]*1e6,"us"))
+        elif result["unit"]=="x":
+            print("%-36s %16.2f %10s"%(name,result["value"],result["unit"]))
+        else:
+            print("%-36s %16.0f %10s"%(name,result["value"],result["unit"]))
+    if args.json:
+        with open(args.json,"w") as f:
+            json.dump(results,f,indent=1,sort_keys=True)
+    failed=sorted(name for name,result in results.items() if "error" in result)
+    if failed:
+        print()
+        print("FAILED " + ", ".join(failed))
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions=compare(results,json.load(f),args.tolerance)
+        print()
+        if not regressions:
+            print("No regressions against "+args.baseline)
+            return 1 if failed else 0
+        for name,before,after,change in regressions:
+            if after is None:
+                print("REGRESSION %-36s no result (baseline %g)"%(name,before))
+            else:
+                print("REGRESSION %-36s %g -> %g (%+.0f%%)"%(name,before,after,change*100))
+        return 1
+    return 1 if failed else 0
+
+if __name__=="__main__":
+    sys.exit(main())
@@ -0,0 +1,56 @@
+""" Persistent cache of controller identities for the fast connect mode of AptDevice.
+For each serial number the model, notes, channel count, bay occupancy and channelAddresses found on the last successful connect are
+kept in a JSON file (c.DEVICE_CACHE_PATH by default), so that a reconnect can skip the discovery queries. """
+from __future__ import print_function,division
+import json
+import os
+import tempfile
+import threading
+from . import aptconsts as c
+
+# Serializes the read-modify-write of the cache file between the threads of this process
+_lock=threading.Lock()
+
+def _load(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (IOError,OSError,ValueError):
+        return {}
+
+def loadIdentity(serial,path=None):
+    """ Return the cached identity dict of the controller with the given serial number, or None if it isn't known """
+    identity=_load(path or c.DEVICE_CACHE_PATH).get(str(serial))
+    if identity is not None:
+        identity["channelAddresses"]=[tuple(address) for address in identity["channelAddresses"]]
+    return identity
+
+def _save(path,identities):
+    """ Replace the cache file atomically, so that a crash can't leave it truncated """
+    directory=os.path.dirname(os.path.abspath(path))
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    fd,tmpPath=tempfile.mkstemp(dir=directory,prefix=".devices")
+    try:
+        with os.fdopen(fd,"w") as f:
+            json.dump(identities,f,indent=1,sort_keys=True)
+        os.replace(tmpPath,path)
+    except:
+        os.remove(tmpPath)
+        raise
+
+def storeIdentity(serial,identity,path=None):
+    """ Record the identity dict of a controller """
+    path=path or c.DEVICE_CACHE_PATH
+    with _lock:
+        identities=_load(path)
+        identities[str(serial)]=identity
+        _save(path,identities)
+
+def forgetIdentity(serial,path=None):
+    """ Remove a controller from the cache, so that the next fast connect runs the full discovery """
+    path=path or c.DEVICE_CACHE_PATH
+    with _lock:
+        identities=_load(path)
+        if identities.pop(str(serial),None) is not None:
+            _save(path,identities)
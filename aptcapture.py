@@ -0,0 +1,219 @@
+""" Capture of the frames exchanged with an APT controller, and deterministic replay of a capture without the hardware.
+WireCapture records every frame sent and received by an AptDevice (see AptDevice.startCapture, or the capture argument of AptDevice) with
+its time.monotonic() time into preallocated buffers, which a background thread writes out to a compact binary log:
+
+    header: b"APTW", format version (uint16)
+    record: time (float64), direction (uint8, CAPTURE_TX or CAPTURE_RX), frame length (uint16), frame
+
+ReplayDevice is a pylibftdi.Device compatible transport which plays a log back to an AptDevice. The frames received after each frame sent
+are released once the host has sent that frame again, after their original delay divided by speed (or straight away if speed is None),
+so the session replays in the same order however fast the host runs """
+from __future__ import print_function,division
+import struct
+import threading
+import time
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+from . import aptconsts as c
+from . import aptcodec
+from .aptsim import _FtdiFunctions
+
+CAPTURE_HEADER=struct.Struct("<4sH")
+CAPTURE_RECORD=struct.Struct("<dBH")
+CAPTURE_MAGIC=b"APTW"
+CAPTURE_VERSION=1
+CAPTURE_TX=0
+CAPTURE_RX=1
+
+class ReplayMismatchError(Exception): pass
+
+class WireCapture(object):
+    """ Record frames into numBuffers preallocated buffers of bufferSize bytes, written to path by a background thread as they fill up.
+    If the writer falls so far behind that no buffer is free the frames are dropped and counted in dropped rather than blocking the link.
+    If writing the log fails (e.g. the disk is full) the error is kept in error, the frames from then on are dropped, and flush() and
+    close() raise it """
+    def __init__(self,path,bufferSize=1<<16,numBuffers=4):
+        if bufferSize<CAPTURE_RECORD.size+aptcodec.MAX_FRAME_BYTES:
+            raise ValueError("bufferSize is too small to hold a frame")
+        self.path=path
+        self.records=0
+        self.dropped=0
+        self.error=None
+        self._file=open(path,"wb")
+        self._file.write(CAPTURE_HEADER.pack(CAPTURE_MAGIC,CAPTURE_VERSION))
+        self._free=queue.Queue()
+        for _ in range(numBuffers-1):
+            self._free.put(bytearray(bufferSize))
+        self._full=queue.Queue()
+        self._buffer=bytearray(bufferSize)
+        self._length=0
+        self._lock=threading.Lock()
+        self._writer=threading.Thread(target=self._writeBuffers,name="WireCapture writer")
+        self._writer.daemon=True
+        self._writer.start()
+
+    def record(self,direction,frame):
+        """ Record a frame (bytes, bytearray or memoryview) sent (CAPTURE_TX) or received (CAPTURE_RX) now """
+        size=CAPTURE_RECORD.size+len(frame)
+        with self._lock:
+            if self.error is not None:
+                self.dropped+=1
+                return
+            if self._buffer is not None and self._length+size>len(self._buffer):
+                self._full.put((self._buffer,self._length))
+                self._buffer=None
+            if self._buffer is None:
+                try:
+                    self._buffer=self._free.get_nowait()
+                    self._length=0
+                except queue.Empty:
+                    self.dropped+=1
+                    return
+            CAPTURE_RECORD.pack_into(self._buffer,self._length,time.monotonic(),direction,len(frame))
+            self._buffer[self._length+CAPTURE_RECORD.size:self._length+size]=frame
+            self._length+=size
+            self.records+=1
+
+    def _writeBuffers(self):
+        """ Body of the writer thread """
+        while True:
+            item=self._full.get()
+            if item is None:
+                self._full.task_done()
+                return
+            buffer,length=item
+            try:
+                if self.error is None:
+                    self._file.write(memoryview(buffer)[:length])
+            except Exception as e:
+                self.error=e
+            finally:
+                self._free.put(buffer)
+                self._full.task_done()
+
+    def flush(self):
+        """ Hand the frames recorded so far to the writer thread and wait until they have been written out """
+        with self._lock:
+            if self._buffer is not None and self._length:
+                self._full.put((self._buffer,self._length))
+                self._buffer=None
+        self._full.join()
+        if self.error is not None:
+            raise self.error
+        self._file.flush()
+
+    def close(self):
+        """ Write out the remaining frames and close the log """
+        with self._lock:
+            if self._buffer is not None and self._length:
+                self._full.put((self._buffer,self._length))
+            self._buffer=None
+        self._full.put(None)
+        self._writer.join()
+        self._file.close()
+        if self.error is not None:
+            raise self.error
+
+def readCapture(path):
+    """ Return the list of (time,direction,frame) records of a capture log """
+    with open(path,"rb") as f:
+        data=f.read()
+    magic,version=CAPTURE_HEADER.unpack_from(data,0)
+    if magic!=CAPTURE_MAGIC or version!=CAPTURE_VERSION:
+        raise ValueError(path + " isn't an aptlib capture log")
+    records=[]
+    offset=CAPTURE_HEADER.size
+    while offset+CAPTURE_RECORD.size<=len(data):
+        t,direction,length=CAPTURE_RECORD.unpack_from(data,offset)
+        offset+=CAPTURE_RECORD.size
+        if offset+length>len(data):
+            break
+        records.append((t,direction,data[offset:offset+length]))
+        offset+=length
+    return records
+
+def _frames(data):
+    """ Split off the complete frames at the start of data (a bytearray, consumed in place) """
+    frames=[]
+    while len(data)>=c.NUM_HEADER_BYTES:
+        dataPacketLength=aptcodec.decodeHeader(data)[-1]
+        frameLength=c.NUM_HEADER_BYTES+dataPacketLength
+        if len(data)<frameLength:
+            break
+        frames.append(bytes(data[:frameLength]))
+        del data[:frameLength]
+    return frames
+
+class ReplayDevice(object):
+    """ Transport replaying the capture log at path: pass it as the device of an AptDevice (or subclass) constructor. speed scales the
+    original delays (None to replay as fast as possible). Each frame the host sends is compared with the one captured at that point;
+    mismatches are collected in self.mismatches as (recordIndex,expected,received), or raise ReplayMismatchError if strict """
+    def __init__(self,path,speed=1.0,strict=False,serial="00000000"):
+        self.records=readCapture(path)
+        self.speed=speed
+        self.strict=strict
+        self.device_id=str(serial)
+        self.closed=False
+        self.baudrate=115200
+        self.ftdi_fn=_FtdiFunctions()
+        self.mismatches=[]
+        self._next=0
+        self._input=bytearray()
+        self._output=bytearray()
+        self._lock=threading.Lock()
+        # Host time and log time of the last frame sent, which the delays of the following received frames are measured from
+        self._anchor=(time.monotonic(),self.records[0][0] if self.records else 0.0)
+
+    @property
+    def finished(self):
+        """ True once every record of the log has been replayed """
+        return self._next>=len(self.records)
+
+    def write(self,data):
+        if self.closed:
+            raise IOError("Replay device is closed")
+        with self._lock:
+            self._input+=data
+            for frame in _frames(self._input):
+                self._match(frame)
+        return len(data)
+
+    def _match(self,frame):
+        """ Match a frame sent by the host with the next frame sent in the log, releasing the frames received before it """
+        while self._next<len(self.records) and self.records[self._next][1]!=CAPTURE_TX:
+            self._output+=self.records[self._next][2]
+            self._next+=1
+        if self._next>=len(self.records):
+            return
+        t,direction,expected=self.records[self._next]
+        if frame!=expected:
+            if self.strict:
+                raise ReplayMismatchError("Frame " + str(self._next) + " of the capture differs: expected " + expected.hex() + ", got " + frame.hex())
+            self.mismatches.append((self._next,expected,frame))
+        self._anchor=(time.monotonic(),t)
+        self._next+=1
+
+    def read(self,length):
+        if self.closed:
+            raise IOError("Replay device is closed")
+        with self._lock:
+            now=time.monotonic()
+            hostTime,logTime=self._anchor
+            while self._next<len(self.records):
+                t,direction,frame=self.records[self._next]
+                if direction!=CAPTURE_RX or (self.speed is not None and hostTime+(t-logTime)/self.speed>now):
+                    break
+                self._output+=frame
+                self._next+=1
+            data=bytes(self._output[:length])
+            del self._output[:length]
+        return data
+
+    def flush(self,flags=None):
+        # Nothing captured is pending before the host's purge, so there is nothing to discard
+        pass
+
+    def close(self):
+        self.closed=True
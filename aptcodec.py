@@ -0,0 +1,122 @@
+""" Table driven encoder/decoder for APT message frames.
+The struct formats listed in aptconsts.PACKET_STRUCTS are compiled into struct.Struct objects once, the first time a message is
+encoded or decoded, so that the per frame cost is a single dict lookup and a pack_into/unpack_from call. """
+from __future__ import division
+from struct import Struct,error
+from . import aptconsts as c
+
+HEADER_WITH_DATA=Struct(c.HEADER_FORMAT_WITH_DATA)
+HEADER_WITHOUT_DATA=Struct(c.HEADER_FORMAT_WITHOUT_DATA)
+SUBMESSAGE_ID=Struct('<H')
+_SUBMESSAGE_IDS=frozenset(c.SUBMESSAGE_IDS)
+# Bound methods of the header structures used on every frame
+_packHeaderWithData=HEADER_WITH_DATA.pack_into
+_packHeaderWithoutData=HEADER_WITHOUT_DATA.pack_into
+_unpackHeaderWithData=HEADER_WITH_DATA.unpack_from
+_unpackHeaderWithoutData=HEADER_WITHOUT_DATA.unpack_from
+
+# Compiled structures, built on first use by _compile()
+_packetStructs=None
+_subMessageStructs=None
+# Largest frame (header+data packet) with a fixed structure, used to size reusable transmit buffers
+MAX_FRAME_BYTES=c.NUM_HEADER_BYTES+256
+
+def _compile():
+    """ Build the dicts of compiled structures from the tables in aptconsts """
+    global _packetStructs,_subMessageStructs
+    subMessageStructs={}
+    for key,fmt in c.SUBMESSAGE_STRUCTS.items():
+        subMessageStructs[key]=Struct(fmt)
+    packetStructs={}
+    for msgIDs,fmt in c.PACKET_STRUCTS:
+        for msgID in msgIDs:
+            if msgID not in packetStructs:
+                packetStructs[msgID]=Struct(fmt)
+    _subMessageStructs=subMessageStructs
+    _packetStructs=packetStructs
+    return packetStructs
+
+def packetStruct(msgID):
+    """ Return the compiled struct.Struct for the data packet of msgID. Raises the same exceptions as aptconsts.getPacketStruct for messages
+    without a fixed structure """
+    packetStructs=_packetStructs
+    if packetStructs is None: packetStructs=_compile()
+    try:
+        return packetStructs[msgID]
+    except KeyError:
+        c.getPacketStruct(msgID)
+        raise
+
+def subMessageStruct(msgID,subMsgID):
+    """ Return the compiled struct.Struct of the sub-message subMsgID of msgID (excluding the sub-message ID word), or None if it is not known """
+    if _subMessageStructs is None: _compile()
+    return _subMessageStructs.get((msgID,subMsgID))
+
+def _packSubMessage(buffer,offset,messageID,dataPacket):
+    """ Pack a sub-message data packet (subMsgID,values...) into buffer and return its length. Unknown sub-messages must be given as (subMsgID,rawBytes) """
+    subMsgID=dataPacket[0]
+    subStruct=subMessageStruct(messageID,subMsgID)
+    if subStruct is None:
+        raw=bytes(dataPacket[1]) if len(dataPacket)>1 else b''
+        size=SUBMESSAGE_ID.size+len(raw)
+        _reserve(buffer,offset+size)
+        SUBMESSAGE_ID.pack_into(buffer,offset,subMsgID)
+        buffer[offset+SUBMESSAGE_ID.size:offset+size]=raw
+    else:
+        size=SUBMESSAGE_ID.size+subStruct.size
+        _reserve(buffer,offset+size)
+        SUBMESSAGE_ID.pack_into(buffer,offset,subMsgID)
+        subStruct.pack_into(buffer,offset+SUBMESSAGE_ID.size,*dataPacket[1:])
+    return size
+
+def _reserve(buffer,size):
+    """ Grow a bytearray in place so that it can hold at least size bytes """
+    if len(buffer)<size:
+        buffer.extend(bytes(size-len(buffer)))
+
+def encodeInto(buffer,messageID,param1=0x00,param2=0x00,destID=c.GENERIC_USB_ID,sourceID=c.HOST_CONTROLLER_ID,dataPacket=None,offset=0):
+    """ Encode a complete message (header and optional data packet) into the bytearray buffer starting at offset, and return the number of bytes written.
+    The buffer is grown in place if it is too small """
+    if dataPacket is None:
+        if len(buffer)<offset+c.NUM_HEADER_BYTES: _reserve(buffer,offset+c.NUM_HEADER_BYTES)
+        _packHeaderWithoutData(buffer,offset,messageID,param1,param2,destID,sourceID)
+        return c.NUM_HEADER_BYTES
+    dataOffset=offset+c.NUM_HEADER_BYTES
+    if messageID in _SUBMESSAGE_IDS:
+        dataLength=_packSubMessage(buffer,dataOffset,messageID,dataPacket)
+    else:
+        packet=packetStruct(messageID)
+        dataLength=packet.size
+        if len(buffer)<dataOffset+dataLength: _reserve(buffer,dataOffset+dataLength)
+        packet.pack_into(buffer,dataOffset,*dataPacket)
+    # The destination byte has its MSB set to flag that a data packet follows
+    _packHeaderWithData(buffer,offset,messageID,dataLength,destID|0x80,sourceID)
+    return c.NUM_HEADER_BYTES+dataLength
+
+def encode(messageID,param1=0x00,param2=0x00,destID=c.GENERIC_USB_ID,sourceID=c.HOST_CONTROLLER_ID,dataPacket=None):
+    """ Encode a complete message and return it as bytes """
+    buffer=bytearray(MAX_FRAME_BYTES)
+    length=encodeInto(buffer,messageID,param1,param2,destID,sourceID,dataPacket)
+    return bytes(buffer[:length])
+
+def decodeHeader(headerRaw):
+    """ Decode the 6 byte header and return tuple of messageID,param1,param2,destID,sourceID,dataPacketLength.
+    param1 and param2 are None and the destID has its MSB cleared if a data packet is attached, otherwise dataPacketLength is 0 """
+    if headerRaw[4]&0x80:
+        messageID,dataPacketLength,destID,sourceID=_unpackHeaderWithData(headerRaw)
+        return (messageID,None,None,destID&0x7F,sourceID,dataPacketLength)
+    return _unpackHeaderWithoutData(headerRaw)+(0,)
+
+def decodeDataPacket(messageID,dataPacketRaw):
+    """ Decode the data packet of messageID straight from the received bytes (any buffer object) and return a tuple of its values.
+    For messages with sub-messages the first value is the sub-message ID; the rest is returned as raw bytes if the sub-message is not known """
+    if messageID in _SUBMESSAGE_IDS:
+        subMsgID=SUBMESSAGE_ID.unpack_from(dataPacketRaw)[0]
+        subStruct=subMessageStruct(messageID,subMsgID)
+        if subStruct is None:
+            return (subMsgID,bytes(dataPacketRaw[SUBMESSAGE_ID.size:]))
+        return (subMsgID,)+subStruct.unpack_from(dataPacketRaw,SUBMESSAGE_ID.size)
+    packet=packetStruct(messageID)
+    if len(dataPacketRaw)!=packet.size:
+        raise error("Data packet of message " + hex(messageID) + " has " + str(len(dataPacketRaw)) + " bytes but " + str(packet.size) + " were expected")
+    return packet.unpack_from(dataPacketRaw)
@@ -1,102 +1,97 @@
 from __future__ import division
+from collections import namedtuple
+import os
 
 # Header structure with and without data packet attached
 NUM_HEADER_BYTES=6  # number of bytes to read for message headers
 HEADER_FORMAT_WITHOUT_DATA = '<HBBBB'
 HEADER_FORMAT_WITH_DATA = '<HHBB'
 # Packet Structures (list of bytes required for each value in the packet)
-def getPacketStruct(msgID):
-    """ given msgID return a format string which can be used by struct.pack and struct.unpack to convert the message data packet to and from hex.
-   Note: all messages with data packets should be accounted for here, but there are almost certainly data entry errors, so some may be missing or incorrect. Few of them have been tested """
+# Each entry maps a list of message IDs onto the struct format of their data packet. Where an ID is listed twice the first entry wins.
+# Note: all messages with data packets should be accounted for here, but there are almost certainly data entry errors, so some may be missing or incorrect. Few of them have been tested
+PACKET_STRUCTS=[
     # 1 word
-    if msgID in [0x07D1,0x07D3,0x07E8,0x07EA,0x0875]:
-        return '<H'
+    ([0x07D1,0x07D3,0x07E8,0x07EA,0x0875],'<H'),
     # 2 words
-    elif msgID in [0x042C,0x04B3,0x04B5,0x04FB,0x04FD,0x0643,0x0645,0x0646,0x0648,0x0652,0x0654,0x07D0,0x0651,0x0609,0x0611,0x07E7]:
-        return '<HH'
+    ([0x042C,0x04B3,0x04B5,0x04FB,0x04FD,0x0643,0x0645,0x0646,0x0648,0x0652,0x0654,0x07D0,0x0651,0x0609,0x0611,0x07E7],'<HH'),
     # 3 words
-    elif msgID in [0x0655,0x0657,0x0700,0x0702,0x04B9,0x0680,0x0682,0x0683,0x0685,0x07DE]:
-        return '<HHH'
+    ([0x0655,0x0657,0x0700,0x0702,0x04B9,0x0680,0x0682,0x0683,0x0685,0x07DE],'<HHH'),
     # 5 words
-    elif msgID in [0x0426,0x0428,0x07D4,0x07D6,0x0670,0x0672]:
-        return '<HHHHH'
+    ([0x0426,0x0428,0x07D4,0x07D6,0x0670,0x0672],'<HHHHH'),
     # 6 words
-    elif msgID in [0x04E0,0x04E2,0x0618,0x0620]:
-        return '<HHHHHH'
+    ([0x04E0,0x04E2,0x0618,0x0620],'<HHHHHH'),
     # 7 words
-    elif msgID in [0x07DA,0x07DC,0x04DA,0x04DC,0x04E0,0x04E2]:
-        return '<HHHHHHH'
+    ([0x07DA,0x07DC,0x04DA,0x04DC,0x04E0,0x04E2],'<HHHHHHH'),
     # 9 words
-    elif msgID in [0x04E9,0x04EB]:
-        return '<HHHHHHHHH'
-    # 1 word + 1 long
-    elif msgID in [0x043A,0x0445,0x0450,0x0410,0x0412,0x0409,0x040B,0x0453]:
-        return "<Hl"
+    ([0x04E9,0x04EB],'<HHHHHHHHH'),
+    # 1 word + 1 long. The GET replies of the general, relative and absolute move parameters (0x043C, 0x0447, 0x0452) and
+    # MGMSG_MOT_MOVE_RELATIVE (0x0448) used to be listed as 1 word + 3 longs, which is 14 bytes, but the APT protocol defines them as a
+    # channel word + one long, like their SET messages (0x043A, 0x0445, 0x0450). Frames of those messages are 6 bytes long and could
+    # not be encoded or decoded with the old structure
+    ([0x043A,0x043C,0x0445,0x0447,0x0448,0x0450,0x0452,0x0410,0x0412,0x0409,0x040B,0x0453],"<Hl"),
     # 1 word + 3 longs
-    elif msgID in [0x043C,0x0447,0x0452,0x0448,0x0413,0x0415]:
-        return "<Hlll"
-    elif msgID in [0x0481,0x0466,0x0464]:
-        return "<HllI"
-    elif msgID in [0x04A0,0x04A2,0x04E6,0x04E8]:
-        return "<HllllH"
-    elif msgID in [0x0703,0x0705,0x04C3,0x04C5]:
-        return "<HHHllllHlH"
-    elif msgID in [0x042A]:
-        return "<HlllH"
-    elif msgID in [0x065C,0x063F]:
-        return "<HI"
-    elif msgID in [0x0440,0x0442]:
-        return "<HHHll"
-    elif msgID in [0x0416,0x0418]:
-        return "<HHllllH"
-    elif msgID in [0x0423,0x0425]:
-        return "<HHHllH"
-    elif msgID in [0x04B0,0x04B2]:
-        return "<HHlHlHlHl"
-    elif msgID in [0x04B6,0x04B8]:
-        return "<HHllHH"
-    elif msgID in [0x04E3,0x04E5]:
-        return "<HHIHH"
-    elif msgID in [0x04D7,0x04D9]:
-        return "<HHHIHHHHHIHH"
-    elif msgID in [0x04F0,0x04F2]:
-        return "<HH16sIIlllllHHHHIIII"
-    elif msgID in [0x0606,0x0608]:
-        return "<f"
-    elif msgID in [0x0621,0x0623]:
-        return "<"+("H"*32)
-    elif msgID in [0x0626,0x0628]:
-        return "<Hhh"
-    elif msgID in [0x0630,0x0632]:
-        return "<HhhhHH"
-    elif msgID in [0x0633,0x0635]:
-        return "<Hh"
-    elif msgID in [0x0636,0x0638]:
-        return "<l"
-    elif msgID in [0x07EB,0x07ED]:
-        return "<hh4x"
-    elif msgID==0x0661:
-        return "<HhhI"
-    elif msgID==0x0081:
-        return "<HH64s"
-    elif msgID==0x0006:
-        return '<l8sHI48s12xHHH'
-    elif msgID==0x0227:
-        return "<I"
-    elif msgID==0x0491:
-        return "<HlHHI"
-    elif msgID ==0x0614:
-        return "<HHfHHH"
-    elif msgID ==0x063A:
-        return "<fHH"
-    elif msgID ==0x0665:
-        return "<HHHfHHHIhhh"
-    elif msgID ==0x0821:
-        return "<HHI"
-    elif msgID ==0x0881:
-        return "<hhHhhI"
-    elif msgID in [0x0800,0x0802,0x0870,0x0872]:
-        raise Exception("Message " + hex(msgID) + " has a variable data packet structure due to the use of submessages, which hasn't been implemented yet")
+    ([0x0413,0x0415],"<Hlll"),
+    ([0x0481,0x0466,0x0464],"<HllI"),
+    ([0x04A0,0x04A2,0x04E6,0x04E8],"<HllllH"),
+    ([0x0703,0x0705,0x04C3,0x04C5],"<HHHllllHlH"),
+    ([0x042A],"<HlllH"),
+    ([0x065C,0x063F],"<HI"),
+    ([0x0440,0x0442],"<HHHll"),
+    ([0x0416,0x0418],"<HHllllH"),
+    ([0x0423,0x0425],"<HHHllH"),
+    ([0x04B0,0x04B2],"<HHlHlHlHl"),
+    ([0x04B6,0x04B8],"<HHllHH"),
+    ([0x04E3,0x04E5],"<HHIHH"),
+    ([0x04D7,0x04D9],"<HHHIHHHHHIHH"),
+    ([0x04F0,0x04F2],"<HH16sIIlllllHHHHIIII"),
+    ([0x0606,0x0608],"<f"),
+    ([0x0621,0x0623],"<"+("H"*32)),
+    ([0x0626,0x0628],"<Hhh"),
+    ([0x0630,0x0632],"<HhhhHH"),
+    ([0x0633,0x0635],"<Hh"),
+    ([0x0636,0x0638],"<l"),
+    ([0x07EB,0x07ED],"<hh4x"),
+    ([0x0661],"<HhhI"),
+    ([0x0081],"<HH64s"),
+    ([0x0006],'<l8sHI48s12xHHH'),
+    ([0x0227],"<I"),
+    ([0x0491],"<HlHHI"),
+    ([0x0614],"<HHfHHH"),
+    ([0x063A],"<fHH"),
+    ([0x0665],"<HHHfHHHIhhh"),
+    ([0x0821],"<HHI"),
+    ([0x0881],"<hhHhhI"),
+]
+# Messages whose data packet starts with a sub-message ID word which determines the structure of the rest of the packet
+SUBMESSAGE_IDS=[0x0800,0x0802,0x0870,0x0872]
+# Structures of the known sub-messages (excluding the leading sub-message ID word), keyed by (msgID,subMsgID)
+SUBMESSAGE_STRUCTS={
+    # MGMSG_LA_SET_PARAMS / MGMSG_LA_GET_PARAMS
+    (0x0800,0x01):'<H',         # SETPOINT
+    (0x0802,0x01):'<H',
+    (0x0800,0x03):'<H',         # UNITS
+    (0x0802,0x03):'<H',
+    # MGMSG_QUAD_SET_PARAMS / MGMSG_QUAD_GET_PARAMS
+    (0x0870,0x01):'<HHH',       # LOOPPARAMS
+    (0x0872,0x01):'<HHH',
+    (0x0872,0x03):'<hhHhh',     # READINGS
+    (0x0870,0x07):'<H',         # OPERMODE
+    (0x0872,0x07):'<H',
+}
+_PACKET_STRUCT_TABLE={}
+for _msgIDs,_fmt in PACKET_STRUCTS:
+    for _msgID in _msgIDs:
+        _PACKET_STRUCT_TABLE.setdefault(_msgID,_fmt)
+
+def getPacketStruct(msgID):
+    """ given msgID return a format string which can be used by struct.pack and struct.unpack to convert the message data packet to and from hex.
+   The structures are listed in PACKET_STRUCTS. Messages with sub-messages are handled by aptcodec instead """
+    try:
+        return _PACKET_STRUCT_TABLE[msgID]
+    except KeyError:
+        pass
+    if msgID in SUBMESSAGE_IDS:
+        raise Exception("Message " + hex(msgID) + " has a variable data packet structure due to the use of submessages, use aptcodec to pack and unpack it")
     else:
         raise Exception("Message " + hex(msgID) + " does not have a packet structure specified. Please check the documentation for this messageID")
   
@@ -251,6 +246,7 @@ MGMSG_PZ_REQ_PICONSTS = 0x0656
 MGMSG_PZ_GET_PICONSTS = 0x0657
 MGMSG_PZ_REQ_PZSTATUSBITS = 0x065B
 MGMSG_PZ_GET_PZSTATUSBITS = 0x065C
+MGMSG_PZ_REQ_PZSTATUSUPDATE = 0x0660
 MGMSG_PZ_GET_PZSTATUSUPDATE = 0x0661
 MGMSG_PZ_ACK_PZSTATUSUPDATE = 0x0662
 MGMSG_PZ_SET_OUTPUTLUT = 0x0700
@@ -360,6 +356,19 @@ WRITE_TIMEOUT=5000
 QUERY_TIMEOUT=60000
 INIT_QUERY_TIMEOUT=5000
 PURGE_DELAY=50      
+# Polling interval while waiting for data; backs off from the min to the max (in ms) while the device is silent
+READ_POLL_MIN=0.05
+READ_POLL_MAX=1.0
+# Initial size of the receive buffer in bytes
+READ_BUFFER_SIZE=4096
+# File where the fast connect mode of AptDevice keeps the identity of the controllers seen before
+DEVICE_CACHE_PATH=os.environ.get("APTLIB_DEVICE_CACHE",os.path.join(os.path.expanduser("~"),".aptlib","devices.json"))
+# Unix socket and shared memory block of the device server (aptserver), and how often (s) it publishes the streamed status to shared memory
+SERVER_SOCKET_PATH=os.environ.get("APTLIB_SOCKET",os.path.join(os.path.expanduser("~"),".aptlib","server.sock"))
+SERVER_SHARED_MEMORY_NAME=os.environ.get("APTLIB_SHARED_MEMORY","aptlib")
+SERVER_PUBLISH_INTERVAL=0.01
+# Transport backend used to reach the controllers unless one is given (see apttransport): "pylibftdi", "serial" or "sim"
+TRANSPORT=os.environ.get("APTLIB_TRANSPORT","pylibftdi")
 # Device IDs
 HOST_CONTROLLER_ID = 0x01
 RACK_CONTROLLER_ID = 0x11
@@ -388,38 +397,86 @@ CHAN_ENABLE_STATE_ENABLED=0x01
 CHAN_ENABLE_STATE_DISABLED=0x02
 
 """ ------------ Constants and methods for motor controllers ------------------"""
-def getMotorScalingFactors(controllerType,stageType):
-    """ Get the conversion factor between encoder units and real (position/velocity/acceleration) units (e.g. mm,mm/s,mm/s/s for linear drive, 
-    deg, deg/s, deg/s/s for angular) given the controller type and stage type as strings.  This data comes from section 8 of the introduction (p. 14 onwards) 
-    from the 'Thorlabs APT Controllers Host-Controller Communications Protocol Issue 9'    
-    """
+# Conversion factors between encoder units and real (position/velocity/acceleration) units, e.g. mm,mm/s,mm/s/s for linear drive, deg, deg/s, deg/s/s
+# for angular. Encoder value = real value * factor
+ScalingFactors=namedtuple('ScalingFactors',['position','velocity','acceleration'])
+
+# Registry of controller families: velocity and acceleration factors relative to the position factor (encoder counts per real unit), and the
+# encoder counts per real unit of each stage type. This data comes from section 8 of the introduction (p. 14 onwards) from the
+# 'Thorlabs APT Controllers Host-Controller Communications Protocol Issue 9'. Extend it with registerMotorController/registerStage
+MOTOR_CONTROLLERS={
+    "TDC001":(2048/6e6*65536,(2048/6e6)**2*65536),
+    "TBD001":(102.4e-6*65536,102.4e-6**2*65536),
+    "TST001":(1,1),
+    "BSC20X":(53.68,1/90.9),
+}
+MOTOR_CONTROLLER_ALIASES={"BBD10X":"TBD001","BBD20X":"TBD001","BSC00X":"TST001","BSC10X":"TST001","MST601":"TST001","MST602":"BSC20X"}
+STAGE_ENCODER_COUNTS={
+    "TDC001":{"MTS25-Z8":34304,"MTS50-Z8":34304,"PRM1-Z8":1919.64,"Z8XX":34304,"Z6XX":24600},
+    "TBD001":{"DDSM100":2000,"MLS203":20000},
+    "TST001":{"DRV001":51200,"DRV013":25600,"DRV014":25600,"DRV113":20480,"DRV114":20480,"FW103":71/0.998,"NR360":4693/0.999},
+    "BSC20X":{"DRV001":819200,"DRV013":409600,"DRV014":409600,"DRV113":327680,"DRV114":327680,"FW103":1138/1.0002,"NR360":75091/0.99997},
+}
+# Resolved ScalingFactors by (controllerType,stageType) as given by the caller
+_scalingCache={}
+
+def registerMotorController(family,velocityFactor,accelerationFactor,aliases=()):
+    """ Add (or replace) a controller family with the given velocity and acceleration factors relative to the position factor, and
+    optionally other model names which map onto it """
+    MOTOR_CONTROLLERS[family.upper()]=(velocityFactor,accelerationFactor)
+    STAGE_ENCODER_COUNTS.setdefault(family.upper(),{})
+    for alias in aliases:
+        MOTOR_CONTROLLER_ALIASES[alias.upper()]=family.upper()
+    _scalingCache.clear()
+
+def registerStage(controllerFamily,stageType,encoderCounts):
+    """ Add (or replace) a stage type driven by a controller family, given its encoder counts per real unit """
+    STAGE_ENCODER_COUNTS.setdefault(controllerFamily.upper(),{})[stageType.upper()]=encoderCounts
+    _scalingCache.clear()
+
+def motorScaling(controllerType,stageType):
+    """ Return the ScalingFactors for the controller type and stage type given as strings. Raises NameError for an unknown controller and
+    KeyError for a stage unknown to the controller """
+    key=(controllerType,stageType)
+    scaling=_scalingCache.get(key)
+    if scaling is not None:
+        return scaling
     # convert the controller/motor strings to uppercase for versatility
     controller=controllerType.upper()
     stage=stageType.upper()
     # De-inflect into family names from specific models
     if controller[0:-1] in ["BBD10","BBD20","BSC00","BSC10","BSC20"]: controller=controller[0:-1]+"X"
     if stage[0:2] in ["Z8","Z6"]: stage=stage[0:2]+"XX"
-    # define a dictionary for encCnt based
-    if controller=="TDC001":
-        T=2048/6e6
-        encCnt={"MTS25-Z8":34304,"MTS50-Z8":34304,"PRM1-Z8":1919.64,"Z8XX":34304,"Z6XX":24600}
-        return {"position":encCnt[stage],"velocity":encCnt[stage]*T*65536,"acceleration":encCnt[stage]*T**2*65536}
-    elif controller in ["TBD001","BBD10X","BBD20X"]:
-        T=102.4e-6
-        encCnt={"DDSM100":2000,"MLS203":20000}
-        return {"position":encCnt[stage],"velocity":encCnt[stage]*T*65536,"acceleration":encCnt[stage]*T**2*65536}
-    elif controller in ["TST001","BSC00X","BSC10X","MST601"]:
-        encCnt={"DRV001":51200,"DRV013":25600,"DRV014":25600,"DRV113":20480,"DRV114":20480,"FW103":71/0.998,"NR360":4693/0.999}
-        return {"position":encCnt[stage],"velocity":encCnt[stage],"acceleration":encCnt[stage]}
-    elif controller in ["BSC20X","MST602"]:
-        encCnt={"DRV001":819200,"DRV013":409600,"DRV014":409600,"DRV113":327680,"DRV114":327680,"FW103":1138/1.0002,"NR360":75091/0.99997}
-        return {"position":encCnt[stage],"velocity":encCnt[stage]*53.68,"acceleration":encCnt[stage]/90.9}
-    else:
-       raise NameError("Controller type: " + controller + " not found")
+    controller=MOTOR_CONTROLLER_ALIASES.get(controller,controller)
+    if controller not in MOTOR_CONTROLLERS:
+        raise NameError("Controller type: " + controller + " not found")
+    velocityFactor,accelerationFactor=MOTOR_CONTROLLERS[controller]
+    encCnt=STAGE_ENCODER_COUNTS[controller][stage]
+    scaling=_scalingCache[key]=ScalingFactors(encCnt,encCnt*velocityFactor,encCnt*accelerationFactor)
+    return scaling
+
+def getMotorScalingFactors(controllerType,stageType):
+    """ Get the conversion factor between encoder units and real (position/velocity/acceleration) units as a dict, given the controller type
+    and stage type as strings (see motorScaling) """
+    return motorScaling(controllerType,stageType)._asdict()
 
 # Constants for the motor
 MOTOR_JOG_FORWARD=0x01
 MOTOR_JOG_REVERSE=0x02
+# Status bits of the DC motor controllers (as returned in the status update and move completed messages)
+MOTOR_STATUS_FORWARD_LIMIT=0x00000001
+MOTOR_STATUS_REVERSE_LIMIT=0x00000002
+MOTOR_STATUS_MOVING_FORWARD=0x00000010
+MOTOR_STATUS_MOVING_REVERSE=0x00000020
+MOTOR_STATUS_JOGGING_FORWARD=0x00000040
+MOTOR_STATUS_JOGGING_REVERSE=0x00000080
+MOTOR_STATUS_HOMING=0x00000200
+MOTOR_STATUS_HOMED=0x00000400
+MOTOR_STATUS_ENABLED=0x80000000
+# Status update streaming: interval in s between the keepalive (ACK) messages which keep the controller sending updates, and the default
+# maximum age in s of a streamed position before getPosition falls back to querying the controller
+STATUS_KEEPALIVE_INTERVAL=0.5
+STATUS_MAX_AGE=0.5
 
 #DEFAULT_STAGE_TYPE="DRV001"
 DEFAULT_STAGE_TYPE="TDC001"
@@ -443,4 +500,12 @@ PIEZO_VOLTAGE_STEP = 0.1            # 0.1V resolution in specifying voltage
 PIEZO_TRAVEL_STEP = 0.1             # 0.1 um resolution in specifying position   
 PIEZO_POSITION_ACCURACY = .02       # 20nm positional accuracy for closed loop piezo controller
 PIEZO_MOVE_TIMEOUT=1.0              # Timeout in seconds specified for position to reach target level
+PIEZO_SETTLE_POLL=0.01              # Status update requested by setPosition if none has been pushed for this many seconds
 PIEZO_ZERO_TIMEOUT=20.0             # Timeout in seconds specified for zero to finish
+PIEZO_ZERO_POLL=0.05                # Status update requested by zeroAll if none has been pushed for this many seconds
+PIEZO_STATUS_ZEROING=0x00000020     # Status bit set while the piezo controller is zeroing
+# Output waveform look up table (MGMSG_PZ_SET_OUTPUTLUT/MGMSG_PZ_SET_OUTPUTLUTPARAMS)
+PIEZO_LUT_MAX_SAMPLES=512           # Number of LUT entries of the TPZ001 (the BPC30x series hold 8000)
+PIEZO_LUT_MODE_CONTINUOUS=0x01      # Repeat the waveform until MGMSG_PZ_STOP_LUTOUTPUT
+PIEZO_LUT_MODE_FIXED=0x02           # Output the waveform the number of cycles given in the LUT parameters
+PIEZO_LUT_MIN_INTERVAL=1            # Minimum time in ms between LUT samples
@@ -1,8 +1,14 @@
 from __future__ import print_function,division
 from . import aptconsts as c
-import pylibftdi
+from . import aptcodec
+from .aptreader import FrameRouter
+from . import aptcache
+from .aptmetrics import LinkMetrics
+from .aptcapture import WireCapture,CAPTURE_TX,CAPTURE_RX
+from . import apttransport
+import threading
 import time
-from struct import pack,unpack,error
+from struct import error
 
 
 # In debug mode we print out all messages which are sent (in hex)
@@ -10,12 +16,34 @@ DEBUG_MODE=False
 
 class MessageReceiptError(Exception): pass
 class DeviceNotFoundError(Exception): pass
+class MessageWriteError(Exception): pass
+
+class _Batch(object):
+    """ Context manager returned by AptDevice.batch(). bytesWritten is the number of bytes sent when the batch exited """
+    def __init__(self,device):
+        self.device=device
+        self.bytesWritten=0
+
+    def __enter__(self):
+        # The write lock is held for the whole batch so that other threads' frames don't get queued behind it
+        self.device._writeLock.acquire()
+        self.device._batchDepth+=1
+        return self
+
+    def __exit__(self,*exc):
+        try:
+            self.device._batchDepth-=1
+            if not self.device._batchDepth:
+                self.bytesWritten=self.device.flush()
+        finally:
+            self.device._writeLock.release()
+        return False
 
 class AptDevice(object):
     """ Wrapper around the Apt protocol via the ftd2xx driver for USB communication with the FT232BM USB peripheral chip in the APT controllers.
    Below is a list of messages defined for all APT devices. Only a small portion of them necessary have been implemented so far taken from the spec
    http://www.thorlabs.com/software/apt/APT_Communications_Protocol_Rev_9.pdf
-   The communication uses the pylibftdi driver.
+   The communication goes through a pluggable transport, pylibftdi by default (see apttransport).
    """
 
 #    def __init__(self,hwser=None):
@@ -81,12 +109,125 @@ class AptDevice(object):
 #        print("Connected to %s device with serial number %d. Notes about device: %s"%(model.replace('\x00', ''),serNum,notes.replace('\x00', '')))
 
 # TOTALLY REWRITE THE INIT FUNCTION
-    def __init__(self,hwser=None):
-      # add Thorlabs devices to USB_PID_LIST -> in the __init__.py script
-      #pylibftdi.USB_PID_LIST.append(0xfaf0)
+    def __init__(self,hwser=None,reader=False,callback=None,device=None,fastConnect=False,cachePath=None,metrics=None,capture=None,transport=None):
+      """ Open the controller with serial number hwser (or the first one matching the class if None) through the transport backend
+      (c.TRANSPORT if None, see apttransport), or the given pylibftdi.Device compatible device. With fastConnect the identity (model,
+      channels, bays) found on the last connect is taken from the cache in cachePath (c.DEVICE_CACHE_PATH by default) when available, and
+      checked by a background thread; this starts the reader thread.
+      metrics is an aptmetrics.LinkMetrics to collect the link metrics in from the first frame (see enableMetrics), and capture the path of
+      a log to capture every frame into from the first one (see startCapture) """
+      self._initBuffers()
+      self.metrics=metrics
+      if capture is not None:
+        self.startCapture(capture)
+      self.transport=transport
+      identity=None
+      if fastConnect and device is None and hwser is not None:
+        identity=aptcache.loadIdentity(hwser,cachePath)
+        if identity is not None:
+          # Open the known device directly instead of enumerating the bus
+          device=apttransport.openTransport(hwser,transport)
+      if device is None:
+        device=self._openDevice(hwser)
+      if fastConnect and identity is None:
+        identity=aptcache.loadIdentity(device.device_id,cachePath)
+      self.device=device
+      # Inititalize the device according to FTD2xx and APT requirements
+      apttransport.configure(device)
+      # With a cached identity stale bytes left after the purge can't be mistaken for replies since the reader thread routes them
+      if identity is None: self.delay()
+      device.flush()
+      if identity is None: self.delay()
+
+      if reader or identity is not None:
+        self.startReader(callback)
 
+      # Background check of a cached identity (see verifyIdentity)
+      self.identityVerified=threading.Event()
+      self.identityMismatch=False
+      self.identityError=None
+      cached=identity is not None
+      if not cached:
+        identity=self._identify()
+        if fastConnect and identity["responded"]:
+          # The defaults assumed for a controller which didn't answer aren't cached, so the next connect asks it again
+          aptcache.storeIdentity(device.device_id,identity,cachePath)
+        self.identityVerified.set()
+      # channelAddresses is a list of (chanID,destAddress) tuples
+      self.channelAddresses=list(identity["channelAddresses"])
+      for channel in range(len(self.channelAddresses)):
+        self.writeMessage(c.MGMSG_MOD_SET_CHANENABLESTATE,1,c.CHAN_ENABLE_STATE_ENABLED,c.RACK_CONTROLLER_ID)            
+        self.EnableHWChannel(channel)
+      # Set the controller type
+      self.controllerType=identity["model"]
+      # Print a message saying we've connected to the device successfuly
+      print("Connected to %s device with serial number %d. Notes about device: %s"%(identity["model"],identity["serialNumber"],identity["notes"]))
+      if cached:
+        verifier=threading.Thread(target=self.verifyIdentity,args=(identity,cachePath),name="AptDevice identity check")
+        verifier.daemon=True
+        verifier.start()
+
+    def _identify(self,fallback=True):
+      """ Query the controller for its model and channels, and return them as the identity dict kept by the fast connect cache.
+      If a single channel controller doesn't answer default values are assumed and "responded" is False, or the error is raised if not
+      fallback """
+      channelAddresses=[]
+      bays=None
+      responded=True
+      # Check first 2 digits of serial number to see if it's normal type or card/slot type
+      if self.device.device_id[0:2] in c.BAY_TYPE_SERIAL_PREFIXES:
+        # Get the device info
+        serNum,model,hwtype,firmwareVer,notes,hwVer,modState,numCh=self.query(c.MGMSG_HW_REQ_INFO,c.MGMSG_HW_GET_INFO,destID=c.RACK_CONTROLLER_ID)[-1]
+        # Check which bays are occupied, and request the hardware info of those, each with a single pipelined round trip
+        with self.batch():
+          for bay in range(numCh):
+            self.writeMessage(c.MGMSG_HW_NO_FLASH_PROGRAMMING,destID=c.ALL_BAYS[bay])
+        bays=[self._bayState(response) for response in self.queryMany([(c.MGMSG_RACK_REQ_BAYUSED,c.MGMSG_RACK_GET_BAYUSED,bay,0,c.RACK_CONTROLLER_ID) for bay in range(numCh)])]
+        channelAddresses=[(c.CHANNEL_1,c.ALL_BAYS[bay]) for bay in range(numCh) if bays[bay]]
+        for response in self.queryMany([(c.MGMSG_HW_REQ_INFO,c.MGMSG_HW_GET_INFO,0,0,bayId) for chanID,bayId in channelAddresses]):
+          if isinstance(response,Exception): raise response
+      else:
+        # Otherwise just build a list of the channel numbers
+        self.writeMessage(c.MGMSG_HW_NO_FLASH_PROGRAMMING,destID=c.GENERIC_USB_ID)
+        try:
+          serNum,model,hwtype,firmwareVer,notes,hwVer,modState,numCh=self.query(c.MGMSG_HW_REQ_INFO,c.MGMSG_HW_GET_INFO,waitTime=c.INIT_QUERY_TIMEOUT)[-1]
+        except:
+          if not fallback:
+            raise
+          print('Device not responding, trying manual initialization')
+          numCh = 1
+          model = b'TDC001\x00\x00'
+          serNum = 00000000
+          notes = b'APT DC Motor Controller'
+          responded=False
+        for channel in range(numCh):
+          channelAddresses.append((c.ALL_CHANNELS[channel],c.GENERIC_USB_ID))
+      return {"serialNumber":serNum,"model":model.split(b'\x00',1)[0].decode(),"notes":notes.split(b'\x00',1)[0].decode(),
+              "numChannels":numCh,"bays":bays,"channelAddresses":channelAddresses,"responded":responded}
+
+    def verifyIdentity(self,cached,cachePath=None):
+      """ Run the discovery queries and compare the result with the cached identity used to connect. If they differ the cache is
+      updated for the next connect, a warning is printed and identityMismatch is set. If the controller doesn't answer the error is kept
+      in identityError. identityVerified is set when done """
+      try:
+        identity=self._identify(fallback=False)
+        if identity!=cached:
+          aptcache.storeIdentity(self.device.device_id,identity,cachePath)
+          if all(identity[key]==cached.get(key) for key in identity if key!="responded"):
+            return
+          self.identityMismatch=True
+          print("Warning: cached identity of device %s is out of date (found %s, %d channels at %s); reconnect to use it"
+                  %(self.device.device_id,identity["model"],len(identity["channelAddresses"]),identity["channelAddresses"]))
+      except Exception as e:
+        self.identityError=e
+      finally:
+        self.identityVerified.set()
+
+    def _openDevice(self,hwser=None):
+      """ Find the device with serial number hwser, or the first device matching deviceDescriptionStrings(), on the USB bus and open it """
+      device=None
       # Get list of connected devices
-      devList = pylibftdi.Driver().list_devices()
+      devList = apttransport.listDevices(self.transport)
       # Find out how many serial devices are connected to the USB bus
       numDevices = len(devList)
 #        # Check each device to see if either the serial number matches (if given) or the description string is recognized as valid for the class type
@@ -96,13 +237,13 @@ class AptDevice(object):
         if hwser!=None and detail[2]!="" and int(detail[2])==hwser:
           # Get the first device which matches the serial number if given
           numMatchingDevices+=1
-          self.device=device=pylibftdi.Device(mode='b',device_id=detail[2].decode())
+          device=apttransport.openTransport(detail[2],self.transport)
           break
-        elif hwser==None and (detail[1].decode() in self.deviceDescriptionStrings()):
+        elif hwser==None and (detail[1] in self.deviceDescriptionStrings()):
           # Get the first device which is valid for the given class if no hwser
           numMatchingDevices+=1
           if numMatchingDevices==1:
-            self.device=device=pylibftdi.Device(mode='b',device_id=detail[2].decode())
+            device=apttransport.openTransport(detail[2],self.transport)
           elif dev==numDevices-1 and numMatchingDevices==0:
              # Raise an exception if no devices were found
              if hwser!=None:
@@ -113,178 +254,484 @@ class AptDevice(object):
       # Print a warning message if no serial given and multiple devices were found which matched the class type
       if numMatchingDevices>1 and hwser==None: 
           print(str(numMatchingDevices)+" devices found matching " + type(self).__name__ + "; the first device was opened")
-      # Inititalize the device according to FTD2xx and APT requirements
-      device.baudrate = 115200
-
-      # Return exception if there is an error in ftdi function
-      def _checked_c(ret):
-        if not ret == 0:
-          raise Exception(device.ftdi_fn.ftdi_get_error_string())
-
-      _checked_c(device.ftdi_fn.ftdi_set_line_property( 8,  # number of bits
-                                                        1,  # number of stop bits
-                                                        0   # no parity
-                                                        ))
-      self.delay()
-      device.flush(pylibftdi.FLUSH_BOTH)
-      self.delay()
-
-      # Skip the reset part
-
-      # From ftdi.h
-      SIO_RTS_CTS_HS = (0x1 << 8)
-      _checked_c(device.ftdi_fn.ftdi_setflowctrl(SIO_RTS_CTS_HS))
-      _checked_c(device.ftdi_fn.ftdi_setrts(1))
-
-      # Check first 2 digits of serial number to see if it's normal type or card/slot type, and build self.channelAddresses as list of (chanID,destAddress) tuples
-      self.channelAddresses=[]
-      if device.device_id[0:2] in c.BAY_TYPE_SERIAL_PREFIXES:
-        # Get the device info
-        serNum,model,hwtype,firmwareVer,notes,hwVer,modState,numCh=self.query(c.MGMSG_HW_REQ_INFO,c.MGMSG_HW_GET_INFO,destID=c.RACK_CONTROLLER_ID)[-1]
-        # Check each bay to see if it's enabled and also request hardware info
-        for bay in range(numCh):
-          bayId=c.ALL_BAYS[bay]
-          self.writeMessage(c.MGMSG_HW_NO_FLASH_PROGRAMMING,destID=bayId)
-          if self.BayUsed(bay):
-            bayInfo=self.query(c.MGMSG_HW_REQ_INFO,c.MGMSG_HW_GET_INFO,destID=bayId)[-1]
-            self.channelAddresses.append((c.CHANNEL_1,bayId))
-      else:
-        # Otherwise just build a list of the channel numbers
-        self.writeMessage(c.MGMSG_HW_NO_FLASH_PROGRAMMING,destID=c.GENERIC_USB_ID)
+      if device is None:
+        raise DeviceNotFoundError("Hardware serial number " + str(hwser) + " was not found" if hwser!=None else "No devices found matching class name " + type(self).__name__)
+      return device
+
+    def __del__(self):
+        self.stopReader()
+        # device isn't set if the constructor failed before opening it
+        device=getattr(self,'device',None)
+        if device is not None and not device.closed:
+            device.close()
+
+    def close(self):
+        self._stopUpdates()
+        self.stopReader()
         try:
-          serNum,model,hwtype,firmwareVer,notes,hwVer,modState,numCh=self.query(c.MGMSG_HW_REQ_INFO,c.MGMSG_HW_GET_INFO,waitTime=c.INIT_QUERY_TIMEOUT)[-1]
-        except:
-          print('Device not responding, trying manual initialization')
-          numCh = 1
-          model = b'TCD001\x00\x00'
-          serNum = 00000000
-          notes = b'APT DC Motor Controller'
-        for channel in range(numCh):
-          self.channelAddresses.append((c.ALL_CHANNELS[channel],c.GENERIC_USB_ID))  
-      for channel in range(len(self.channelAddresses)):
-        self.writeMessage(c.MGMSG_MOD_SET_CHANENABLESTATE,1,c.CHAN_ENABLE_STATE_ENABLED,c.RACK_CONTROLLER_ID)            
-        self.EnableHWChannel(channel)
-      # Set the controller type
-      #print(model)
-      #input()
-      self.controllerType=model.split(b'\x00',1)[0].decode()
-      # Print a message saying we've connected to the device successfuly
-      print("Connected to %s device with serial number %d. Notes about device: %s"%(model.split(b'\x00',1)[0].decode(),serNum,notes.split(b'\x00',1)[0].decode()))
+            self.stopCapture()
+        finally:
+            self.device.close()
 
+    def startReader(self,callback=None):
+        """ Start a background thread which reads frames continuously and routes them to the threads waiting in query().
+        Frames which nobody is waiting for (e.g. a late MGMSG_MOT_MOVE_COMPLETED) are passed to callback(message) if given,
+        otherwise they are put on the queue self.events """
+        if self._reader is not None:
+            # Now wanted for itself rather than for what started it (see _acquireReader)
+            self._implicitReader=False
+            return
+        self.router.callback=callback
+        self.router.error=None
+        self._readerStop=threading.Event()
+        self._reader=threading.Thread(target=self._readerLoop,args=(self._readerStop,),name="AptDevice reader")
+        self._reader.daemon=True
+        self._reader.start()
 
-        
-    def __del__(self):
+    def stopReader(self):
+        """ Stop the background reader thread, if running """
+        self._implicitReader=False
+        reader=self._detachReader()
+        if reader is not None and reader is not threading.current_thread():
+            reader.join()
+
+    def _detachReader(self):
+        """ Tell the reader thread to stop and return it (None if there is none) without waiting for it to exit, which it does after its
+        current read. Reads hold _readLock, so a reader started meanwhile or a querying thread can't read at the same time """
+        reader=getattr(self,'_reader',None)
+        if reader is None:
+            return None
+        self._readerStop.set()
+        self._reader=None
+        # Wake up the threads waiting for the reader to route their reply, which now read the frames themselves
+        with self.router.condition:
+            self.router.condition.notify_all()
+        return reader
+
+    def _acquireReader(self):
+        """ Start the reader thread for status updates or moves which need it, if it isn't running. A reader started here is stopped by
+        _releaseReader once nothing needs it, so that the queries which follow don't pay for routing through it """
+        with self._implicitLock:
+            if self._reader is None:
+                self.startReader(self.router.callback)
+                self._implicitReader=True
+
+    def _releaseReader(self):
+        """ Stop the reader thread started by _acquireReader if nothing needs it any more (see _readerNeeded). It may run in the reader
+        thread itself, so it doesn't wait for the thread to exit """
+        with self._implicitLock:
+            if self._implicitReader and not self._readerNeeded():
+                self._implicitReader=False
+                self._detachReader()
+
+    def _readerNeeded(self):
+        """ True while something relies on the reader thread to route frames: here the status updates """
+        return self.streaming
+
+    @property
+    def events(self):
+        """ Queue of the unsolicited frames received while waiting for replies, when no callback is set """
+        return self.router.events
+
+    def _readerLoop(self,stop):
+        """ Body of the reader thread, which runs until the stop event is set. If it stops on an error the error is handed to the waiting
+        threads and later queries read the frames themselves """
+        try:
+            while not stop.is_set():
+                with self._readLock:
+                    try:
+                        message=self._readFrame()
+                    except MessageReceiptError:
+                        # Nothing received within the read timeout
+                        continue
+                self.router.dispatch(message)
+        except Exception as e:
+            if self._reader is threading.current_thread():
+                self._reader=None
+            self.router.fail(e)
+        finally:
+            # Threads waiting for the read lock can take over
+            with self.router.condition:
+                self.router.condition.notify_all()
+
+    def enableMetrics(self,metrics=None):
+        """ Start collecting link metrics into metrics (a new aptmetrics.LinkMetrics labelled with the serial number if None) and return it """
+        if metrics is None:
+            metrics=LinkMetrics(str(getattr(self,"serialNumber",self.device.device_id)))
+        self.metrics=metrics
+        return metrics
+
+    def disableMetrics(self):
+        """ Stop collecting link metrics """
+        self.metrics=None
+
+    def startCapture(self,path,**kwargs):
+        """ Record every frame sent and received from now on into the capture log at path (see aptcapture.WireCapture for the keyword
+        arguments), which ReplayDevice can play back. Returns the WireCapture """
+        self.stopCapture()
+        self.capture=WireCapture(path,**kwargs)
+        return self.capture
+
+    def stopCapture(self):
+        """ Stop capturing and write out the rest of the log """
+        capture,self.capture=self.capture,None
+        if capture is not None:
+            capture.close()
+
+    @property
+    def streaming(self):
+        """ True while status updates are being streamed """
+        return self._updatesStop is not None
+
+    def _statusChannel(self,message):
+        """ Return the channel index of a status message from its source and channel ID, or None if it isn't one of ours """
+        return self._statusChannels.get((message[4],message[-1][0]))
+
+    def _controllerAddresses(self):
+        return sorted(set(destAddress for channelID,destAddress in self.channelAddresses))
+
+    def _startUpdates(self,messageIDs,listener,ackMessageID,keepaliveInterval):
+        """ Ask the controllers to push status update messages, route the messageIDs to listener(message), and start a thread sending the
+        ackMessageID keepalive every keepaliveInterval s so that the controllers keep sending. The reader thread is started if needed,
+        and stopped again by _stopUpdates if it was started for them """
+        if self._updatesStop is not None:
+            return
+        self._acquireReader()
+        self._statusChannels=dict(((destAddress,channelID),channel) for channel,(channelID,destAddress) in enumerate(self.channelAddresses))
+        self._updatesListener=(messageIDs,listener)
+        for messageID in messageIDs:
+            self.router.addListener(messageID,listener)
+        self._updatesStop=threading.Event()
+        with self.batch():
+            for destAddress in self._controllerAddresses():
+                self.writeMessage(c.MGMSG_HW_START_UPDATEMSGS,destID=destAddress)
+        keepalive=threading.Thread(target=self._keepalive,args=(self._updatesStop,ackMessageID,keepaliveInterval),name="AptDevice keepalive")
+        keepalive.daemon=True
+        keepalive.start()
+
+    def _stopUpdates(self):
+        """ Stop the status updates started by _startUpdates """
+        if self._updatesStop is None:
+            return
+        self._updatesStop.set()
+        self._updatesStop=None
+        messageIDs,listener=self._updatesListener
+        for messageID in messageIDs:
+            self.router.removeListener(messageID,listener)
         if not self.device.closed:
-            self.device.close()
+            with self.batch():
+                for destAddress in self._controllerAddresses():
+                    self.writeMessage(c.MGMSG_HW_STOP_UPDATEMSGS,destID=destAddress)
+        self._releaseReader()
 
-    def close(self):
-        self.device.close()
+    def _keepalive(self,stop,ackMessageID,interval):
+        """ Body of the keepalive thread """
+        while not stop.wait(interval):
+            try:
+                with self.batch():
+                    for destAddress in self._controllerAddresses():
+                        self.writeMessage(ackMessageID,destID=destAddress)
+            except Exception as e:
+                print("Error sending status update keepalive: " + repr(e))
+                return
 
     def writeMessage(self,messageID,param1=0x00,param2=0x00,destID=c.GENERIC_USB_ID,sourceID=c.HOST_CONTROLLER_ID,dataPacket=None):
         """ Send message to device given messageID, parameters 1 & 2, destination and sourceID ID, and optional data packet, 
         where dataPacket is an array of numeric values. The method converts all the values to hex according to the protocol
         specification for the message, and sends this to the device."""
-        if dataPacket!=None:
-            # If a data packet is included then header consists of concatenation of: messageID (2 bytes),number of bytes in dataPacket (2 bytes), destination byte with MSB=1 (i.e. or'd with 0x80), sourceID byte
+        # If a data packet is included then header consists of concatenation of: messageID (2 bytes),number of bytes in dataPacket (2 bytes), destination byte with MSB=1 (i.e. or'd with 0x80), sourceID byte
+        # If no data packet then header consists of concatenation of: messageID (2 bytes),param 1 byte, param2 bytes,destination byte, sourceID byte
+        with self._writeLock:
+            offset=self._txLength
             try:
-                dataPacketStr=pack(c.getPacketStruct(messageID) , *dataPacket)
+                length=aptcodec.encodeInto(self._txBuffer,messageID,param1,param2,destID,sourceID,dataPacket,offset)
             except error as e:
-                raise error("Error packing message " +hex(messageID)+"; probably the packet structure is recorded incorrectly in c.getPacketStruct()")
-            message=pack(c.HEADER_FORMAT_WITH_DATA , messageID , len(dataPacketStr) , destID|0x80 , sourceID) + dataPacketStr
-        else:
-            # If no data packet then header consists of concatenation of: messageID (2 bytes),param 1 byte, param2 bytes,destination byte, sourceID byte
-            message=pack(c.HEADER_FORMAT_WITHOUT_DATA,messageID,param1,param2,destID,sourceID)
-        if DEBUG_MODE: self.disp(message,"TX:  ")
-        #input()
-        numBytesWritten=self.device.write(message)
+                raise error("Error packing message " +hex(messageID)+"; probably the packet structure is recorded incorrectly in c.PACKET_STRUCTS")
+            if DEBUG_MODE: self.disp(bytes(self._txBuffer[offset:offset+length]),"TX:  ")
+            if self.metrics is not None: self.metrics.frameSent(messageID,length)
+            if self.capture is not None: self.capture.record(CAPTURE_TX,memoryview(self._txBuffer)[offset:offset+length])
+            #input()
+            if self._batchDepth:
+                # Inside batch(): leave the frame in the transmit buffer until the batch is flushed
+                self._txLength=offset+length
+            else:
+                self._writeAll(length)
+
+    def batch(self):
+        """ Context manager which coalesces the messages written inside it into a single USB transfer when it exits:
+
+            with device.batch() as b:
+                device.writeMessage(...)
+                device.writeMessage(...)
+            print(b.bytesWritten)
+
+        Batches can be nested, the frames are sent when the outermost one exits. Queries made inside a batch flush the frames queued before them """
+        return _Batch(self)
+
+    def flush(self):
+        """ Send the frames queued by batch() so far, and return the number of bytes written """
+        with self._writeLock:
+            length=self._txLength
+            self._txLength=0
+            return self._writeAll(length) if length else 0
+
+    def _writeAll(self,length):
+        """ Write the first length bytes of the transmit buffer, retrying after short writes until everything is sent or c.WRITE_TIMEOUT expires """
+        data=bytes(self._txBuffer[:length])
+        sent=0
+        deadline=None
+        while sent<length:
+            numBytesWritten=self.device.write(data[sent:] if sent else data)
+            if numBytesWritten is None or numBytesWritten<0:
+                raise MessageWriteError("Error writing to apt device: " + repr(numBytesWritten))
+            sent+=numBytesWritten
+            if sent<length:
+                if self.metrics is not None: self.metrics.shortWrite()
+                if deadline is None:
+                    deadline=time.monotonic()+c.WRITE_TIMEOUT/1000
+                elif time.monotonic()>deadline:
+                    raise MessageWriteError("Timeout writing to apt device: " + str(sent) + " of " + str(length) + " bytes written")
+                if not numBytesWritten:
+                    time.sleep(c.READ_POLL_MIN/1000)
+        return sent
     
     def query(self,txMessageID,rxMessageID,param1=0,param2=0,destID=c.GENERIC_USB_ID,sourceID=c.HOST_CONTROLLER_ID,dataPacket=None,waitTime=None):
         """ Sends the REQ query message given by txMessageID, and then retrieves the GET response message given by rxMessageID from the device.
         param1,param2,destID,and sourceID for the REQ message can also be specified if non-default values are required.
         The return value is a 7 element tuple with the first 6 values the messageID,param1,param2,destID,sourceID from the GET message header
         and the final value of the tuple is another tuple containing the values of the data packet, or None if there was no data packet.
-        A wait parameter can also be optionally specified (in seconds) which introduces a waiting period between writing and reading """
-        self.writeMessage(txMessageID,param1,param2,destID,sourceID,dataPacket)
-        if waitTime!=None:
-            # Keep reading the response until the query timeout is exceeded if wait flag specified
-            t0=time.time()
-            while True:
-                try:
-                    response=self.readMessage()
-                    break
-                except MessageReceiptError:
-                    if time.time()-t0 > waitTime/1000: raise
+        A wait parameter can also be optionally specified (in seconds) which introduces a waiting period between writing and reading.
+        The reply is matched by messageID, source and channel, so unrelated frames received first are not an error, and any number of threads
+        can query the device at once: each gets its own reply, routed by the reader thread (see startReader) or else by whichever waiting thread is reading """
+        waiter=self._replyWaiter(rxMessageID,param1,destID,dataPacket)
+        t0=time.monotonic()
+        try:
+            self.writeMessage(txMessageID,param1,param2,destID,sourceID,dataPacket)
+            self.flush()
+        except:
+            self.router.cancel(waiter)
+            raise
+        response=self._awaitReply(waiter,t0+(c.READ_TIMEOUT if waitTime is None else waitTime)/1000)
+        if self.metrics is not None:
+            if response is None:
+                self.metrics.queryTimedOut(txMessageID)
+                self.metrics.receiptError()
+            else:
+                self.metrics.queryDone(txMessageID,waiter.received-t0)
+        if response is None:
+            raise MessageReceiptError("Timeout querying apt device when sending messageID " + hex(txMessageID) + ".... Expected to receive messageID " + hex(rxMessageID))
+        return response
+
+    def queryMany(self,requests,waitTime=None):
+        """ Pipelined version of query(): send all the REQ messages back to back in a single USB transfer, then collect the GET replies,
+        matched by messageID, source and channel, as they arrive. requests is a list of tuples with the arguments of query()
+        (txMessageID,rxMessageID[,param1[,param2[,destID[,sourceID[,dataPacket]]]]]). waitTime (ms, default c.READ_TIMEOUT) is shared by the
+        whole batch. Returns a list with the reply of each request in order, or the MessageReceiptError raised for a request which wasn't answered """
+        defaults=(0,0,c.GENERIC_USB_ID,c.HOST_CONTROLLER_ID,None)
+        requests=[tuple(request)+defaults[len(request)-2:] for request in requests]
+        waiters=[]
+        try:
+            for txMessageID,rxMessageID,param1,param2,destID,sourceID,dataPacket in requests:
+                waiters.append(self._replyWaiter(rxMessageID,param1,destID,dataPacket))
+            with self.batch():
+                for txMessageID,rxMessageID,param1,param2,destID,sourceID,dataPacket in requests:
+                    self.writeMessage(txMessageID,param1,param2,destID,sourceID,dataPacket)
+        except:
+            for waiter in waiters:
+                self.router.cancel(waiter)
+            raise
+        deadline=time.monotonic()+(c.READ_TIMEOUT if waitTime is None else waitTime)/1000
+        results=[]
+        for request,waiter in zip(requests,waiters):
+            response=self._awaitReply(waiter,deadline)
+            if response is None:
+                if self.metrics is not None:
+                    self.metrics.queryTimedOut(request[0])
+                    self.metrics.receiptError()
+                response=MessageReceiptError("Timeout querying apt device when sending messageID " + hex(request[0]) + ".... Expected to receive messageID " + hex(request[1]))
+            results.append(response)
+        return results
+
+    def _replyWaiter(self,rxMessageID,param1=0,destID=c.GENERIC_USB_ID,dataPacket=None,callback=None):
+        """ Register with the router for the reply rxMessageID to a request with the given param1/dataPacket sent to destID.
+        The reply must come from destID and, unless the request's channel is 0, from the same channel """
+        channel=param1 if dataPacket is None else dataPacket[0]
+        return self.router.register(rxMessageID,destID,channel or None,callback)
+
+    def _initBuffers(self):
+      """ Set up the transmit/receive buffers and the (not yet running) reader thread state """
+      # Reusable buffer which outgoing messages are encoded into
+      self._txBuffer=bytearray(aptcodec.MAX_FRAME_BYTES)
+      # Number of bytes queued in self._txBuffer by batch(), and the nesting depth of batch()
+      self._txLength=0
+      self._batchDepth=0
+      # Serializes the use of the transmit buffer between threads (e.g. the identity check of fast connect and the caller)
+      self._writeLock=threading.RLock()
+      # aptmetrics.LinkMetrics collecting the link metrics, or None when disabled
+      self.metrics=None
+      # aptcapture.WireCapture recording the frames, or None when not capturing
+      self.capture=None
+      # Held by the thread reading frames off the device when the reader thread isn't running (see _awaitReply)
+      self._readLock=threading.Lock()
+      # Receive buffer: bytes in self._rxBuffer[self._rxStart:self._rxEnd] have been read from the device but not consumed yet
+      self._rxBuffer=bytearray(c.READ_BUFFER_SIZE)
+      self._rxView=memoryview(self._rxBuffer)
+      self._rxStart=0
+      self._rxEnd=0
+      # Background reader thread (see startReader), and the router which matches received frames to the replies being waited for
+      self._reader=None
+      self.router=FrameRouter()
+      # Whether the reader thread was started by _acquireReader rather than by startReader, and the lock serializing the two
+      self._implicitReader=False
+      self._implicitLock=threading.Lock()
+      # Status update streaming (see _startUpdates): the stop event of the keepalive thread while streaming, and the listener registered
+      self._updatesStop=None
+      self._updatesListener=None
+      # channel -> latest streamed status of the channel, kept by the subclasses
+      self.status={}
+
+    def _fill(self):
+      """ Move everything the device has available into the receive buffer with a single bulk read, and return the number of bytes added """
+      if self._rxStart==self._rxEnd:
+        self._rxStart=self._rxEnd=0
+      elif self._rxEnd>len(self._rxBuffer)//2:
+        # Compact the unconsumed bytes to the start of the buffer to make room
+        unconsumed=self._rxEnd-self._rxStart
+        self._rxBuffer[:unconsumed]=self._rxView[self._rxStart:self._rxEnd]
+        self._rxStart,self._rxEnd=0,unconsumed
+      chunk=self.device.read(len(self._rxBuffer)-self._rxEnd)
+      numBytes=len(chunk)
+      if numBytes:
+        self._rxBuffer[self._rxEnd:self._rxEnd+numBytes]=chunk
+        self._rxEnd+=numBytes
+      return numBytes
+
+    def _reserve(self,length):
+      """ Make sure the receive buffer can hold length unconsumed bytes """
+      if length>len(self._rxBuffer):
+        # Views handed out earlier keep the old buffer alive, so allocate a new one rather than resizing
+        unconsumed=self._rxEnd-self._rxStart
+        rxBuffer=bytearray(max(length,2*len(self._rxBuffer)))
+        rxBuffer[:unconsumed]=self._rxView[self._rxStart:self._rxEnd]
+        self._rxBuffer=rxBuffer
+        self._rxView=memoryview(rxBuffer)
+        self._rxStart,self._rxEnd=0,unconsumed
+
+    def _waitFor(self,length,waitTime=c.READ_TIMEOUT):
+      """ Wait until at least length bytes are in the receive buffer, without consuming them. Returns False if waitTime (ms) runs out first,
+      or blocks indefinitely if waitTime is None. Polling backs off from READ_POLL_MIN to READ_POLL_MAX while the device stays silent """
+      if self._rxEnd-self._rxStart>=length:
+        return True
+      self._reserve(length)
+      deadline=None if waitTime is None else time.monotonic()+waitTime/1000
+      pause=0
+      while True:
+        if self._fill():
+          if self._rxEnd-self._rxStart>=length:
+            return True
+          pause=0
+          continue
+        if deadline is not None:
+          remaining=deadline-time.monotonic()
+          if remaining<=0:
+            # Part of a frame arrived but not the rest of it
+            if self.metrics is not None and self._rxEnd>self._rxStart: self.metrics.shortRead()
+            return False
         else:
-            # Otherwise just wait for the ordinary read timeout
-            response=self.readMessage()
-        # Check that the received message is the one which was expected
-        if response[0]!=rxMessageID:
-            raise MessageReceiptError("Error querying apt device when sending messageID " + hex(txMessageID) + ".... Expected to receive messageID " + hex(rxMessageID) + " but got " + hex(response[0]))
-        return response             
+          remaining=c.READ_POLL_MAX/1000
+        pause=min(max(2*pause,c.READ_POLL_MIN/1000),c.READ_POLL_MAX/1000,remaining)
+        if self.metrics is None:
+          time.sleep(pause)
+        else:
+          t0=time.monotonic()
+          time.sleep(pause)
+          self.metrics.slept(time.monotonic()-t0)
 
     def _read(self,length,waitTime=c.READ_TIMEOUT):
       """
-      If block is True, then we will return only when have have length number of
-      bytes. Otherwise we will perform a read, then immediately return with
-      however many bytes we managed to read.
+      Wait until length bytes have been received and return them as a memoryview slice of the receive buffer,
+      which is only valid until the next read. waitTime is in ms, or None to block until the data arrives.
 
-      Note that if no data is available, then an empty byte string will be
-      returned.
+      Note that if the data doesn't arrive in time, then an empty byte string will be
+      returned and any partial data is kept for the next read.
       """
-      data = bytes()
-      t0 = time.time()
-      while len(data) < length:
-        diff = length - len(data)
-        data += self.device.read(diff)
-        if waitTime!=None and time.time()-t0 > waitTime/1000:
-          break
-
-        time.sleep(0.001)
+      if not self._waitFor(length,waitTime):
+        return b''
+      start=self._rxStart
+      self._rxStart=start+length
+      return self._rxView[start:start+length]
 
-      return data
-
-      
+    def _awaitReply(self,waiter,deadline):
+        """ Wait until the time.monotonic() deadline for the frame of a waiter registered with the router, and return it, or None on timeout.
+        Without the reader thread the frames are read here, and those for other waiters or nobody are routed as the reader thread would.
+        Raises the reader's error if the reader thread dies while routing the frames """
+        condition=self.router.condition
+        while waiter.response is None:
+            remaining=deadline-time.monotonic()
+            if remaining<=0:
+                self.router.cancel(waiter)
+                return waiter.response
+            if self._reader is not None:
+                # The reader thread routes the frame, unless it is stopped meanwhile
+                with condition:
+                    condition.wait_for(lambda: waiter.response is not None or self.router.error is not None or self._reader is None,remaining)
+                    if waiter.response is None and self.router.error is not None:
+                        self.router.cancel(waiter)
+                        raise self.router.error
+                continue
+            # Leader/follower: one waiting thread at a time reads and routes frames for all of them, the others sleep until their
+            # frame has been routed or the reader's role is free
+            if not self._readLock.acquire(False):
+                with condition:
+                    condition.wait_for(lambda: waiter.response is not None or not self._readLock.locked(),remaining)
+                continue
+            try:
+                if waiter.response is None:
+                    try:
+                        self.router.dispatch(self._readFrame(min(remaining*1000,c.READ_TIMEOUT)))
+                    except MessageReceiptError:
+                        pass
+            finally:
+                self._readLock.release()
+                with condition:
+                    condition.notify_all()
+        return waiter.response
 
-    def readMessage(self):
+    def readMessage(self,waitTime=c.READ_TIMEOUT):
         """ Read a single message from the device and return tuple of messageID, parameters 1 & 2, destination and sourceID ID, and data packet 
         (if included), where dataPacket is a tuple of all the message dependent parameters decoded from hex, 
         as specified in the protocol documentation. Normally the user doesn't need to call this method as it's automatically called by query()"""
+        try:
+            return self._readFrame(waitTime)
+        except MessageReceiptError:
+            if self.metrics is not None: self.metrics.receiptError()
+            raise
+
+    def _readFrame(self,waitTime=c.READ_TIMEOUT):
+        """ readMessage() for the reader thread and the threads routing frames, whose read timeouts are just idle polls and aren't
+        counted as receipt errors """
         # Read 6 byte header from device
-        headerRaw=self._read(c.NUM_HEADER_BYTES)
-        if headerRaw==b'': raise MessageReceiptError("Timeout reading from the device")
+        if not self._waitFor(c.NUM_HEADER_BYTES,waitTime):
+            raise MessageReceiptError("Timeout reading from the device")
         # Check if a data packet is attached (i.e. get the 5th byte and check if the MSB is set)
-        #print(headerRaw)
-        if DEBUG_MODE: self.disp(headerRaw)
-        #input()
-        #isDataPacket=unpack("B",headerRaw[4])[0]>>7
-        isDataPacket = headerRaw[4]>>7
-        #print(isDataPacket)
-        #input()
+        messageID,param1,param2,destID,sourceID,dataPacketLength=aptcodec.decodeHeader(self._rxView[self._rxStart:self._rxStart+c.NUM_HEADER_BYTES])
+        frameLength=c.NUM_HEADER_BYTES+dataPacketLength
+        # Only consume the header once the whole frame has arrived, so that a timeout doesn't lose the frame boundary
+        if not self._waitFor(frameLength,waitTime):
+            raise MessageReceiptError("Timeout reading data packet of message " + hex(messageID) + " from the device")
+        frame=self._read(frameLength)
+        if DEBUG_MODE: self.disp(frame,"RX:  ")
+        if self.metrics is not None: self.metrics.frameReceived(messageID,frameLength)
+        if self.capture is not None: self.capture.record(CAPTURE_RX,frame)
         # Read data packet if it exists, and interpret the message accordingly
-        if isDataPacket:
-            header=unpack(c.HEADER_FORMAT_WITH_DATA,headerRaw)
-            messageID=header[0]
-            dataPacketLength=header[1]
-            param1=None
-            param2=None
-            destID=header[2]
-            sourceID=header[3]
-            destID=destID&0x7F
-            dataPacketRaw=self._read(dataPacketLength)
-            if DEBUG_MODE: self.disp(headerRaw+dataPacketRaw,"RX:  ")
+        if dataPacketLength:
             try:
-                dataPacket=unpack(c.getPacketStruct(messageID),dataPacketRaw)
-            except error as e:
-                # If an error occurs, it's likely due to a problem with the manual inputted data for packet structure in aptconsts
-                raise
+                dataPacket=aptcodec.decodeDataPacket(messageID,frame[c.NUM_HEADER_BYTES:])
+            except Exception:
+                # A message without a packet structure in aptconsts, or of another size (e.g. from newer firmware): the frame has been
+                # consumed, so pass its data packet on as raw bytes rather than losing the link
+                dataPacket=bytes(frame[c.NUM_HEADER_BYTES:])
         else:
-            if DEBUG_MODE: self.disp(headerRaw,"RX:  ")
-            header=unpack(c.HEADER_FORMAT_WITHOUT_DATA,headerRaw)
-            messageID=header[0]
-            param1=header[1]
-            param2=header[2]
-            destID=header[3]
-            sourceID=header[4]
             dataPacket=None
         # Return tuple containing all the message parameters
         return (messageID,param1,param2,destID,sourceID,dataPacket)
@@ -302,7 +749,12 @@ class AptDevice(object):
 
     def BayUsed(self,bayId):
         """ Check if the specified bay is occupied """
-        response=self.query(c.MGMSG_RACK_REQ_BAYUSED,c.MGMSG_RACK_GET_BAYUSED,bayId,0,c.RACK_CONTROLLER_ID)
+        return self._bayState(self.query(c.MGMSG_RACK_REQ_BAYUSED,c.MGMSG_RACK_GET_BAYUSED,bayId,0,c.RACK_CONTROLLER_ID))
+
+    def _bayState(self,response):
+        """ Interpret the reply to MGMSG_RACK_REQ_BAYUSED (or the error from queryMany) """
+        if isinstance(response,Exception):
+            raise response
         state=response[2]
         if state==c.BAY_OCCUPIED:
             return True
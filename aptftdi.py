@@ -0,0 +1,38 @@
+""" Transport over libftdi through pylibftdi (see apttransport). Importing this module loads libftdi and registers the USB product ID of
+the Thorlabs APT controllers with pylibftdi """
+from __future__ import print_function,division
+import pylibftdi
+from .apttransport import configureFtdi
+
+# add Thorlabs devices to USB_PID_LIST
+if 0xfaf0 not in pylibftdi.USB_PID_LIST:
+    pylibftdi.USB_PID_LIST.append(0xfaf0)
+
+def _text(value):
+    return value.decode() if isinstance(value,bytes) else value
+
+class FtdiTransport(object):
+    """ The controller with the given serial number opened with pylibftdi.Device in binary mode """
+    def __init__(self,serial):
+        self.device=pylibftdi.Device(mode='b',device_id=str(serial))
+        self.device_id=str(serial)
+        # Bound directly to the device's methods so the transport adds no call overhead to the hot path
+        self.read=self.device.read
+        self.write=self.device.write
+
+    @staticmethod
+    def listDevices():
+        return [(_text(manufacturer),_text(description),_text(serial)) for manufacturer,description,serial in pylibftdi.Driver().list_devices()]
+
+    @property
+    def closed(self):
+        return self.device.closed
+
+    def configure(self):
+        configureFtdi(self.device)
+
+    def flush(self,flags=pylibftdi.FLUSH_BOTH):
+        self.device.flush(flags)
+
+    def close(self):
+        self.device.close()
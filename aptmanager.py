@@ -0,0 +1,147 @@
+""" Bring up many APT controllers at once.
+DeviceManager enumerates the USB bus a single time, and then opens and initializes the requested controllers concurrently, so that the
+startup time of a rig is set by its slowest controller rather than the sum over all of them. A fleet file maps logical names onto
+controllers:
+
+    {
+     "focus": {"class": "Z8XX", "serial": 83000001},
+     "x": {"class": "AptMotor", "serial": 83000002, "stageType": "MTS50-Z8", "fastConnect": true},
+     "objective": {"class": "AptPiezo", "serial": 81000001}
+    }
+
+Any keys besides "class" and "serial" are passed to the constructor. """
+from __future__ import print_function,division
+import json
+from concurrent.futures import ThreadPoolExecutor
+from . import apttransport
+from .aptdevice import AptDevice,DeviceNotFoundError
+from .aptmotor import AptMotor
+from .aptpiezo import AptPiezo
+from .prm1 import PRM1
+from .z8xx import Z8XX
+
+# Classes which can be named in a fleet file
+DEVICE_CLASSES={"AptDevice":AptDevice,"AptMotor":AptMotor,"AptPiezo":AptPiezo,"PRM1":PRM1,"Z8XX":Z8XX}
+
+def _descriptions(cls):
+    """ Description strings accepted by a device class. deviceDescriptionStrings doesn't use the instance, so it is called without one.
+    Classes without it (AptDevice) can only be opened by serial number """
+    if not hasattr(cls,"deviceDescriptionStrings"):
+        return ()
+    return cls.deviceDescriptionStrings(None)
+
+class DeviceManager(object):
+    """ Index of the controllers on the bus, built by enumerating it once through the transport backend (c.TRANSPORT if None, see
+    apttransport). devices can be given instead as a list of (manufacturer,description,serial) tuples as returned by
+    apttransport.listDevices(), and deviceFactory(serial) replaces the backend to open them (e.g. to use aptsim.SimulatedDevice) """
+    def __init__(self,devices=None,deviceFactory=None,transport=None):
+        self.transport=transport
+        self.deviceFactory=deviceFactory or (lambda serial: apttransport.openTransport(serial,transport))
+        self.opened={}
+        self.refresh(devices)
+
+    def refresh(self,devices=None):
+        """ Enumerate the bus (unless devices is given) and rebuild bySerial (serial -> description) and byDescription (description -> [serials]) """
+        if devices is None:
+            devices=apttransport.listDevices(self.transport)
+        self.bySerial={}
+        self.byDescription={}
+        for manufacturer,description,serial in devices:
+            serial=serial.decode() if isinstance(serial,bytes) else str(serial)
+            description=description.decode() if isinstance(description,bytes) else description
+            self.bySerial[serial]=description
+            self.byDescription.setdefault(description,[]).append(serial)
+
+    def find(self,cls,serial=None,exclude=()):
+        """ Return the serial number (as a string) of the controller to open for cls: serial itself if it is on the bus, otherwise the first
+        controller not in exclude whose description matches the class """
+        if serial is not None:
+            serial=str(serial)
+            if serial not in self.bySerial:
+                raise DeviceNotFoundError("Hardware serial number " + serial + " was not found")
+            return serial
+        for description in _descriptions(cls):
+            for candidate in self.byDescription.get(description,[]):
+                if candidate not in exclude:
+                    return candidate
+        if not hasattr(cls,"deviceDescriptionStrings"):
+            raise DeviceNotFoundError(cls.__name__ + " doesn't match any device description; give the serial number of the controller to open")
+        raise DeviceNotFoundError("No devices found matching class name " + cls.__name__)
+
+    def open(self,cls,serial=None,name=None,**kwargs):
+        """ Open and initialize one controller with class cls. Extra keyword arguments are passed to the constructor """
+        serial=self.find(cls,serial,self._claimed())
+        device=self._connect(cls,serial,kwargs)
+        self.opened[name if name is not None else serial]=device
+        return device
+
+    def openMany(self,specs,maxWorkers=None):
+        """ Open the controllers described by specs, a dict of name -> (cls,serial,kwargs), concurrently on a thread pool and return a dict
+        of name -> device. If any of them fails the others are closed and the first error is raised """
+        # Resolve the serial numbers up front so that two specs without a serial can't claim the same controller
+        claimed=self._claimed()
+        serials={}
+        for name,(cls,serial,kwargs) in specs.items():
+            serials[name]=self.find(cls,serial,claimed)
+            claimed.add(serials[name])
+        def connect(name):
+            cls,serial,kwargs=specs[name]
+            return self._connect(cls,serials[name],kwargs or {})
+        devices={}
+        error=None
+        if specs:
+            with ThreadPoolExecutor(max_workers=maxWorkers or len(specs)) as pool:
+                futures=dict((name,pool.submit(connect,name)) for name in specs)
+                for name,future in futures.items():
+                    try:
+                        devices[name]=future.result()
+                    except Exception as e:
+                        if error is None: error=e
+        if error is not None:
+            for device in devices.values():
+                device.close()
+            raise error
+        self.opened.update(devices)
+        return devices
+
+    def openFleet(self,path,maxWorkers=None):
+        """ Open all the controllers of a fleet file (see loadFleet) and return a dict of name -> device """
+        return self.openMany(loadFleet(path),maxWorkers)
+
+    def _connect(self,cls,serial,kwargs):
+        """ Open the transport to a controller and initialize it with cls, closing the transport again if the initialization fails """
+        transport=self.deviceFactory(serial)
+        try:
+            return cls(device=transport,**kwargs)
+        except:
+            transport.close()
+            raise
+
+    def _claimed(self):
+        return set(str(device.device.device_id) for device in self.opened.values())
+
+    def close(self):
+        """ Close all the controllers opened through the manager """
+        for device in self.opened.values():
+            device.close()
+        self.opened={}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self,*exc):
+        self.close()
+
+def loadFleet(path):
+    """ Read a JSON fleet file mapping logical names onto {"class":..,"serial":..,...} and return the specs for DeviceManager.openMany """
+    with open(path) as f:
+        fleet=json.load(f)
+    specs={}
+    for name,entry in fleet.items():
+        entry=dict(entry)
+        className=entry.pop("class")
+        if className not in DEVICE_CLASSES:
+            raise ValueError("Unknown device class " + repr(className) + " for " + repr(name) + "; expected one of " + ", ".join(sorted(DEVICE_CLASSES)))
+        serial=entry.pop("serial",None)
+        specs[name]=(DEVICE_CLASSES[className],serial,entry)
+    return specs
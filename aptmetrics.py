@@ -0,0 +1,149 @@
+""" Instrumentation of the link to an APT controller: frames and bytes sent and received per message ID, query latency histograms per
+request message, timeouts, receive errors, short reads/writes and the time spent sleeping while polling the device.
+Collection is off by default and then costs a single attribute test per frame; enable it with AptDevice.enableMetrics() (or the metrics
+argument of AptDevice). Read the counters with LinkMetrics.snapshot(), or in Prometheus text format with prometheusText() """
+from __future__ import print_function,division
+import bisect
+import threading
+
+# Upper bounds (s) of the query latency histogram buckets
+LATENCY_BUCKETS=(50e-6,100e-6,250e-6,500e-6,1e-3,2.5e-3,5e-3,10e-3,25e-3,50e-3,100e-3,250e-3,500e-3,1.0,2.5,5.0,10.0)
+
+def _messageLabel(messageID):
+    return "%#06x"%messageID
+
+class LinkMetrics(object):
+    """ Counters of one device link. label names the device in the Prometheus output (AptDevice.enableMetrics uses the serial number) """
+    def __init__(self,label=None,buckets=LATENCY_BUCKETS):
+        self.label=label
+        self.buckets=tuple(buckets)
+        self._lock=threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """ Zero all the counters """
+        with self._lock:
+            # messageID -> [frames,bytes]
+            self._tx={}
+            self._rx={}
+            # messageID -> [count per bucket (the last one is +Inf),sum,count]
+            self._latency={}
+            # messageID -> number of queries which timed out
+            self._timeouts={}
+            self.receiptErrors=0
+            self.shortReads=0
+            self.shortWrites=0
+            self.sleepTime=0.0
+
+    def frameSent(self,messageID,length):
+        with self._lock:
+            counts=self._tx.get(messageID)
+            if counts is None:
+                counts=self._tx[messageID]=[0,0]
+            counts[0]+=1
+            counts[1]+=length
+
+    def frameReceived(self,messageID,length):
+        with self._lock:
+            counts=self._rx.get(messageID)
+            if counts is None:
+                counts=self._rx[messageID]=[0,0]
+            counts[0]+=1
+            counts[1]+=length
+
+    def queryDone(self,messageID,latency):
+        """ Record the round trip time (s) of a query with request messageID """
+        with self._lock:
+            histogram=self._latency.get(messageID)
+            if histogram is None:
+                histogram=self._latency[messageID]=[[0]*(len(self.buckets)+1),0.0,0]
+            histogram[0][bisect.bisect_left(self.buckets,latency)]+=1
+            histogram[1]+=latency
+            histogram[2]+=1
+
+    def queryTimedOut(self,messageID):
+        with self._lock:
+            self._timeouts[messageID]=self._timeouts.get(messageID,0)+1
+
+    def receiptError(self):
+        """ Record a read or query which failed with MessageReceiptError (the idle polls of the reader thread aren't counted) """
+        with self._lock:
+            self.receiptErrors+=1
+
+    def shortRead(self):
+        """ Record a read which timed out with part of a frame received """
+        with self._lock:
+            self.shortReads+=1
+
+    def shortWrite(self):
+        with self._lock:
+            self.shortWrites+=1
+
+    def slept(self,seconds):
+        with self._lock:
+            self.sleepTime+=seconds
+
+    def snapshot(self):
+        """ Return a copy of the counters as a dict. Per message counters are keyed by the hex message ID, and the latency histograms
+        list the cumulative count of each bucket upper bound as in Prometheus """
+        with self._lock:
+            latency={}
+            for messageID,(counts,total,count) in self._latency.items():
+                cumulative=0
+                buckets=[]
+                for bound,bucketCount in zip(self.buckets+(float('inf'),),counts):
+                    cumulative+=bucketCount
+                    buckets.append((bound,cumulative))
+                latency[_messageLabel(messageID)]={"buckets":buckets,"sum":total,"count":count}
+            return {"txFrames":dict((_messageLabel(messageID),frames) for messageID,(frames,numBytes) in self._tx.items()),
+                    "txBytes":dict((_messageLabel(messageID),numBytes) for messageID,(frames,numBytes) in self._tx.items()),
+                    "rxFrames":dict((_messageLabel(messageID),frames) for messageID,(frames,numBytes) in self._rx.items()),
+                    "rxBytes":dict((_messageLabel(messageID),numBytes) for messageID,(frames,numBytes) in self._rx.items()),
+                    "queryLatency":latency,
+                    "timeouts":dict((_messageLabel(messageID),count) for messageID,count in self._timeouts.items()),
+                    "receiptErrors":self.receiptErrors,
+                    "shortReads":self.shortReads,
+                    "shortWrites":self.shortWrites,
+                    "sleepTime":self.sleepTime}
+
+    def prometheus(self,prefix="aptlib"):
+        return prometheusText([self],prefix)
+
+# Prometheus metric name suffix, type, help text and snapshot key of the counters
+_COUNTERS=(("tx_frames_total","counter","Frames sent per message ID","txFrames"),
+           ("tx_bytes_total","counter","Bytes sent per message ID","txBytes"),
+           ("rx_frames_total","counter","Frames received per message ID","rxFrames"),
+           ("rx_bytes_total","counter","Bytes received per message ID","rxBytes"),
+           ("query_timeouts_total","counter","Queries which timed out per request message ID","timeouts"))
+_SCALARS=(("receipt_errors_total","counter","Reads and queries which failed with MessageReceiptError","receiptErrors"),
+          ("short_reads_total","counter","Reads which timed out with part of a frame received","shortReads"),
+          ("short_writes_total","counter","Device writes which sent part of the data","shortWrites"),
+          ("read_sleep_seconds_total","counter","Time spent sleeping while polling the device for data","sleepTime"))
+
+def _labels(**labels):
+    return "{"+",".join('%s="%s"'%(key,str(value).replace("\\","\\\\").replace('"','\\"')) for key,value in sorted(labels.items()) if value is not None)+"}"
+
+def prometheusText(metrics,prefix="aptlib"):
+    """ Return the counters of a list of LinkMetrics in the Prometheus text exposition format, with the device label of each """
+    snapshots=[(m.label,m.snapshot()) for m in metrics]
+    lines=[]
+    for suffix,kind,text,key in _COUNTERS:
+        name=prefix+"_"+suffix
+        lines+=["# HELP "+name+" "+text,"# TYPE "+name+" "+kind]
+        for label,snapshot in snapshots:
+            for message,value in sorted(snapshot[key].items()):
+                lines.append(name+_labels(device=label,message=message)+" "+repr(value))
+    for suffix,kind,text,key in _SCALARS:
+        name=prefix+"_"+suffix
+        lines+=["# HELP "+name+" "+text,"# TYPE "+name+" "+kind]
+        for label,snapshot in snapshots:
+            lines.append(name+(_labels(device=label) if label is not None else "")+" "+repr(snapshot[key]))
+    name=prefix+"_query_latency_seconds"
+    lines+=["# HELP "+name+" Round trip time of queries per request message ID","# TYPE "+name+" histogram"]
+    for label,snapshot in snapshots:
+        for message,histogram in sorted(snapshot["queryLatency"].items()):
+            for bound,count in histogram["buckets"]:
+                lines.append(name+"_bucket"+_labels(device=label,message=message,le="+Inf" if bound==float('inf') else repr(bound))+" "+str(count))
+            lines.append(name+"_sum"+_labels(device=label,message=message)+" "+repr(histogram["sum"]))
+            lines.append(name+"_count"+_labels(device=label,message=message)+" "+str(histogram["count"]))
+    return "\n".join(lines)+"\n"
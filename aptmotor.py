@@ -1,13 +1,120 @@
 from __future__ import absolute_import,division,print_function
-from .aptdevice import AptDevice
+from collections import namedtuple
+import threading
+import time
+try:
+    import numpy as np
+except ImportError:
+    np=None
+from .aptdevice import AptDevice,MessageReceiptError
 from . import aptconsts as c
+from .aptscan import runScan
+
+# Outcome of one axis of moveMany: the position reported in the move completed message, the time from sending the move until its
+# completion was received (in s), and the exception if the axis failed (in which case position is None)
+MoveResult=namedtuple('MoveResult',['position','duration','error'])
+# Latest streamed state of a channel: position in real units, the raw velocity word and the 32 status bits reported by the controller, and
+# the time.monotonic() time it was received
+MotorStatus=namedtuple('MotorStatus',['position','velocity','statusBits','timestamp'])
+
+class MoveHandle(object):
+    """ A move sent without waiting for it to finish. The reader thread resolves the handle when the controller reports the end of the
+    move (or MGMSG_MOT_MOVE_STOPPED after cancel()), so the caller can do other work in the meantime and collect the outcome with wait()
+    or result(). started and finished are time.monotonic() times, and message is the frame which ended the move. If the reader thread
+    was started for the move it is stopped again once no handle is outstanding. onFinish is called when the move ends, before the handle
+    is resolved; the error it raises, if any, becomes the error of the handle """
+    def __init__(self,motor,channel,messageIDs,onFinish=None):
+        self.motor=motor
+        self.channel=channel
+        self.message=None
+        self.error=None
+        self._onFinish=onFinish
+        self._resolving=False
+        self.started=time.monotonic()
+        self.finished=None
+        channelID,destAddress=motor.channelAddresses[channel]
+        # Register before the move is sent so that a fast reply can't be missed
+        self._waiters=[motor._replyWaiter(messageID,channelID,destAddress,callback=self._resolve) for messageID in messageIDs]
+
+    def _resolve(self,message,error=None):
+        """ Waiter callback, called by the reader thread with the frame ending the move, or None if the reader thread died """
+        router=self.motor.router
+        with router.condition:
+            if self._resolving:
+                return
+            self._resolving=True
+            for waiter in self._waiters:
+                router.cancel(waiter)
+        finished=time.monotonic()
+        if self._onFinish is not None:
+            # Before waking the threads waiting on the handle, so that what they send next reaches the controller after it
+            try:
+                self._onFinish()
+            except Exception as e:
+                error=error or e
+        with router.condition:
+            if message is None:
+                self.error=error or router.error or MessageReceiptError("The reader thread stopped before the move finished")
+            else:
+                self.message=message
+                self.error=error
+            self.finished=finished
+            router.condition.notify_all()
+        self.motor._moveFinished()
+
+    def _fail(self,error):
+        self._resolve(None,error)
+
+    def done(self):
+        """ True once the move has finished, been stopped or failed """
+        return self.message is not None or self.error is not None
+
+    @property
+    def stopped(self):
+        """ True if the move ended with MGMSG_MOT_MOVE_STOPPED rather than reaching its target """
+        return self.message is not None and self.message[0]==c.MGMSG_MOT_MOVE_STOPPED
+
+    @property
+    def duration(self):
+        """ Time (s) from sending the move until it finished, or None while it is in progress """
+        return None if self.finished is None else self.finished-self.started
+
+    def wait(self,timeout=None):
+        """ Wait up to timeout s (forever if None) for the move to finish. Returns done() """
+        with self.motor.router.condition:
+            return self.motor.router.condition.wait_for(self.done,timeout)
+
+    def result(self,timeout=None):
+        """ Wait up to timeout s for the move to finish and return the position it reported (None for homing, whose completion message
+        carries no position). Raises MessageReceiptError on timeout, or the error the move failed with """
+        if not self.wait(timeout):
+            raise MessageReceiptError("Timeout waiting for the move of channel " + str(self.channel) + " to finish")
+        if self.error is not None:
+            raise self.error
+        dataPacket=self.message[-1]
+        return self.motor._encToPosition(dataPacket[1]) if dataPacket else None
+
+    def cancel(self):
+        """ Stop the move with MGMSG_MOT_MOVE_STOP. The handle is then resolved by MGMSG_MOT_MOVE_STOPPED (or by the completion if the
+        move finished first). Returns False if the move had already finished """
+        if self.done():
+            return False
+        self.motor.LLMoveStop(self.channel)
+        self.motor.flush()
+        return True
 
 class _AptMotor(AptDevice):
     """ Wrapper around the messages of the APT protocol specified for motor controller. The method names (and case) are set the same as in the Thor Labs ActiveX control for compatibility
 
     !!!! TODO: These are no longer directly compatible with ActiveX control due to the mapping of channel onto destId via self.channelAddresses, therefore it makes more sense to use a cleaner syntax here without
     worrying about compatibility, and if needed make a AptMotorWrapper(AptMotor) class which gives versions with identical names. This will prevent cluttering of the namespace as well"""   
+    # (controllerType,stageType) which the cached scaling factors were resolved for
+    _scalingKey=None
+
     def __init__(self,stageType=c.DEFAULT_STAGE_TYPE,*args,**kwargs):
+        # Number of moves outstanding (see _moveStarted)
+        self._moveLock=threading.Lock()
+        self._moveHandles=0
         super(_AptMotor,self).__init__(*args,**kwargs)
         """ 
         ThorLabs APT ActiveX control does the following on initialization of PRM1-Z8 stage with TDC001 controller
@@ -28,28 +135,30 @@ class _AptMotor(AptDevice):
 
         # Initialization procedure for the different stages (only PRM1-Z8 implemented)
         if self.stageType == 'PRM1-Z8':
-            # MGMSG_MOT_SET_VELPARAMS
-            self.writeMessage(c.MGMSG_MOT_SET_VELPARAMS,dataPacket=(c.CHANNEL_1,0,0x93,0x68d5f))
-            # MGMSG_MOT_SET_JOGPARAMS
-            self.writeMessage(c.MGMSG_MOT_SET_JOGPARAMS,dataPacket=(c.CHANNEL_1,0x2,0x257e,0x08bd,0xdc,0x9d425,0x2))
-            # MGMSG_MOT_SET_LIMSWITCHPARAMS
-            self.writeMessage(c.MGMSG_MOT_SET_LIMSWITCHPARAMS,dataPacket=(c.CHANNEL_1,0x4,0x1,0x780,0x780,0x1))
-            # MGMSG_MOT_SET_GENMOVEPARAMS
-            self.writeMessage(c.MGMSG_MOT_SET_GENMOVEPARAMS,dataPacket=(c.CHANNEL_1,0x780))
-            # MGMSG_MOT_SET_HOMEPARAMS
-            self.writeMessage(c.MGMSG_MOT_SET_HOMEPARAMS,dataPacket=(c.CHANNEL_1,0x2,0x1,0x68d5f,0x1dff))
-            # MGMSG_MOT_SET_MOVERELPARAMS
-            self.writeMessage(c.MGMSG_MOT_SET_MOVERELPARAMS,dataPacket=(c.CHANNEL_1,0xa00))
-            # MGMSG_MOT_SET_MOVEABSPARAMS
-            self.writeMessage(c.MGMSG_MOT_SET_MOVEABSPARAMS,dataPacket=(c.CHANNEL_1,0x0))
-            # MGMSG_MOT_SET_DCPIDPARAMS
-            self.writeMessage(c.MGMSG_MOT_SET_DCPIDPARAMS,dataPacket=(c.CHANNEL_1,0x352,0x96,0xaa0,0x32,0xf))
-            # MGMSG_MOT_SET_AVMODES
-            self.writeMessage(c.MGMSG_MOT_SET_AVMODES,dataPacket=(c.CHANNEL_1,0xf))
-            # MGMSG_MOT_SET_BUTTONPARAMS
-            self.writeMessage(c.MGMSG_MOT_SET_BUTTONPARAMS,dataPacket=(c.CHANNEL_1,0x1,0x4afc,0x95f9,0x7d0,0x7d0))
-            # MGMSG_MOT_SET_POTPARAMS
-            self.writeMessage(c.MGMSG_MOT_SET_POTPARAMS,dataPacket=(c.CHANNEL_1,0x14,0xa7be,0x32,0x346b4,0x50,0x68d69,0x64,0xd1ad1))
+            # Send the whole profile in a single USB transfer
+            with self.batch():
+                # MGMSG_MOT_SET_VELPARAMS
+                self.writeMessage(c.MGMSG_MOT_SET_VELPARAMS,dataPacket=(c.CHANNEL_1,0,0x93,0x68d5f))
+                # MGMSG_MOT_SET_JOGPARAMS
+                self.writeMessage(c.MGMSG_MOT_SET_JOGPARAMS,dataPacket=(c.CHANNEL_1,0x2,0x257e,0x08bd,0xdc,0x9d425,0x2))
+                # MGMSG_MOT_SET_LIMSWITCHPARAMS
+                self.writeMessage(c.MGMSG_MOT_SET_LIMSWITCHPARAMS,dataPacket=(c.CHANNEL_1,0x4,0x1,0x780,0x780,0x1))
+                # MGMSG_MOT_SET_GENMOVEPARAMS
+                self.writeMessage(c.MGMSG_MOT_SET_GENMOVEPARAMS,dataPacket=(c.CHANNEL_1,0x780))
+                # MGMSG_MOT_SET_HOMEPARAMS
+                self.writeMessage(c.MGMSG_MOT_SET_HOMEPARAMS,dataPacket=(c.CHANNEL_1,0x2,0x1,0x68d5f,0x1dff))
+                # MGMSG_MOT_SET_MOVERELPARAMS
+                self.writeMessage(c.MGMSG_MOT_SET_MOVERELPARAMS,dataPacket=(c.CHANNEL_1,0xa00))
+                # MGMSG_MOT_SET_MOVEABSPARAMS
+                self.writeMessage(c.MGMSG_MOT_SET_MOVEABSPARAMS,dataPacket=(c.CHANNEL_1,0x0))
+                # MGMSG_MOT_SET_DCPIDPARAMS
+                self.writeMessage(c.MGMSG_MOT_SET_DCPIDPARAMS,dataPacket=(c.CHANNEL_1,0x352,0x96,0xaa0,0x32,0xf))
+                # MGMSG_MOT_SET_AVMODES
+                self.writeMessage(c.MGMSG_MOT_SET_AVMODES,dataPacket=(c.CHANNEL_1,0xf))
+                # MGMSG_MOT_SET_BUTTONPARAMS
+                self.writeMessage(c.MGMSG_MOT_SET_BUTTONPARAMS,dataPacket=(c.CHANNEL_1,0x1,0x4afc,0x95f9,0x7d0,0x7d0))
+                # MGMSG_MOT_SET_POTPARAMS
+                self.writeMessage(c.MGMSG_MOT_SET_POTPARAMS,dataPacket=(c.CHANNEL_1,0x14,0xa7be,0x32,0x346b4,0x50,0x68d69,0x64,0xd1ad1))
             
 
     def close(self):
@@ -59,10 +168,11 @@ class _AptMotor(AptDevice):
         return super(_AptMotor, self).close()
 
     def MoveHome(self,channel=0,wait=True):
-        """ Home the specified channel and wait for the homed return message to be returned """
+        """ Home the specified channel and wait for the homed return message to be returned. With wait=False return a MoveHandle instead """
         channelID,destAddress=self.channelAddresses[channel]
-        waitTime=c.QUERY_TIMEOUT if wait else None
-        response=self.query(c.MGMSG_MOT_MOVE_HOME,c.MGMSG_MOT_MOVE_HOMED,channelID,destID=destAddress,waitTime=waitTime)
+        if not wait:
+            return self._startMove(channel,c.MGMSG_MOT_MOVE_HOMED,c.MGMSG_MOT_MOVE_HOME,channelID,destID=destAddress)
+        response=self.query(c.MGMSG_MOT_MOVE_HOME,c.MGMSG_MOT_MOVE_HOMED,channelID,destID=destAddress,waitTime=c.QUERY_TIMEOUT)
 
     def MoveJog(self,channel=0,direction=c.MOTOR_JOG_FORWARD):
         """ Jog the specified channel in the specified direction and wait for the move completed message to be returned """
@@ -77,16 +187,91 @@ class _AptMotor(AptDevice):
         return self._encToPosition(posParam)
 
     def MoveAbsoluteEnc(self,channel=0,positionCh1=0.0,positionCh2=0,waitTime=c.QUERY_TIMEOUT,wait=True):
-        """ Move the specified channel to the specified absolute position and wait for the move completed message to be returned """
+        """ Move the specified channel to the specified absolute position and wait for the move completed message to be returned.
+        With wait=False return a MoveHandle instead """
         channelID,destAddress=self.channelAddresses[channel]
         position=positionCh1
-        waitTimeParam=waitTime if wait else None
         posParam=self._positionToEnc(position)
-        response=self.query(c.MGMSG_MOT_MOVE_ABSOLUTE,c.MGMSG_MOT_MOVE_COMPLETED,0x06,destID=destAddress,dataPacket=(channelID,posParam),waitTime=waitTimeParam)
+        if not wait:
+            return self._startMove(channel,c.MGMSG_MOT_MOVE_COMPLETED,c.MGMSG_MOT_MOVE_ABSOLUTE,0x06,destID=destAddress,dataPacket=(channelID,posParam))
+        response=self.query(c.MGMSG_MOT_MOVE_ABSOLUTE,c.MGMSG_MOT_MOVE_COMPLETED,0x06,destID=destAddress,dataPacket=(channelID,posParam),waitTime=waitTime)
+
+    def MoveRelativeEnc(self,channel=0,distance=0.0,waitTime=c.QUERY_TIMEOUT,wait=True):
+        """ Move the specified channel by distance from its current position with a single MGMSG_MOT_MOVE_RELATIVE and wait for the move
+        completed message to be returned. With wait=False return a MoveHandle instead """
+        channelID,destAddress=self.channelAddresses[channel]
+        dataPacket=(channelID,self._positionToEnc(distance))
+        if not wait:
+            return self._startMove(channel,c.MGMSG_MOT_MOVE_COMPLETED,c.MGMSG_MOT_MOVE_RELATIVE,0x06,destID=destAddress,dataPacket=dataPacket)
+        self.query(c.MGMSG_MOT_MOVE_RELATIVE,c.MGMSG_MOT_MOVE_COMPLETED,0x06,destID=destAddress,dataPacket=dataPacket,waitTime=waitTime)
+
+    def MoveVelocity(self,channel=0,direction=c.MOTOR_JOG_FORWARD):
+        """ Start moving the specified channel continuously in direction at the maximum velocity of its velocity parameters, until it is
+        stopped (LLMoveStop, or cancel() on the returned MoveHandle) or reaches a limit switch. Returns a MoveHandle resolved by the
+        MGMSG_MOT_MOVE_STOPPED message """
+        channelID,destAddress=self.channelAddresses[channel]
+        return self._startMove(channel,c.MGMSG_MOT_MOVE_STOPPED,c.MGMSG_MOT_MOVE_VELOCITY,channelID,direction,destID=destAddress)
+
+    def SetVelParams(self,channel=0,minVelocity=0.0,acceleration=0.0,maxVelocity=0.0):
+        """ Set the trapezoidal velocity profile of the specified channel: velocities in mm/s and acceleration in mm/s/s (or degrees) """
+        channelID,destAddress=self.channelAddresses[channel]
+        self.writeMessage(c.MGMSG_MOT_SET_VELPARAMS,destID=destAddress,dataPacket=(channelID,self._velocityToEnc(minVelocity),
+                                                                                     self._accelerationToEnc(acceleration),self._velocityToEnc(maxVelocity)))
+
+    def GetVelParams(self,channel=0):
+        """ Get the (minVelocity,acceleration,maxVelocity) of the velocity profile of the specified channel in mm/s and mm/s/s (or degrees) """
+        channelID,destAddress=self.channelAddresses[channel]
+        response=self.query(c.MGMSG_MOT_REQ_VELPARAMS,c.MGMSG_MOT_GET_VELPARAMS,channelID,destID=destAddress)
+        dataPacket=response[-1]
+        scaling=self.scaling
+        return dataPacket[1]/scaling.velocity,dataPacket[2]/scaling.acceleration,dataPacket[3]/scaling.velocity
+
+    def _startMove(self,channel,rxMessageID,txMessageID,param1=0,param2=0,destID=c.GENERIC_USB_ID,dataPacket=None,onFinish=None):
+        """ Send a move without waiting and return a MoveHandle resolved by rxMessageID or MGMSG_MOT_MOVE_STOPPED. The reader thread is
+        started if needed since it resolves the handle, and stopped by _moveFinished once the last handle is resolved, so that the
+        queries which follow don't pay for routing through it """
+        self._moveStarted()
+        handle=MoveHandle(self,channel,(rxMessageID,c.MGMSG_MOT_MOVE_STOPPED),onFinish)
+        try:
+            self.writeMessage(txMessageID,param1,param2,destID,dataPacket=dataPacket)
+            self.flush()
+        except Exception as e:
+            handle._fail(e)
+            raise
+        return handle
+
+    def _moveStarted(self):
+        """ Count a move whose completion the reader thread has to route, starting the reader thread if needed. Each call is matched by
+        a call to _moveFinished """
+        with self._moveLock:
+            self._moveHandles+=1
+        self._acquireReader()
+
+    def _moveFinished(self):
+        """ Called when a move counted by _moveStarted has been resolved: stop the reader thread if it was started for the moves, or for
+        status updates which have stopped since, and nothing needs it any more (see AptDevice._releaseReader) """
+        with self._moveLock:
+            self._moveHandles-=1
+        self._releaseReader()
+
+    def _readerNeeded(self):
+        return self._moveHandles>0 or super(_AptMotor,self)._readerNeeded()
+
+    def _startMoveAbsolute(self,channel,position):
+        """ Send the absolute move for channel without waiting, and return the router waiter for its MGMSG_MOT_MOVE_COMPLETED """
+        channelID,destAddress=self.channelAddresses[channel]
+        dataPacket=(channelID,self._positionToEnc(position))
+        waiter=self._replyWaiter(c.MGMSG_MOT_MOVE_COMPLETED,0x06,destAddress,dataPacket)
+        try:
+            self.writeMessage(c.MGMSG_MOT_MOVE_ABSOLUTE,0x06,destID=destAddress,dataPacket=dataPacket)
+        except:
+            self.router.cancel(waiter)
+            raise
+        return waiter
 
     def MoveAbsoluteEx(self,channel=0,positionCh1=0.0,positionCh2=0,wait=True):
         """ Wrapper for MoveAbsoluteEx """
-        self.MoveAbsoluteEnc(channel,positionCh1,positionCh2,wait=wait)
+        return self.MoveAbsoluteEnc(channel,positionCh1,positionCh2,wait=wait)
 
     def GetStageAxisInfo(self,channel=0):
         """ Get the stage axis info... doesn't seem to be working right now """
@@ -102,22 +287,61 @@ class _AptMotor(AptDevice):
         self.writeMessage(c.MGMSG_MOT_MOVE_STOP,channelID,destID=destAddress)
         pass
 
+    @property
+    def scaling(self):
+        """ The aptconsts.ScalingFactors of this controller and stage type. They are resolved once, and again only if either type is changed """
+        key=(self.controllerType,self.stageType)
+        if self._scalingKey!=key:
+            self._scaling=c.motorScaling(*key)
+            self._scalingKey=key
+        return self._scaling
+
     def _positionToEnc(self,position):
         """ convert between position in mm (or angle in degrees where applicable) and appropriate encoder units"""
-        return round(position*c.getMotorScalingFactors(self.controllerType,self.stageType)["position"])
+        return round(position*self.scaling.position)
 
     def _encToPosition(self,enc):
         """ convert between position in mm (or angle in degrees where applicable) and appropriate encoder units"""
-        return enc/c.getMotorScalingFactors(self.controllerType,self.stageType)["position"]
+        return enc/self.scaling.position
     
     def _velocityToEnc(self,velocity):
         """ convert between velocity in mm/s (angular in degrees/s where applicable) and appropriate encoder units"""
-        return round(velocity*c.getMotorScalingFactors(self.controllerType,self.stageType)["velocity"])
+        return round(velocity*self.scaling.velocity)
     
     def _accelerationToEnc(self,acceleration):
         """ convert between acceleration in mm/s/s (angular in degrees/s/s where applicable) and appropriate encoder units"""
-        return round(acceleration*c.getMotorScalingFactors(self.controllerType,self.stageType)["acceleration"])
+        return round(acceleration*self.scaling.acceleration)
+
+    def positionsToEnc(self,positions):
+        """ Vectorised _positionToEnc: convert an array of positions into a NumPy array of encoder counts (requires numpy) """
+        return self._toEnc(positions,self.scaling.position)
+
+    def encToPositions(self,counts):
+        """ Vectorised _encToPosition: convert an array of encoder counts into a NumPy array of positions (requires numpy) """
+        return self._fromEnc(counts,self.scaling.position)
 
+    def velocitiesToEnc(self,velocities):
+        """ Vectorised _velocityToEnc (requires numpy) """
+        return self._toEnc(velocities,self.scaling.velocity)
+
+    def encToVelocities(self,counts):
+        """ Convert an array of velocities in encoder units into real units (requires numpy) """
+        return self._fromEnc(counts,self.scaling.velocity)
+
+    def accelerationsToEnc(self,accelerations):
+        """ Vectorised _accelerationToEnc (requires numpy) """
+        return self._toEnc(accelerations,self.scaling.acceleration)
+
+    def _toEnc(self,values,factor):
+        if np is None:
+            raise ImportError("numpy is required for the vectorised conversions")
+        # np.rint rounds halves to even like round()
+        return np.rint(np.asarray(values,dtype=np.float64)*factor).astype(np.int64)
+
+    def _fromEnc(self,counts,factor):
+        if np is None:
+            raise ImportError("numpy is required for the vectorised conversions")
+        return np.asarray(counts,dtype=np.float64)/factor
 
 
 class AptMotor(_AptMotor):
@@ -129,10 +353,123 @@ class AptMotor(_AptMotor):
         # Mapping dictionary between class names and the description string given by the device
         return ['APT DC Motor Controller']
     
+    def close(self):
+        self.stopStatusUpdates()
+        return super(AptMotor,self).close()
+
     def setPosition(self,position,channel=0):
         self.MoveAbsoluteEnc(channel,position)
-    def getPosition(self, channel = 0):
+    def getPosition(self, channel = 0, maxAge=c.STATUS_MAX_AGE):
+        """ Get the position. While status updates are streaming (see startStatusUpdates) the streamed position is returned without
+        any USB traffic if it is at most maxAge s old, otherwise the controller is queried """
+        status=self.status.get(channel)
+        if status is not None and self.streaming and time.monotonic()-status.timestamp<=maxAge:
+            return status.position
         return self.GetPosition(channel)
+
+    def getCachedPosition(self,channel=0):
+        """ Return (position,age) of the latest streamed position of the channel, age being in s, without any USB traffic.
+        Raises KeyError if no status has been received for the channel yet """
+        status=self.status[channel]
+        return status.position,time.monotonic()-status.timestamp
+
+    def startStatusUpdates(self,keepaliveInterval=c.STATUS_KEEPALIVE_INTERVAL):
+        """ Ask the controller to push MGMSG_MOT_GET_DCSTATUSUPDATE messages, and keep self.status (channel -> MotorStatus) up to date
+        from them and from the move completed/stopped messages. The reader thread is started if needed, and a keepalive thread sends
+        MGMSG_MOT_ACK_DCSTATUSUPDATE every keepaliveInterval s so that the controller keeps sending """
+        self._startUpdates((c.MGMSG_MOT_GET_DCSTATUSUPDATE,c.MGMSG_MOT_GET_STATUSUPDATE,c.MGMSG_MOT_MOVE_COMPLETED,c.MGMSG_MOT_MOVE_STOPPED),
+                           self._updateStatus,c.MGMSG_MOT_ACK_DCSTATUSUPDATE,keepaliveInterval)
+
+    def stopStatusUpdates(self):
+        """ Stop the status updates started by startStatusUpdates. The last received values stay in self.status """
+        self._stopUpdates()
+
+    def _updateStatus(self,message):
+        """ Router listener caching the state carried by status update and move completed/stopped messages (all start with
+        channel, position and end with the status bits). Only MGMSG_MOT_GET_DCSTATUSUPDATE carries the velocity (the third field of the
+        others is the encoder count), so the last one received is kept, or None before the first one """
+        dataPacket=message[-1]
+        channel=self._statusChannel(message)
+        if channel is not None:
+            if message[0]==c.MGMSG_MOT_GET_DCSTATUSUPDATE:
+                velocity=dataPacket[2]
+            else:
+                previous=self.status.get(channel)
+                velocity=previous.velocity if previous is not None else None
+            self.status[channel]=MotorStatus(self._encToPosition(dataPacket[1]),velocity,dataPacket[-1],time.monotonic())
     def zero(self,channel=0):
         self.MoveHome(channel)
- 
+
+    def moveBy(self,distance,channel=0,wait=True):
+        """ Move by distance relative to the current position in a single message. With wait=False return a MoveHandle """
+        return self.MoveRelativeEnc(channel,distance,wait=wait)
+
+    def moveAtVelocity(self,velocity,channel=0,acceleration=None):
+        """ Start a continuous move at velocity (signed, in mm/s) for fly-scans, ramping up with acceleration (the current acceleration of
+        the channel if None). Returns a MoveHandle: cancel() it (or call stop) to end the move. The velocity profile of the channel is set
+        for the move and restored once it ends, before the handle is resolved """
+        channelID,destAddress=self.channelAddresses[channel]
+        previous=self.GetVelParams(channel)
+        if acceleration is None:
+            acceleration=previous[1]
+        def restore():
+            self.SetVelParams(channel,*previous)
+            self.flush()
+        with self.batch():
+            self.SetVelParams(channel,0.0,acceleration,abs(velocity))
+            return self._startMove(channel,c.MGMSG_MOT_MOVE_STOPPED,c.MGMSG_MOT_MOVE_VELOCITY,channelID,
+                                   c.MOTOR_JOG_FORWARD if velocity>=0 else c.MOTOR_JOG_REVERSE,destID=destAddress,onFinish=restore)
+
+    def stop(self,channel=0):
+        """ Stop the channel (see LLMoveStop) """
+        self.LLMoveStop(channel)
+        self.flush()
+
+    def scan(self,positions,measure=None,channel=0,settle=0.0,waitTime=c.QUERY_TIMEOUT):
+        """ Step through positions, calling measure(index,position) at each one after waiting settle s, and return an aptscan.ScanResult
+        of NumPy arrays. The reported position of each point is taken from the move completed message, so each point costs a single
+        round trip. Each move must complete within waitTime ms (see aptscan.runScan for overlapping the measurements with the moves) """
+        def move(position):
+            waiter=self._startMoveAbsolute(channel,position)
+            response=self._awaitReply(waiter,time.monotonic()+waitTime/1000)
+            if response is None:
+                raise MessageReceiptError("Timeout waiting for messageID " + hex(c.MGMSG_MOT_MOVE_COMPLETED) + " after moving to " + str(position))
+            return self._encToPosition(response[-1][1])
+        return runScan(positions,move,measure,settle)
+
+
+def moveMany(targets,waitTime=c.QUERY_TIMEOUT):
+    """ Move several axes concurrently. targets maps a motor (channel 0) or a (motor,channel) tuple to an absolute position.
+    Every MGMSG_MOT_MOVE_ABSOLUTE is sent first, then all the MGMSG_MOT_MOVE_COMPLETED messages are collected against one shared deadline
+    of waitTime ms, so the total time is that of the slowest move rather than the sum. The reader thread of each motor runs for the call
+    (see _AptMotor._moveStarted) so that every completion is timed when it arrives, not when its motor's turn to be awaited comes.
+    Returns a dict mapping each key of targets to a MoveResult; failures are reported per axis rather than raised """
+    results={}
+    pending=[]
+    motors=[]
+    try:
+        for key,position in targets.items():
+            motor,channel=key if isinstance(key,tuple) else (key,0)
+            try:
+                if not any(motor is other for other in motors):
+                    motor._moveStarted()
+                    motors.append(motor)
+                t0=time.monotonic()
+                pending.append((key,motor,motor._startMoveAbsolute(channel,position),t0))
+            except Exception as e:
+                results[key]=MoveResult(None,0.0,e)
+        deadline=time.monotonic()+waitTime/1000
+        for key,motor,waiter,t0 in pending:
+            try:
+                response=motor._awaitReply(waiter,deadline)
+            except Exception as e:
+                results[key]=MoveResult(None,time.monotonic()-t0,e)
+                continue
+            if response is None:
+                results[key]=MoveResult(None,time.monotonic()-t0,MessageReceiptError("Timeout waiting for messageID " + hex(c.MGMSG_MOT_MOVE_COMPLETED) + " after moving " + repr(key)))
+            else:
+                results[key]=MoveResult(motor._encToPosition(response[-1][1]),waiter.received-t0,None)
+    finally:
+        for motor in motors:
+            motor._moveFinished()
+    return results
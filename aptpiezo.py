@@ -1,20 +1,147 @@
 from __future__ import absolute_import,print_function,division
-from .aptdevice import AptDevice
+from collections import namedtuple
+import threading
+import time
+try:
+    import numpy as np
+except ImportError:
+    np=None
+from .aptdevice import AptDevice,MessageReceiptError
 from . import aptconsts as c
+from .aptscan import runScan
+
+# Latest state of a channel from a MGMSG_PZ_GET_PZSTATUSUPDATE message: voltage (V), position (um), status bits and time.monotonic() receive time
+PiezoStatus=namedtuple('PiezoStatus',['voltage','position','statusBits','timestamp'])
+# Result of AptPiezo.setPosition: the settled position (um) and the time (s) from the command until the position came within tolerance
+SettleResult=namedtuple('SettleResult',['position','settleTime'])
+
+class SettleTimeoutError(MessageReceiptError):
+    """ The position didn't settle at the target in time. position is the last position received (None if there was none) """
+    def __init__(self,channel,target,position):
+        super(SettleTimeoutError,self).__init__("Timeout error moving to "+str(target)+"um on channel "+str(channel)+", last position "+str(position)+"um")
+        self.channel=channel
+        self.target=target
+        self.position=position
+
+class ZeroTimeoutError(MessageReceiptError):
+    """ Zeroing didn't finish in time. channels are the channels still zeroing, durations those of the channels which finished """
+    def __init__(self,channels,durations):
+        super(ZeroTimeoutError,self).__init__("Timeout error zeroing channels "+", ".join(str(channel) for channel in channels))
+        self.channels=channels
+        self.durations=durations
+
+class _Settle(object):
+    """ Progress of a channel towards a target position, judged from the status updates received since the move was sent (see
+    AptPiezo.setPosition). Shared by the blocking and the asyncio setPosition, which wait for the status updates in their own way """
+    def __init__(self,piezo,channel,position,tolerance,dwell,timeout):
+        self.piezo=piezo
+        self.channel=channel
+        self.position=position
+        self.tolerance=tolerance
+        self.dwell=dwell
+        self.t0=self.lastRequest=time.monotonic()
+        self.deadline=self.t0+timeout
+        self.settledSince=None
+
+    def check(self):
+        """ Look at the latest status of the channel. Returns (result,timeToWait,request): the SettleResult once settled (otherwise None),
+        how long to wait for the next status update, and whether one should be requested first. Raises SettleTimeoutError on timeout """
+        now=time.monotonic()
+        status=self.piezo.status.get(self.channel)
+        # Only updates received after the command count
+        if status is not None and status.timestamp<self.t0:
+            status=None
+        if status is not None and abs(self.position-status.position)<=self.tolerance:
+            if self.settledSince is None:
+                self.settledSince=status.timestamp
+            if now-self.settledSince>=self.dwell:
+                return SettleResult(status.position,self.settledSince-self.t0),0,False
+        else:
+            self.settledSince=None
+        if now>=self.deadline:
+            raise SettleTimeoutError(self.channel,self.position,status.position if status is not None else None)
+        request=now-max(self.lastRequest,status.timestamp if status is not None else self.t0)>=c.PIEZO_SETTLE_POLL
+        if request:
+            self.lastRequest=now
+        timeToWait=min(self.deadline-now,c.PIEZO_SETTLE_POLL)
+        if self.settledSince is not None:
+            timeToWait=min(timeToWait,self.settledSince+self.dwell-now)
+        return None,timeToWait,request
+
+class _Zeroing(object):
+    """ Progress of zeroing channels (see AptPiezo.zeroAll). A status update pushed before the controller handled the zero command can
+    still arrive after it was sent, so a clear zeroing bit only counts once the bit has been seen set, or once the reply to a
+    MGMSG_PZ_REQ_PZSTATUSBITS sent right after the command has arrived (replies come back in order). Shared by the blocking and the
+    asyncio zeroAll, which wait for the status updates in their own way """
+    def __init__(self,piezo,channels,timeout):
+        self.piezo=piezo
+        self.channels=channels
+        self.t0=self.lastRequest=time.monotonic()
+        self.deadline=self.t0+timeout
+        # channel -> time.monotonic() time from which a clear zeroing bit means the channel has finished, and the time it finished
+        self.started={}
+        self.finished={}
+
+    def statusBits(self,channel,message,received):
+        """ Take in the reply to the MGMSG_PZ_REQ_PZSTATUSBITS request of channel received at time received (None if the reader died) """
+        if message is not None and channel not in self.started:
+            self.started[channel]=received
+            if not message[-1][1]&c.PIEZO_STATUS_ZEROING:
+                self.finished.setdefault(channel,received)
+
+    def check(self):
+        """ Look at the latest status of each channel. Returns (durations,timeToWait,request): the dict of channel -> time (s) taken to
+        zero once all have finished (otherwise None), how long to wait for the next status update, and the channels to request one for
+        first. Raises ZeroTimeoutError on timeout """
+        now=time.monotonic()
+        pending=[]
+        lastUpdate=now
+        for channel in self.channels:
+            if channel in self.finished:
+                continue
+            status=self.piezo.status.get(channel)
+            # Only updates received after the command count
+            if status is not None and status.timestamp>=self.t0:
+                if status.statusBits&c.PIEZO_STATUS_ZEROING:
+                    self.started.setdefault(channel,status.timestamp)
+                elif channel in self.started and status.timestamp>=self.started[channel]:
+                    self.finished[channel]=status.timestamp
+                    continue
+                lastUpdate=min(lastUpdate,status.timestamp)
+            else:
+                lastUpdate=self.t0
+            pending.append(channel)
+        durations=dict((channel,finished-self.t0) for channel,finished in self.finished.items())
+        if not pending:
+            return durations,0,()
+        if now>=self.deadline:
+            raise ZeroTimeoutError(pending,durations)
+        if now-max(self.lastRequest,lastUpdate)>=c.PIEZO_ZERO_POLL:
+            self.lastRequest=now
+        else:
+            pending=()
+        return None,min(self.deadline-now,c.PIEZO_ZERO_POLL),pending
+
+def _lutInteger(name,value):
+    """ Return a LUT parameter as an int, raising ValueError for values which aren't whole numbers rather than truncating them """
+    if int(value)!=value:
+        raise ValueError(name + " must be a whole number, not " + repr(value))
+    return int(value)
 
 class _AptPiezo(AptDevice):
     """ Wrapper around the messages of the APT protocol specified for piezo controller. The method names (and case) are set the same as in the Thor Labs ActiveX control for compatibility
 
     !!!! TODO: These are no longer directly compatible with ActiveX control due to the mapping of channel onto destId via self.channelAddresses, therefore it makes more sense to use a cleaner syntax here without
     worrying about compatibility, and if needed make a AptPiezoWrapper(AptPiezo) class which gives versions with identical names. This will prevent cluttering of the namespace as well"""   
-    def __init__(self,hwser=None):
-        super(_AptPiezo, self).__init__(hwser)
+    def __init__(self,*args,**kwargs):
+        super(_AptPiezo, self).__init__(*args,**kwargs)
         self.maxVoltage=75.0                # for some unknown reason our device isn't responding to self.GetMaxOPVoltage()
         self.maxExtension=self.GetMaxTravel()
-        for ch in range(len(self.channelAddresses)):
-            self.SetControlMode(ch)
-            self.SetVoltOutput(ch)
-            self.initializeConstants(ch)
+        with self.batch():
+            for ch in range(len(self.channelAddresses)):
+                self.SetControlMode(ch)
+                self.SetVoltOutput(ch)
+                self.initializeConstants(ch)
             # If we wanna receive status update messages then we need to send MGMSG_HW_START_UPDATEMSGS
             # We would additionally need to send server alive messages every 1s, e.g. MGMSG_PZ_ACK_PZSTATUSUPDATE for Piezo
             # However if we don't need broadcasting of the position etc we can just fetch the status via GET_STATUTSUPDATES
@@ -110,6 +237,30 @@ class _AptPiezo(AptDevice):
         assert dataPacket[0]==channelID, "inconsistent channel in response message from piezocontroller"
         return dataPacket[1]
 
+    def SetOutputLUT(self,channel=0,index=0,output=0):
+        """ Set entry index of the output waveform look up table of the channel. output is the raw value: a fraction of the maximum voltage
+        (open loop) or of the maximum extension (closed loop) with c.PIEZO_MAX_VOLT_REPR/c.PIEZO_MAX_POS_REPR representing 100% """
+        channelID,destAddress=self.channelAddresses[channel]
+        self.writeMessage(c.MGMSG_PZ_SET_OUTPUTLUT,destID=destAddress,dataPacket=(channelID,index,output))
+
+    def SetOutputLUTParams(self,channel=0,mode=c.PIEZO_LUT_MODE_CONTINUOUS,cycleLength=1,numCycles=1,delayTime=c.PIEZO_LUT_MIN_INTERVAL,preCycleRest=0,postCycleRest=0,
+                           trigStart=0,trigWidth=0,trigRepeatCycle=0):
+        """ Set how the look up table is output: mode (continuous or fixed number of numCycles cycles), the number of LUT entries cycleLength
+        making up one cycle, the time in ms between entries delayTime, the rests in ms before and after each cycle, and the output trigger """
+        channelID,destAddress=self.channelAddresses[channel]
+        self.writeMessage(c.MGMSG_PZ_SET_OUTPUTLUTPARAMS,destID=destAddress,dataPacket=(channelID,mode,cycleLength,numCycles,delayTime,preCycleRest,postCycleRest,
+                                                                                       trigStart,trigWidth,trigRepeatCycle))
+
+    def StartLUTOutput(self,channel=0):
+        """ Start outputting the waveform in the look up table """
+        channelID,destAddress=self.channelAddresses[channel]
+        self.writeMessage(c.MGMSG_PZ_START_LUTOUTPUT,channelID,destID=destAddress)
+
+    def StopLUTOutput(self,channel=0):
+        """ Stop outputting the waveform in the look up table """
+        channelID,destAddress=self.channelAddresses[channel]
+        self.writeMessage(c.MGMSG_PZ_STOP_LUTOUTPUT,channelID,destID=destAddress)
+
     # Helper methods for the above main methods. Change to mixed case since no need for compatibility with ActiveX control
     def _voltageAsFraction(self,voltage):
         """ specify voltage as short representing fraction of max voltage"""
@@ -130,6 +281,10 @@ class _AptPiezo(AptDevice):
        
 class AptPiezo(_AptPiezo):
     """ This class contains higher level methods not provided in the Thor Labs ActiveX control, but are very useful nonetheless """
+    def __init__(self,*args,**kwargs):
+        # Notified by the status update listener whenever self.status changes
+        self._statusChanged=threading.Condition()
+        super(AptPiezo,self).__init__(*args,**kwargs)
 
     def deviceDescriptionStrings(self):
         """ Return a list of strings for which the device description is compatible with this class """
@@ -146,33 +301,161 @@ class AptPiezo(_AptPiezo):
         StatusBits=self.LLGetStatusBits(channel)
         return (StatusBits>>5) & 1
 
-    def setPosition(self,channel,position):
-        """ Move to specified position if valid, and wait for the measured position to stabilize """
-        if position>=0 and position <= self.maxExtension:
+    def setPosition(self,channel,position,tolerance=1.01*c.PIEZO_POSITION_ACCURACY,dwell=0.0,timeout=c.PIEZO_MOVE_TIMEOUT):
+        """ Move to position (closed loop mode) and wait until it has settled, i.e. the position pushed by the controller's status updates
+        has stayed within tolerance um of the target for dwell s. Status updates are started if needed, and one is requested whenever none
+        has arrived for c.PIEZO_SETTLE_POLL s. Returns a SettleResult, or raises SettleTimeoutError if not settled within timeout s """
+        self._checkTarget(position)
+        self.startStatusUpdates()
+        with self._statusChanged:
             self.SetPosOutput(channel,position)
-            t0=time.time()
-            while abs(position-self.GetPosOutput(channel))>1.01*c.PIEZO_POSITION_ACCURACY:
-                if (time.time()-t0)>c.PIEZO_MOVE_TIMEOUT:
-                    print("Timeout error moving to "+str(position)+ 'um on channel '+str(channel))
-                    break 
-                else:
-                    time.sleep(10e-3)
+            settle=_Settle(self,channel,position,tolerance,dwell,timeout)
+            while True:
+                result,timeToWait,request=settle.check()
+                if result is not None:
+                    return result
+                if request:
+                    self._requestStatus((channel,))
+                self._statusChanged.wait(timeToWait)
+
+    def _checkTarget(self,position):
+        """ Raise ValueError if position (um) is out of the travel range """
+        if not 0<=position<=self.maxExtension:
+            raise ValueError("position must be between 0 and " + str(self.maxExtension) + "um, not " + str(position))
+
+    def _requestStatus(self,channels):
+        """ Request a status update for each of channels. The replies reach self.status through the status update listener """
+        with self.batch():
+            for channel in channels:
+                channelID,destAddress=self.channelAddresses[channel]
+                self.writeMessage(c.MGMSG_PZ_REQ_PZSTATUSUPDATE,channelID,destID=destAddress)
+
+    def startStatusUpdates(self,keepaliveInterval=c.STATUS_KEEPALIVE_INTERVAL):
+        """ Ask the controller to push MGMSG_PZ_GET_PZSTATUSUPDATE messages and keep self.status (channel -> PiezoStatus) up to date from
+        them. The reader thread is started if needed, and a keepalive thread sends MGMSG_PZ_ACK_PZSTATUSUPDATE every keepaliveInterval s """
+        self._startUpdates((c.MGMSG_PZ_GET_PZSTATUSUPDATE,),self._updateStatus,c.MGMSG_PZ_ACK_PZSTATUSUPDATE,keepaliveInterval)
+
+    def stopStatusUpdates(self):
+        """ Stop the status updates started by startStatusUpdates. The last received values stay in self.status """
+        self._stopUpdates()
+
+    def _updateStatus(self,message):
+        """ Router listener caching the (channel,voltage,position,status bits) of the status update messages, and waking up setPosition """
+        dataPacket=message[-1]
+        channel=self._statusChannel(message)
+        if channel is not None:
+            with self._statusChanged:
+                self.status[channel]=PiezoStatus(self._fractionAsVoltage(dataPacket[1]),self._fractionAsPosition(dataPacket[2]),dataPacket[3],time.monotonic())
+                self._statusChanged.notify_all()
 
     def getPosition(self,channel):
         """ Get the position of the piezo. This is simply a wrapper for GetPosOutput using mixedCase """
         return self.GetPosOutput(channel)
 
     def zero(self,channel):
-        """ Call the zero method and wait for it to finish """       
-        self.ZeroPosition(channel)
-        t0=time.time()
-        while self.isZeroing(channel):
-            if (time.time()-t0)>c.PIEZO_ZERO_TIMEOUT:
-                print("Timeout error zeroing channel "+str(channel))
-                break 
-            else:
-                time.sleep(500e-3)
+        """ Call the zero method and wait for it to finish. Returns the time (s) it took """
+        return self.zeroAll((channel,))[channel]
+
+    def zeroAll(self,channels=None,timeout=c.PIEZO_ZERO_TIMEOUT):
+        """ Zero channels (all of them by default) at the same time and wait until the zeroing status bit of every one of them has cleared,
+        watching the pushed status updates and requesting them for the channels which have had none for c.PIEZO_ZERO_POLL s (see _Zeroing).
+        Returns a dict of channel -> time (s) taken to zero, or raises ZeroTimeoutError if they haven't all finished within timeout s """
+        channels=list(range(len(self.channelAddresses)) if channels is None else channels)
+        self.startStatusUpdates()
+        def statusBits(channel,message):
+            received=time.monotonic()
+            with self._statusChanged:
+                zeroing.statusBits(channel,message,received)
+                self._statusChanged.notify_all()
+        with self._statusChanged:
+            zeroing=_Zeroing(self,channels,timeout)
+            waiters=self._sendZero(channels,statusBits)
+            try:
+                while True:
+                    durations,timeToWait,request=zeroing.check()
+                    if durations is not None:
+                        return durations
+                    if request:
+                        self._requestStatus(request)
+                    self._statusChanged.wait(timeToWait)
+            finally:
+                for waiter in waiters:
+                    self.router.cancel(waiter)
+
+    def _sendZero(self,channels,statusBits):
+        """ Zero channels, each followed by a MGMSG_PZ_REQ_PZSTATUSBITS request whose reply is passed to statusBits(channel,message) by
+        the reader thread. Returns the router waiters of the replies """
+        waiters=[]
+        try:
+            with self.batch():
+                for channel in channels:
+                    channelID,destAddress=self.channelAddresses[channel]
+                    self.ZeroPosition(channel)
+                    waiters.append(self._replyWaiter(c.MGMSG_PZ_GET_PZSTATUSBITS,channelID,destAddress,
+                                                     callback=lambda message,channel=channel: statusBits(channel,message)))
+                    self.writeMessage(c.MGMSG_PZ_REQ_PZSTATUSBITS,channelID,destID=destAddress)
+        except:
+            for waiter in waiters:
+                self.router.cancel(waiter)
+            raise
+        return waiters
 
     def moveToCenter(self,channel):
         """ Moves the specified channel to half of its maximum extension"""
         self.setPosition(channel,self.maxExtension/2)
+
+    def uploadWaveform(self,waveform,channel=0,units="volts",interval=c.PIEZO_LUT_MIN_INTERVAL,cycles=None,preCycleRest=0,postCycleRest=0):
+        """ Convert a waveform (a NumPy array or sequence of samples in volts, or in microns for closed loop mode with units="microns") and
+        load it into the output look up table of the channel with a single bulk write, together with the LUT parameters: interval ms
+        between samples, and cycles repetitions of the waveform (None to repeat until stopWaveform). The LUT parameters must be whole
+        numbers, and ValueError is raised otherwise. Start the output with startWaveform.
+        Returns the raw LUT values which were uploaded """
+        if units=="volts":
+            fullScale,maxRepr=self.maxVoltage,c.PIEZO_MAX_VOLT_REPR
+        elif units=="microns":
+            fullScale,maxRepr=self.maxExtension,c.PIEZO_MAX_POS_REPR
+        else:
+            raise ValueError("units must be 'volts' or 'microns', not " + repr(units))
+        if np is not None:
+            samples=np.asarray(waveform,dtype=np.float64)
+            if samples.ndim!=1:
+                raise ValueError("waveform must be one dimensional")
+            outOfRange=np.any((samples<0)|(samples>fullScale))
+            values=np.rint(samples*(maxRepr/fullScale)).astype(np.int64).tolist()
+        else:
+            samples=[float(sample) for sample in waveform]
+            outOfRange=any(sample<0 or sample>fullScale for sample in samples)
+            values=[int(round(sample*maxRepr/fullScale)) for sample in samples]
+        if outOfRange:
+            raise ValueError("waveform exceeds the range 0-" + str(fullScale) + " " + units)
+        if not 0<len(values)<=c.PIEZO_LUT_MAX_SAMPLES:
+            raise ValueError("waveform must have between 1 and " + str(c.PIEZO_LUT_MAX_SAMPLES) + " samples")
+        if interval<c.PIEZO_LUT_MIN_INTERVAL:
+            raise ValueError("interval must be at least " + str(c.PIEZO_LUT_MIN_INTERVAL) + " ms")
+        interval,preCycleRest,postCycleRest=(_lutInteger(name,value) for name,value in
+                                             (("interval",interval),("preCycleRest",preCycleRest),("postCycleRest",postCycleRest)))
+        if cycles is None:
+            mode,cycles=c.PIEZO_LUT_MODE_CONTINUOUS,1
+        else:
+            mode,cycles=c.PIEZO_LUT_MODE_FIXED,_lutInteger("cycles",cycles)
+            if cycles<0:
+                raise ValueError("cycles must not be negative")
+        with self.batch():
+            for index,value in enumerate(values):
+                self.SetOutputLUT(channel,index,value)
+            self.SetOutputLUTParams(channel,mode,len(values),cycles,interval,preCycleRest,postCycleRest)
+        return values
+
+    def startWaveform(self,channel=0):
+        """ Start the output of the waveform loaded by uploadWaveform """
+        self.StartLUTOutput(channel)
+
+    def stopWaveform(self,channel=0):
+        """ Stop the output of the waveform """
+        self.StopLUTOutput(channel)
+
+    def scan(self,positions,measure=None,channel=0,settle=0.0):
+        """ Step through positions (closed loop mode), calling measure(index,position) at each one after waiting settle s, and return an
+        aptscan.ScanResult of NumPy arrays. Each point is reached when setPosition reports it has settled, which raises SettleTimeoutError
+        if it doesn't within the move timeout """
+        return runScan(positions,lambda position: self.setPosition(channel,position).position,measure,settle)
@@ -0,0 +1,146 @@
+""" Routing of received frames to the threads waiting for them.
+Callers register a waiter for the reply they expect before sending their request, and block on a condition variable until the reader
+thread hands them a matching frame (without the reader thread, the waiting thread reads and routes the frames itself). Frames which nobody is waiting for are passed to a callback or put on an event queue. """
+from __future__ import print_function,division
+import threading
+import time
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+# Maximum number of unsolicited frames kept in the event queue; the oldest are dropped when it is full
+MAX_EVENTS=1000
+
+def frameChannel(message):
+    """ Return the channel ID of a message tuple as returned by AptDevice.readMessage: param1 for header only messages,
+    otherwise the first value of the data packet (the Chan Ident word of most messages) """
+    dataPacket=message[-1]
+    if dataPacket is None:
+        return message[1]
+    return dataPacket[0] if dataPacket else None
+
+class Waiter(object):
+    """ A pending reply. sourceID and channel are None to match any value. If callback is set it is called with the
+    message by the reader thread when the reply arrives, or with None if the reader thread dies first. received is the
+    time.monotonic() time at which the reply was routed """
+    __slots__=('messageID','sourceID','channel','callback','response','received')
+    def __init__(self,messageID,sourceID=None,channel=None,callback=None):
+        self.messageID=messageID
+        self.sourceID=sourceID
+        self.channel=channel
+        self.callback=callback
+        self.response=None
+        self.received=None
+
+    def matches(self,message):
+        return (self.sourceID is None or self.sourceID==message[4]) and (self.channel is None or self.channel==frameChannel(message))
+
+class FrameRouter(object):
+    """ Demultiplex received frames onto the waiters keyed by (messageID,sourceID,channel).
+    Listeners registered for a messageID see every frame with that ID (e.g. to cache pushed status updates). Frames matching neither a waiter
+    nor a listener are given to callback(message) if set, otherwise they are put on the events queue """
+    def __init__(self,callback=None,maxEvents=MAX_EVENTS):
+        self.condition=threading.Condition()
+        self.callback=callback
+        self.events=queue.Queue(maxEvents)
+        self.error=None
+        self._waiters={}
+        self._listeners={}
+
+    def register(self,messageID,sourceID=None,channel=None,callback=None):
+        """ Register interest in a frame. This must be done before the request is sent so that a fast reply can't be missed """
+        waiter=Waiter(messageID,sourceID,channel,callback)
+        with self.condition:
+            self._waiters.setdefault(messageID,[]).append(waiter)
+        return waiter
+
+    def cancel(self,waiter):
+        """ Forget a waiter which is no longer interested in its reply """
+        with self.condition:
+            waiters=self._waiters.get(waiter.messageID)
+            if waiters and waiter in waiters:
+                waiters.remove(waiter)
+
+    def addListener(self,messageID,listener):
+        """ Call listener(message) from the reader thread for every frame with messageID """
+        with self.condition:
+            self._listeners[messageID]=self._listeners.get(messageID,())+(listener,)
+
+    def removeListener(self,messageID,listener):
+        with self.condition:
+            listeners=tuple(l for l in self._listeners.get(messageID,()) if l!=listener)
+            if listeners:
+                self._listeners[messageID]=listeners
+            else:
+                self._listeners.pop(messageID,None)
+
+    def dispatch(self,message):
+        """ Hand a received frame to the listeners for its messageID and to the oldest matching waiter, or to the unsolicited frame
+        handling if there is neither """
+        with self.condition:
+            listeners=self._listeners.get(message[0],())
+            waiter=None
+            waiters=self._waiters.get(message[0])
+            if waiters:
+                for candidate in waiters:
+                    if candidate.matches(message):
+                        waiters.remove(candidate)
+                        candidate.received=time.monotonic()
+                        candidate.response=message
+                        self.condition.notify_all()
+                        waiter=candidate
+                        break
+        for listener in listeners:
+            try:
+                listener(message)
+            except Exception as e:
+                print("Error in message listener: " + repr(e))
+        if waiter is None:
+            if not listeners:
+                self._unsolicited(message)
+        elif waiter.callback is not None:
+            self._callWaiter(waiter,message)
+
+    def _callWaiter(self,waiter,message):
+        try:
+            waiter.callback(message)
+        except Exception as e:
+            print("Error in reply callback: " + repr(e))
+
+    def _unsolicited(self,message):
+        if self.callback is not None:
+            try:
+                self.callback(message)
+            except Exception as e:
+                print("Error in unsolicited message callback: " + repr(e))
+            return
+        while True:
+            try:
+                self.events.put_nowait(message)
+                return
+            except queue.Full:
+                try:
+                    self.events.get_nowait()
+                except queue.Empty:
+                    pass
+
+    def wait(self,waiter,timeout=None):
+        """ Block until the waiter receives its frame and return it. Returns None on timeout, in which case the waiter is cancelled.
+        Raises the reader's error if the reader thread has died """
+        with self.condition:
+            self.condition.wait_for(lambda: waiter.response is not None or self.error is not None,timeout)
+            if waiter.response is None:
+                self.cancel(waiter)
+                if self.error is not None:
+                    raise self.error
+            return waiter.response
+
+    def fail(self,error):
+        """ Called by the reader thread when it stops on an error, to wake up everyone waiting """
+        with self.condition:
+            self.error=error
+            self.condition.notify_all()
+            pending=[waiter for waiters in self._waiters.values() for waiter in waiters if waiter.callback is not None]
+        for waiter in pending:
+            self._callWaiter(waiter,None)
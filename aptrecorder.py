@@ -0,0 +1,215 @@
+""" Telemetry recorder for the position/status of motors and piezos.
+Samples are appended to preallocated NumPy column arrays used as a ring buffer, so recording does no allocation per sample and its memory
+use is fixed however long it runs. If a directory is given, every full chunk of the ring buffer is also copied into one of a fixed pool of
+chunk buffers and written out as a .npy file by a background thread, and loadTelemetry() maps the chunks back from disk for analysis
+without reading them into memory. Requires numpy. """
+from __future__ import print_function,division
+import os
+import threading
+import time
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+import numpy as np
+from . import aptconsts as c
+from .aptpiezo import _AptPiezo
+
+# Columns of a telemetry record: the time.monotonic() receive time, the channel index, the position in real units, the raw velocity word
+# (NaN for piezos and for the motor messages other than MGMSG_MOT_GET_DCSTATUSUPDATE) and the status bits
+RECORD_DTYPE=np.dtype([("timestamp","f8"),("channel","u1"),("position","f8"),("velocity","f8"),("status","u4")])
+CHUNK_PREFIX="telemetry-"
+
+# Messages carrying (channel,position,...,status) for motors, and (channel,voltage,position,status) for piezos
+MOTOR_STATUS_MESSAGES=(c.MGMSG_MOT_GET_DCSTATUSUPDATE,c.MGMSG_MOT_GET_STATUSUPDATE,c.MGMSG_MOT_MOVE_COMPLETED,c.MGMSG_MOT_MOVE_STOPPED)
+PIEZO_STATUS_MESSAGES=(c.MGMSG_PZ_GET_PZSTATUSUPDATE,)
+
+class TelemetryRecorder(object):
+    """ Record the status stream of an AptMotor (or AptPiezo) into a ring buffer of capacity samples.
+    By default the samples come from the status update messages pushed by the controller, which are started if the device supports it.
+    If pollInterval (s) is given the position of each channel is instead read with getPosition every pollInterval.
+    If path is given it is a directory where each chunk of chunkSize samples is saved as it fills up; chunkSize must divide capacity.
+    Chunks wait to be written in a pool of numChunks buffers; if the disk is so slow that none is free the chunk is dropped and counted in
+    droppedChunks rather than using more memory. Status updates started by start() are stopped by stop() """
+    def __init__(self,device,capacity=1<<16,path=None,chunkSize=1<<12,pollInterval=None,numChunks=4):
+        if capacity%chunkSize:
+            raise ValueError("chunkSize must divide capacity")
+        self.device=device
+        self.capacity=capacity
+        self.chunkSize=chunkSize
+        self.path=path
+        self.pollInterval=pollInterval
+        self.buffer=np.zeros(capacity,RECORD_DTYPE)
+        # Column views, so that a sample is stored with scalar assignments only
+        self._timestamp=self.buffer["timestamp"]
+        self._channel=self.buffer["channel"]
+        self._position=self.buffer["position"]
+        self._velocity=self.buffer["velocity"]
+        self._status=self.buffer["status"]
+        self.count=0
+        # Number of polls which failed, and of chunks which couldn't be saved for lack of a free chunk buffer
+        self.dropped=0
+        self.droppedChunks=0
+        self.numChunks=numChunks
+        self._lock=threading.Lock()
+        self._running=False
+        self._startedUpdates=False
+        self._chunks=None
+        self._freeChunks=None
+        self._writer=None
+        self._poller=None
+        self._channels=dict(((destAddress,channelID),channel) for channel,(channelID,destAddress) in enumerate(device.channelAddresses))
+
+    def start(self):
+        """ Start recording """
+        if self._running:
+            return
+        self._running=True
+        if self.path is not None:
+            if not os.path.isdir(self.path):
+                os.makedirs(self.path)
+            self._chunkIndex=len([name for name in os.listdir(self.path) if name.startswith(CHUNK_PREFIX)])
+            self._freeChunks=queue.Queue()
+            for _ in range(self.numChunks):
+                self._freeChunks.put(np.zeros(self.chunkSize,RECORD_DTYPE))
+            self._chunks=queue.Queue()
+            self._writer=threading.Thread(target=self._writeChunks,name="TelemetryRecorder writer")
+            self._writer.daemon=True
+            self._writer.start()
+        if self.pollInterval is not None:
+            self._pollStop=threading.Event()
+            self._poller=threading.Thread(target=self._poll,name="TelemetryRecorder poller")
+            self._poller.daemon=True
+            self._poller.start()
+            return
+        if not hasattr(self.device,"startStatusUpdates"):
+            raise ValueError(type(self.device).__name__ + " doesn't stream status updates; give a pollInterval")
+        for messageID in self._messages():
+            self.device.router.addListener(messageID,self._onMessage)
+        self._startedUpdates=not self.device.streaming
+        self.device.startStatusUpdates()
+
+    def stop(self):
+        """ Stop recording, and write out the samples of the last partial chunk if saving to disk """
+        if not self._running:
+            return
+        self._running=False
+        if self._poller is not None:
+            self._pollStop.set()
+            self._poller.join()
+            self._poller=None
+        else:
+            for messageID in self._messages():
+                self.device.router.removeListener(messageID,self._onMessage)
+            if self._startedUpdates:
+                self._startedUpdates=False
+                self.device.stopStatusUpdates()
+        if self._writer is not None:
+            with self._lock:
+                start=(self.count//self.chunkSize)*self.chunkSize
+                if self.count>start:
+                    # Not on the hot path: wait for a chunk buffer to be free rather than dropping the last samples
+                    self._saveChunk(start,self.count,self._freeChunks.get())
+            self._chunks.put(None)
+            self._writer.join()
+            self._writer=None
+            self._chunks=None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self,*exc):
+        self.stop()
+
+    def _messages(self):
+        return PIEZO_STATUS_MESSAGES if isinstance(self.device,_AptPiezo) else MOTOR_STATUS_MESSAGES
+
+    def append(self,timestamp,channel,position,velocity,status):
+        """ Store one sample, overwriting the oldest one when the ring buffer is full """
+        with self._lock:
+            i=self.count%self.capacity
+            self._timestamp[i]=timestamp
+            self._channel[i]=channel
+            self._position[i]=position
+            self._velocity[i]=velocity
+            self._status[i]=status
+            self.count+=1
+            if self._chunks is not None and not self.count%self.chunkSize:
+                # Copy the chunk out before the ring buffer wraps around onto it
+                try:
+                    chunk=self._freeChunks.get_nowait()
+                except queue.Empty:
+                    self.droppedChunks+=1
+                else:
+                    self._saveChunk(self.count-self.chunkSize,self.count,chunk)
+
+    def _saveChunk(self,start,end,chunk):
+        """ Copy the samples with sequence numbers start..end-1 into the chunk buffer and queue it for the writer thread. Chunks start on a
+        multiple of chunkSize, which divides the capacity, so they never wrap around the end of the ring buffer """
+        i=start%self.capacity
+        chunk[:end-start]=self.buffer[i:i+end-start]
+        self._chunks.put((chunk,end-start))
+
+    def _onMessage(self,message):
+        """ Router listener for the status messages """
+        dataPacket=message[-1]
+        channel=self._channels.get((message[4],dataPacket[0]))
+        if channel is None:
+            return
+        if message[0]==c.MGMSG_PZ_GET_PZSTATUSUPDATE:
+            self.append(time.monotonic(),channel,self.device._fractionAsPosition(dataPacket[2]),np.nan,dataPacket[3])
+        else:
+            # The third field of the other motor messages is the encoder count
+            velocity=dataPacket[2] if message[0]==c.MGMSG_MOT_GET_DCSTATUSUPDATE else np.nan
+            self.append(time.monotonic(),channel,self.device._encToPosition(dataPacket[1]),velocity,dataPacket[-1])
+
+    def _poll(self):
+        """ Body of the polling thread """
+        numChannels=len(self.device.channelAddresses)
+        nextPoll=time.monotonic()
+        while not self._pollStop.is_set():
+            for channel in range(numChannels):
+                try:
+                    position=self.device.getPosition(channel)
+                except Exception:
+                    self.dropped+=1
+                    continue
+                self.append(time.monotonic(),channel,position,np.nan,0)
+            nextPoll+=self.pollInterval
+            self._pollStop.wait(max(0.0,nextPoll-time.monotonic()))
+
+    def _ring(self,start,end):
+        """ Copy of the samples with sequence numbers start..end-1, which must still be in the ring buffer """
+        if end==start:
+            return self.buffer[:0].copy()
+        i,j=start%self.capacity,end%self.capacity
+        if i<j:
+            return self.buffer[i:j].copy()
+        return np.concatenate((self.buffer[i:],self.buffer[:j]))
+
+    def _writeChunks(self):
+        """ Body of the writer thread """
+        while True:
+            item=self._chunks.get()
+            if item is None:
+                return
+            chunk,length=item
+            np.save(os.path.join(self.path,"%s%06d.npy"%(CHUNK_PREFIX,self._chunkIndex)),chunk[:length])
+            self._chunkIndex+=1
+            self._freeChunks.put(chunk)
+
+    def snapshot(self,channel=None):
+        """ Return a copy of the samples still in the ring buffer in time order, optionally only those of one channel """
+        with self._lock:
+            records=self._ring(max(0,self.count-self.capacity),self.count)
+        if channel is not None:
+            records=records[records["channel"]==channel]
+        return records
+
+def loadTelemetry(path,mmap=True):
+    """ Return the chunks saved by a TelemetryRecorder in the directory path as a list of record arrays in time order. They are memory
+    mapped read only unless mmap is False, so a recording larger than memory can be processed chunk by chunk; np.concatenate() them
+    for a single array if it fits """
+    names=sorted(name for name in os.listdir(path) if name.startswith(CHUNK_PREFIX) and name.endswith(".npy"))
+    return [np.load(os.path.join(path,name),mmap_mode="r" if mmap else None) for name in names]
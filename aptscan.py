@@ -0,0 +1,39 @@
+""" Step-and-measure scans: move to each of a list of positions, optionally wait, call a measurement function and record where the stage
+actually was. Used by AptMotor.scan and AptPiezo.scan. Requires numpy. """
+from __future__ import print_function,division
+from collections import namedtuple
+import time
+try:
+    import numpy as np
+except ImportError:
+    np=None
+
+# Result of a scan, one entry per point: the commanded and reported positions, the time.monotonic() time of the measurement, the time
+# taken by the move (s) and the values returned by the measurement function (None if there was none)
+ScanResult=namedtuple('ScanResult',['commanded','reported','timestamps','durations','values'])
+
+def runScan(positions,move,measure=None,settle=0.0):
+    """ Run a scan over positions. move(position) moves there, waits for the move to finish and returns the reported position.
+    measure(index,position) is called once each point is reached and settle s have elapsed. If it returns a concurrent.futures.Future
+    (e.g. from submitting the processing of the acquired data to an executor) the scan carries on with the next move straight away and
+    the future's result is collected at the end """
+    if np is None:
+        raise ImportError("numpy is required for scans")
+    commanded=np.asarray(positions,dtype=np.float64)
+    numPoints=len(commanded)
+    reported=np.full(numPoints,np.nan)
+    timestamps=np.full(numPoints,np.nan)
+    durations=np.full(numPoints,np.nan)
+    values=[None]*numPoints if measure is not None else None
+    for i in range(numPoints):
+        t0=time.monotonic()
+        reported[i]=move(commanded[i])
+        durations[i]=time.monotonic()-t0
+        if settle:
+            time.sleep(settle)
+        timestamps[i]=time.monotonic()
+        if measure is not None:
+            values[i]=measure(i,reported[i])
+    if values is not None:
+        values=[value.result() if hasattr(value,"result") and hasattr(value,"done") else value for value in values]
+    return ScanResult(commanded,reported,timestamps,durations,values)
@@ -0,0 +1,93 @@
+""" Transport over the /dev/ttyUSB* serial device created by the Linux ftdi_sio driver (see apttransport), for systems where libftdi
+can't claim the controllers. The port is driven with termios directly: raw, 115200 baud 8N1 with RTS/CTS flow control and non blocking
+reads, as the APT protocol requires """
+from __future__ import print_function,division
+import errno
+import fcntl
+import glob
+import os
+import struct
+import termios
+
+SYSFS_TTY="/sys/class/tty"
+
+def _usbAttribute(tty,name):
+    """ Return the attribute of the USB device behind the tty (e.g. "ttyUSB0"), or None """
+    path=os.path.realpath(os.path.join(SYSFS_TTY,tty,"device"))
+    # device is the USB interface; the serial number, product and manufacturer belong to its parent USB device
+    for directory in (path,os.path.dirname(path),os.path.dirname(os.path.dirname(path))):
+        try:
+            with open(os.path.join(directory,name)) as f:
+                return f.read().strip()
+        except (IOError,OSError):
+            pass
+    return None
+
+def _ttys():
+    return sorted(os.path.basename(path) for path in glob.glob(os.path.join(SYSFS_TTY,"ttyUSB*")))
+
+class SerialTransport(object):
+    """ The controller with the given USB serial number opened through its /dev/ttyUSB* device (or the device path given as serial) """
+    def __init__(self,serial):
+        self.device_id=str(serial)
+        self.port=self.findPort(self.device_id)
+        self.closed=True
+        self.fd=os.open(self.port,os.O_RDWR|os.O_NOCTTY|os.O_NONBLOCK)
+        self.closed=False
+        self._tty=os.path.basename(self.port)
+
+    @staticmethod
+    def findPort(serial):
+        """ Return the path of the tty device of the controller with the USB serial number """
+        if serial.startswith("/dev/"):
+            return serial
+        for tty in _ttys():
+            if _usbAttribute(tty,"serial")==serial:
+                return os.path.join("/dev",tty)
+        raise IOError(errno.ENODEV,"No ttyUSB device with serial number " + serial)
+
+    @staticmethod
+    def listDevices():
+        return [(_usbAttribute(tty,"manufacturer") or "",_usbAttribute(tty,"product") or "",_usbAttribute(tty,"serial") or "") for tty in _ttys()]
+
+    def configure(self):
+        """ Set the port to raw 115200 baud 8N1 with RTS/CTS flow control and raise RTS """
+        iflag,oflag,cflag,lflag,ispeed,ospeed,cc=termios.tcgetattr(self.fd)
+        iflag=0
+        oflag=0
+        lflag=0
+        cflag=termios.CS8|termios.CREAD|termios.CLOCAL|termios.CRTSCTS
+        cc[termios.VMIN]=0
+        cc[termios.VTIME]=0
+        termios.tcsetattr(self.fd,termios.TCSANOW,[iflag,oflag,cflag,lflag,termios.B115200,termios.B115200,cc])
+        fcntl.ioctl(self.fd,termios.TIOCMBIS,struct.pack("I",termios.TIOCM_RTS))
+        # The driver's default 16 ms latency timer delays every short reply; 1 ms matches libftdi's use. Needs write access to sysfs
+        try:
+            with open(os.path.join(SYSFS_TTY,self._tty,"device","latency_timer"),"w") as f:
+                f.write("1")
+        except (IOError,OSError):
+            pass
+
+    def read(self,length):
+        try:
+            return os.read(self.fd,length)
+        except OSError as e:
+            if e.errno in (errno.EAGAIN,errno.EWOULDBLOCK):
+                return b""
+            raise
+
+    def write(self,data):
+        try:
+            return os.write(self.fd,data)
+        except OSError as e:
+            if e.errno in (errno.EAGAIN,errno.EWOULDBLOCK):
+                return 0
+            raise
+
+    def flush(self,flags=None):
+        termios.tcflush(self.fd,termios.TCIOFLUSH)
+
+    def close(self):
+        if not self.closed:
+            os.close(self.fd)
+            self.closed=True
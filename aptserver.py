@@ -0,0 +1,457 @@
+""" Device server sharing APT controllers between processes.
+Only one process can open an FTDI device, so DeviceServer owns the devices and executes commands for any number of clients connected
+over a Unix socket (or TCP). The protocol is binary with fixed size requests:
+
+    request: sequence number (uint32), opcode (uint8), flags (uint8), axis index (uint16), value (float64)
+    reply:   sequence number (uint32), status (uint8, 0 for success), value (float64), payload length (uint16), payload (utf-8)
+
+where an axis is one channel of one device, numbered in the order of DeviceServer.axes. The payload holds the error message of a failed
+request, or the JSON list of axes for OP_LIST.
+The server also publishes the latest streamed position and status bits of every axis in a shared memory block (see SharedState), so other
+processes can read them with no round trip to the server and no USB traffic. Run a server for a fleet file (see aptmanager) with
+
+    python -m aptlib.aptserver fleet.json """
+from __future__ import print_function,division
+import argparse
+import json
+import os
+import socket
+import struct
+import sys
+import threading
+try:
+    import socketserver
+except ImportError:
+    import SocketServer as socketserver
+try:
+    from multiprocessing import shared_memory
+except ImportError:
+    shared_memory=None
+from collections import namedtuple
+from . import aptconsts as c
+from .aptmotor import _AptMotor
+from .aptpiezo import _AptPiezo
+
+REQUEST=struct.Struct("<IBBHd")
+REPLY=struct.Struct("<IBdH")
+OP_LIST=0
+OP_GET_POSITION=1
+OP_MOVE_TO=2
+OP_MOVE_BY=3
+OP_HOME=4
+OP_STOP=5
+# Request flag: return once the command is sent instead of when the move has finished (motors only)
+FLAG_NO_WAIT=0x01
+STATUS_OK=0
+STATUS_ERROR=1
+
+# Shared memory layout: a header (magic, layout version, number of axes, length of the JSON list of axes, process ID of the server), the JSON
+# list of axes, and one record per axis aligned on 8 bytes. A record is a seqlock sequence number (odd while being written), the status bits, the position and
+# the time.monotonic() time it was received by the server
+SHARED_HEADER=struct.Struct("<4sHHII")
+SHARED_RECORD=struct.Struct("<IIdd")
+SHARED_MAGIC=b"APTS"
+SHARED_VERSION=1
+
+class DeviceServerError(Exception): pass
+
+# One axis of the server: device name, channel and kind ("motor" or "piezo")
+Axis=namedtuple('Axis',['name','channel','kind'])
+# Latest published state of an axis. position is NaN until a status has been received
+AxisState=namedtuple('AxisState',['position','statusBits','timestamp'])
+
+# Names of the shared memory blocks created by this process, which the resource tracker of this process already removes on exit
+_created=set()
+
+class SharedState(object):
+    """ Shared memory block of the latest state of each axis. The server creates it with axes; other processes attach to it by name and
+    read it with read(), which never blocks the writer (seqlock). A block left behind by a server which crashed is taken over if it has the
+    layout of this version and is large enough, and replaced otherwise; a block of the same name which isn't an aptserver's, or whose
+    server is still running, is an error """
+    def __init__(self,name=c.SERVER_SHARED_MEMORY_NAME,axes=None):
+        if shared_memory is None:
+            raise ImportError("multiprocessing.shared_memory (Python 3.8+) is required for the shared state")
+        self.name=name
+        if axes is None:
+            self.memory=_attach(name)
+            magic,version,numAxes,namesLength,pid=SHARED_HEADER.unpack_from(self.memory.buf,0)
+            if magic!=SHARED_MAGIC or version!=SHARED_VERSION:
+                self.memory.close()
+                raise ValueError("Shared memory block " + repr(name) + " wasn't created by a compatible aptserver")
+            names=bytes(self.memory.buf[SHARED_HEADER.size:SHARED_HEADER.size+namesLength])
+            self.axes=[Axis(*axis) for axis in json.loads(names.decode())]
+            self.owner=False
+        else:
+            self.axes=list(axes)
+            names=json.dumps(self.axes).encode()
+            numAxes,namesLength=len(self.axes),len(names)
+            size=self._recordsOffset(namesLength)+numAxes*SHARED_RECORD.size
+            self.memory=_create(name,size)
+            SHARED_HEADER.pack_into(self.memory.buf,0,SHARED_MAGIC,SHARED_VERSION,numAxes,namesLength,os.getpid())
+            self.memory.buf[SHARED_HEADER.size:SHARED_HEADER.size+namesLength]=names
+            self.owner=True
+        self._offset=self._recordsOffset(namesLength)
+        if self.owner:
+            for axis in range(len(self.axes)):
+                SHARED_RECORD.pack_into(self.memory.buf,self._offset+axis*SHARED_RECORD.size,0,0,float('nan'),0.0)
+
+    @staticmethod
+    def _recordsOffset(namesLength):
+        return (SHARED_HEADER.size+namesLength+7)//8*8
+
+    def write(self,axis,position,statusBits,timestamp):
+        """ Publish the state of an axis. There must be a single writer """
+        buf=self.memory.buf
+        offset=self._offset+axis*SHARED_RECORD.size
+        sequence=struct.unpack_from("<I",buf,offset)[0]
+        struct.pack_into("<I",buf,offset,(sequence+1)&0xFFFFFFFF)
+        SHARED_RECORD.pack_into(buf,offset,(sequence+1)&0xFFFFFFFF,statusBits,position,timestamp)
+        struct.pack_into("<I",buf,offset,(sequence+2)&0xFFFFFFFF)
+
+    def read(self,axis):
+        """ Return the AxisState of an axis (an index into self.axes), retrying if the server was writing it at the same time """
+        buf=self.memory.buf
+        offset=self._offset+axis*SHARED_RECORD.size
+        while True:
+            sequence,statusBits,position,timestamp=SHARED_RECORD.unpack_from(buf,offset)
+            if not sequence&1 and struct.unpack_from("<I",buf,offset)[0]==sequence:
+                return AxisState(position,statusBits,timestamp)
+
+    def index(self,name,channel=0):
+        """ Return the index of the axis of device name and channel """
+        return self.axes.index(next(axis for axis in self.axes if axis.name==name and axis.channel==channel))
+
+    def close(self):
+        """ Detach from the block, and remove it if this is the server's instance """
+        self.memory.close()
+        if self.owner:
+            self.memory.unlink()
+            _created.discard(self.name)
+
+def _create(name,size):
+    """ Create the shared memory block of the server, taking over a stale block of a previous server """
+    try:
+        memory=shared_memory.SharedMemory(name=name,create=True,size=size)
+    except FileExistsError:
+        if name in _created:
+            raise DeviceServerError("Shared memory block " + repr(name) + " is in use by a server of this process")
+        memory=shared_memory.SharedMemory(name=name)
+        magic,version,numAxes,namesLength,pid=SHARED_HEADER.unpack_from(memory.buf,0) if memory.size>=SHARED_HEADER.size else (None,)*5
+        if magic!=SHARED_MAGIC or _running(pid):
+            # Leave the block to its owner: don't let the resource tracker of this process remove it on exit
+            memory.close()
+            from multiprocessing import resource_tracker
+            resource_tracker.unregister(memory._name,"shared_memory")
+            if magic!=SHARED_MAGIC:
+                raise DeviceServerError("Shared memory block " + repr(name) + " exists and wasn't created by aptserver")
+            raise DeviceServerError("Shared memory block " + repr(name) + " is in use by the running server process " + str(pid))
+        if version!=SHARED_VERSION or memory.size<size:
+            memory.close()
+            memory.unlink()
+            memory=shared_memory.SharedMemory(name=name,create=True,size=size)
+    _created.add(name)
+    return memory
+
+def _running(pid):
+    """ True if a process with this ID is running """
+    if not pid:
+        return False
+    try:
+        os.kill(pid,0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        # It exists but belongs to another user
+        pass
+    return True
+
+def _attach(name):
+    """ Attach to an existing shared memory block without letting the resource tracker of this process remove it on exit """
+    try:
+        return shared_memory.SharedMemory(name=name,track=False)
+    except TypeError:
+        # Before Python 3.13 every process attaching to a block registers it for removal, so unregister it again, unless the block was
+        # created by this process, whose registration must stay for the unlink of the owner
+        memory=shared_memory.SharedMemory(name=name)
+        if name not in _created:
+            from multiprocessing import resource_tracker
+            resource_tracker.unregister(memory._name,"shared_memory")
+        return memory
+
+def _axisKind(device):
+    if isinstance(device,_AptPiezo):
+        return "piezo"
+    if isinstance(device,_AptMotor):
+        return "motor"
+    return None
+
+def _receive(sock,size):
+    """ Read exactly size bytes from sock, or return None if the connection was closed """
+    data=b""
+    while len(data)<size:
+        chunk=sock.recv(size-len(data))
+        if not chunk:
+            return None
+        data+=chunk
+    return data
+
+class _RequestHandler(socketserver.BaseRequestHandler):
+    """ Serves the requests of one client connection """
+    def handle(self):
+        server=self.server.deviceServer
+        if self.server.address_family!=getattr(socket,"AF_UNIX",None):
+            self.request.setsockopt(socket.IPPROTO_TCP,socket.TCP_NODELAY,1)
+        while True:
+            request=_receive(self.request,REQUEST.size)
+            if request is None:
+                return
+            sequence,opcode,flags,axis,value=REQUEST.unpack(request)
+            try:
+                value,payload=server.execute(opcode,flags,axis,value)
+                status=STATUS_OK
+            except Exception as e:
+                value,payload,status=float('nan'),repr(e),STATUS_ERROR
+            payload=payload.encode()[:0xFFFF]
+            self.request.sendall(REPLY.pack(sequence,status,value,len(payload))+payload)
+
+def _removeStaleSocket(address):
+    """ Remove the socket file left at address by a server which is no longer running. Raises DeviceServerError if a server answers there """
+    if not os.path.exists(address):
+        return
+    probe=socket.socket(socket.AF_UNIX,socket.SOCK_STREAM)
+    try:
+        probe.connect(address)
+    except (ConnectionRefusedError,FileNotFoundError):
+        pass
+    else:
+        raise DeviceServerError("A server is already running at " + address)
+    finally:
+        probe.close()
+    os.remove(address)
+
+if hasattr(socketserver,"UnixStreamServer"):
+    class _UnixServer(socketserver.ThreadingMixIn,socketserver.UnixStreamServer):
+        daemon_threads=True
+
+class _TCPServer(socketserver.ThreadingMixIn,socketserver.TCPServer):
+    daemon_threads=True
+    allow_reuse_address=True
+
+class DeviceServer(object):
+    """ Serve the devices of a dict of name -> device (e.g. from DeviceManager.openMany) at address: a Unix socket path, or a (host,port)
+    tuple for TCP. Each channel of each motor and piezo is an axis. Status updates are started on every device, and the streamed state is
+    published every publishInterval s to the shared memory block sharedName (None not to publish). The devices aren't closed by close() """
+    def __init__(self,devices,address=c.SERVER_SOCKET_PATH,sharedName=c.SERVER_SHARED_MEMORY_NAME,publishInterval=c.SERVER_PUBLISH_INTERVAL):
+        self.devices=devices
+        self.axes=[]
+        for name in sorted(devices):
+            kind=_axisKind(devices[name])
+            if kind is not None:
+                self.axes.extend(Axis(name,channel,kind) for channel in range(len(devices[name].channelAddresses)))
+        # Commands to one device are serialized; a waiting move only holds the lock while the move is sent
+        self._locks=dict((name,threading.Lock()) for name in devices)
+        self.address=address
+        if isinstance(address,tuple):
+            self._server=_TCPServer(address,_RequestHandler,bind_and_activate=True)
+        else:
+            directory=os.path.dirname(address)
+            if directory and not os.path.isdir(directory):
+                os.makedirs(directory)
+            _removeStaleSocket(address)
+            self._server=_UnixServer(address,_RequestHandler)
+            # Identity of our socket file, so that close() doesn't remove the socket of another server which replaced it
+            self._socketInode=os.stat(address).st_ino
+        self._server.deviceServer=self
+        try:
+            self.shared=SharedState(sharedName,self.axes) if sharedName is not None else None
+        except:
+            self._server.server_close()
+            if not isinstance(address,tuple):
+                os.remove(address)
+            raise
+        self.publishInterval=publishInterval
+        self._stop=threading.Event()
+        self._threads=[]
+
+    def start(self):
+        """ Start serving requests and publishing the state on background threads """
+        for name,device in self.devices.items():
+            if _axisKind(device) is not None:
+                device.startStatusUpdates()
+        self._threads=[threading.Thread(target=self._server.serve_forever,name="DeviceServer")]
+        if self.shared is not None:
+            self._threads.append(threading.Thread(target=self._publish,name="DeviceServer publisher"))
+        for thread in self._threads:
+            thread.daemon=True
+            thread.start()
+
+    def serveForever(self):
+        """ Start and block until interrupted """
+        self.start()
+        try:
+            while not self._stop.wait(1.0):
+                pass
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.close()
+
+    def close(self):
+        self._stop.set()
+        self._server.shutdown()
+        self._server.server_close()
+        for thread in self._threads:
+            thread.join()
+        if self.shared is not None:
+            self.shared.close()
+        if not isinstance(self.address,tuple):
+            try:
+                if os.stat(self.address).st_ino==self._socketInode:
+                    os.remove(self.address)
+            except OSError:
+                pass
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self,*exc):
+        self.close()
+
+    def _publish(self):
+        """ Body of the publisher thread: copy every new streamed status into the shared memory block """
+        published=[None]*len(self.axes)
+        while not self._stop.wait(self.publishInterval):
+            for index,axis in enumerate(self.axes):
+                status=self.devices[axis.name].status.get(axis.channel)
+                if status is not None and status is not published[index]:
+                    self.shared.write(index,status.position,status.statusBits,status.timestamp)
+                    published[index]=status
+
+    def execute(self,opcode,flags,axis,value):
+        """ Execute a request and return the (value,payload) of the reply """
+        if opcode==OP_LIST:
+            return float(len(self.axes)),json.dumps(self.axes)
+        if axis>=len(self.axes):
+            raise IndexError("No axis " + str(axis) + "; the server has " + str(len(self.axes)))
+        name,channel,kind=self.axes[axis]
+        device=self.devices[name]
+        wait=not flags&FLAG_NO_WAIT
+        handle=None
+        with self._locks[name]:
+            if opcode==OP_GET_POSITION:
+                return float(device.getPosition(channel)),""
+            if kind=="piezo":
+                if opcode==OP_MOVE_TO:
+                    return float(device.setPosition(channel,value).position),""
+                if opcode==OP_MOVE_BY:
+                    return float(device.setPosition(channel,device.getPosition(channel)+value).position),""
+                if opcode==OP_HOME:
+                    device.zero(channel)
+                    return float(device.getPosition(channel)),""
+                raise ValueError("Opcode " + str(opcode) + " isn't supported for piezo axes")
+            if opcode==OP_MOVE_TO:
+                handle=device.MoveAbsoluteEnc(channel,value,wait=False)
+            elif opcode==OP_MOVE_BY:
+                handle=device.MoveRelativeEnc(channel,value,wait=False)
+            elif opcode==OP_HOME:
+                handle=device.MoveHome(channel,wait=False)
+            elif opcode==OP_STOP:
+                device.stop(channel)
+                return float('nan'),""
+            else:
+                raise ValueError("Unknown opcode " + str(opcode))
+        if not wait:
+            return float('nan'),""
+        position=handle.result(c.QUERY_TIMEOUT/1000)
+        return float('nan') if position is None else float(position),""
+
+class DeviceClient(object):
+    """ Connection to a DeviceServer at address (a Unix socket path, or a (host,port) tuple for TCP). Axes can be given as an index into
+    self.axes, a device name (channel 0) or a (name,channel) tuple. Failed requests raise DeviceServerError. Positions can be read without
+    a round trip from the server's shared memory with SharedState """
+    def __init__(self,address=c.SERVER_SOCKET_PATH,timeout=None):
+        if isinstance(address,tuple):
+            self.socket=socket.create_connection(address,timeout)
+            self.socket.setsockopt(socket.IPPROTO_TCP,socket.TCP_NODELAY,1)
+        else:
+            self.socket=socket.socket(socket.AF_UNIX,socket.SOCK_STREAM)
+            self.socket.settimeout(timeout)
+            self.socket.connect(address)
+        self._lock=threading.Lock()
+        self._sequence=0
+        count,payload=self._request(OP_LIST)
+        self.axes=[Axis(*axis) for axis in json.loads(payload)]
+
+    def _request(self,opcode,axis=0,value=0.0,flags=0):
+        with self._lock:
+            self._sequence=(self._sequence+1)&0xFFFFFFFF
+            self.socket.sendall(REQUEST.pack(self._sequence,opcode,flags,axis,value))
+            reply=_receive(self.socket,REPLY.size)
+            if reply is None:
+                raise DeviceServerError("The server closed the connection")
+            sequence,status,value,payloadLength=REPLY.unpack(reply)
+            payload=_receive(self.socket,payloadLength).decode() if payloadLength else ""
+        if sequence!=self._sequence:
+            raise DeviceServerError("Reply out of sequence")
+        if status!=STATUS_OK:
+            raise DeviceServerError(payload)
+        return value,payload
+
+    def axisIndex(self,axis):
+        if isinstance(axis,int):
+            return axis
+        name,channel=axis if isinstance(axis,tuple) else (axis,0)
+        for index,candidate in enumerate(self.axes):
+            if candidate.name==name and candidate.channel==channel:
+                return index
+        raise KeyError("No axis " + repr(axis))
+
+    def getPosition(self,axis):
+        return self._request(OP_GET_POSITION,self.axisIndex(axis))[0]
+
+    def moveTo(self,axis,position,wait=True):
+        """ Move to position and return the position reached (NaN with wait=False) """
+        return self._request(OP_MOVE_TO,self.axisIndex(axis),position,0 if wait else FLAG_NO_WAIT)[0]
+
+    def moveBy(self,axis,distance,wait=True):
+        return self._request(OP_MOVE_BY,self.axisIndex(axis),distance,0 if wait else FLAG_NO_WAIT)[0]
+
+    def home(self,axis,wait=True):
+        """ Home a motor axis, or zero a piezo axis """
+        return self._request(OP_HOME,self.axisIndex(axis),0.0,0 if wait else FLAG_NO_WAIT)[0]
+
+    def stop(self,axis):
+        self._request(OP_STOP,self.axisIndex(axis))
+
+    def close(self):
+        self.socket.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self,*exc):
+        self.close()
+
+def main(argv=None):
+    from .aptmanager import DeviceManager
+    parser=argparse.ArgumentParser(description=__doc__,formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("fleet",help="JSON fleet file of the devices to serve (see aptmanager)")
+    parser.add_argument("--socket",default=c.SERVER_SOCKET_PATH,help="Unix socket path to listen on")
+    parser.add_argument("--tcp",help="listen on host:port over TCP instead")
+    parser.add_argument("--shared-memory",default=c.SERVER_SHARED_MEMORY_NAME,help="name of the shared memory block for the axis state")
+    args=parser.parse_args(argv)
+    if args.tcp:
+        host,port=args.tcp.rsplit(":",1)
+        address=(host,int(port))
+    else:
+        address=args.socket
+    with DeviceManager() as manager:
+        devices=manager.openFleet(args.fleet)
+        server=DeviceServer(devices,address,args.shared_memory)
+        print("Serving " + ", ".join(sorted(devices)) + " on " + str(address))
+        server.serveForever()
+    return 0
+
+if __name__=="__main__":
+    sys.exit(main())
@@ -0,0 +1,543 @@
+""" Simulated APT controllers which can stand in for pylibftdi.Device, so that aptlib can be exercised without hardware:
+
+    motor=AptMotor(device=SimulatedDevice(),stageType="Z8XX")
+
+The simulation speaks the APT framing of aptconsts/aptcodec and answers the messages used by _AptMotor and _AptPiezo. Motors follow a
+trapezoidal velocity profile set by MGMSG_MOT_SET_VELPARAMS (interpreted with the TDC001 time base), and piezo outputs approach their
+set point exponentially. The USB link can be given a latency, a random jitter and a probability of dropping each byte sent to the host.
+A serial number starting with one of c.BAY_TYPE_SERIAL_PREFIXES simulates a rack controller with one controller per occupied bay. """
+from __future__ import division
+import heapq
+import math
+import random
+import threading
+import time
+from . import aptconsts as c
+from . import aptcodec
+
+# Sampling interval of the TDC001, used to convert the velocity/acceleration parameters to encoder counts per second (per second)
+TDC001_SAMPLE_TIME=2048/6e6
+# Default MGMSG_MOT_SET_VELPARAMS acceleration and maximum velocity (those sent for the PRM1-Z8 stage)
+DEFAULT_ACCELERATION=0x93
+DEFAULT_VELOCITY=0x68d5f
+# Default relative move (MGMSG_MOT_SET_MOVERELPARAMS) and jog step (MGMSG_MOT_SET_JOGPARAMS) in encoder counts
+DEFAULT_RELATIVE_DISTANCE=0xa00
+DEFAULT_JOG_STEP=0x257e
+# Piezo status bit set when an actuator is connected
+PIEZO_STATUS_CONNECTED=0x00000001
+
+def _parameterMessages():
+    """ Map each SET message ID of aptconsts with matching REQ and GET messages onto (REQ,GET), so that parameters can be stored and read back """
+    names=vars(c)
+    messages={}
+    for name,setID in names.items():
+        if name.startswith("MGMSG_") and "_SET_" in name:
+            reqName=name.replace("_SET_","_REQ_",1)
+            getName=name.replace("_SET_","_GET_",1)
+            if reqName in names and getName in names:
+                messages[setID]=(names[reqName],names[getName])
+    return messages
+
+PARAMETER_MESSAGES=_parameterMessages()
+PARAMETER_REQUESTS=dict((reqID,(setID,getID)) for setID,(reqID,getID) in PARAMETER_MESSAGES.items())
+
+class _FtdiFunctions(object):
+    """ The subset of pylibftdi's ftdi_fn used by AptDevice """
+    def ftdi_set_line_property(self,*args): return 0
+    def ftdi_setflowctrl(self,*args): return 0
+    def ftdi_setrts(self,*args): return 0
+    def ftdi_get_error_string(self): return b""
+
+class _Move(object):
+    """ A move of a motor channel from start at time t0, either to target with a trapezoidal velocity profile, or at constant
+    velocity in direction (+1/-1) if target is None. All units are encoder counts and seconds """
+    def __init__(self,t0,start,target,velocity,acceleration,reply,direction=None):
+        self.t0=t0
+        self.start=start
+        self.target=target
+        self.velocity=velocity
+        self.acceleration=acceleration
+        self.reply=reply
+        if target is None:
+            self.direction=direction
+            self.duration=None
+            return
+        self.direction=1 if target>=start else -1
+        distance=abs(target-start)
+        self.rampTime=velocity/acceleration
+        if distance>=velocity*self.rampTime:
+            self.duration=distance/velocity+self.rampTime
+        else:
+            # Never reaches full speed: triangular profile
+            self.rampTime=math.sqrt(distance/acceleration)
+            self.velocity=acceleration*self.rampTime
+            self.duration=2*self.rampTime
+
+    def position(self,t):
+        dt=max(0.0,t-self.t0)
+        if self.target is None:
+            return self.start+self.direction*self.velocity*dt
+        if dt>=self.duration:
+            return self.target
+        distance=abs(self.target-self.start)
+        if dt<self.rampTime:
+            travelled=0.5*self.acceleration*dt**2
+        elif dt<self.duration-self.rampTime:
+            travelled=0.5*self.acceleration*self.rampTime**2+self.velocity*(dt-self.rampTime)
+        else:
+            travelled=distance-0.5*self.acceleration*(self.duration-dt)**2
+        return self.start+self.direction*travelled
+
+    def speed(self,t):
+        dt=max(0.0,t-self.t0)
+        if self.target is None:
+            return self.velocity
+        if dt>=self.duration:
+            return 0.0
+        return min(self.velocity,self.acceleration*dt,self.acceleration*(self.duration-dt))
+
+class _MotorChannel(object):
+    """ State of one DC motor channel """
+    def __init__(self,channelID):
+        self.channelID=channelID
+        self.position=0.0
+        self.move=None
+        self.enabled=True
+        self.homed=False
+
+    def positionAt(self,t):
+        return self.move.position(t) if self.move is not None else self.position
+
+    def statusAt(self,t):
+        status=c.MOTOR_STATUS_ENABLED if self.enabled else 0
+        if self.homed:
+            status|=c.MOTOR_STATUS_HOMED
+        if self.move is not None and (self.move.duration is None or t<self.move.t0+self.move.duration):
+            status|=c.MOTOR_STATUS_MOVING_FORWARD if self.move.direction>0 else c.MOTOR_STATUS_MOVING_REVERSE
+            if self.move.reply==c.MGMSG_MOT_MOVE_HOMED:
+                status|=c.MOTOR_STATUS_HOMING
+        return status
+
+    def stop(self,t):
+        self.position=self.positionAt(t)
+        self.move=None
+
+class _PiezoChannel(object):
+    """ State of one piezo channel. The output is tracked as a fraction of full scale (0..c.PIEZO_MAX_POS_REPR) which approaches its
+    set point with time constant settleTime """
+    def __init__(self,channelID,maxTravel,maxVoltage,settleTime):
+        self.channelID=channelID
+        self.maxTravel=maxTravel
+        self.maxVoltage=maxVoltage
+        self.settleTime=settleTime
+        self.controlMode=c.PIEZO_OPEN_LOOP_MODE
+        self.enabled=True
+        self.start=0.0
+        self.target=0.0
+        self.t0=0.0
+        self.zeroUntil=None
+        # Output look up table: index -> raw value, the LUT parameters data packet, and the time the LUT output was started
+        self.lut={}
+        self.lutParams=None
+        self.lutStart=None
+
+    def outputAt(self,t):
+        if self.lutStart is not None and t>=self.lutStart:
+            return self._lutOutputAt(t)
+        dt=max(0.0,t-self.t0)
+        return self.target+(self.start-self.target)*math.exp(-dt/self.settleTime)
+
+    def _lutOutputAt(self,t):
+        """ The LUT entry being output at time t (ignoring the pre/post cycle rests); the last entry is held once a fixed number of cycles is done """
+        channelID,mode,cycleLength,numCycles,delayTime=self.lutParams[:5]
+        sample=int((t-self.lutStart)*1000/max(delayTime,1))
+        if mode==c.PIEZO_LUT_MODE_FIXED and sample>=cycleLength*numCycles:
+            sample=cycleLength*numCycles-1
+        return self.lut.get(sample%cycleLength,0)
+
+    def stopLut(self,t):
+        """ Stop the LUT output, holding the current output """
+        if self.lutStart is not None:
+            output=self.outputAt(t)
+            self.lutStart=None
+            self.start=self.target=output
+            self.t0=t
+
+    def setTarget(self,t,target):
+        self.start=self.outputAt(t)
+        self.target=float(target)
+        self.t0=t
+
+    def statusAt(self,t):
+        status=PIEZO_STATUS_CONNECTED
+        if self.zeroUntil is not None and t<self.zeroUntil:
+            status|=c.PIEZO_STATUS_ZEROING
+        return status
+
+class _Controller(object):
+    """ One addressable controller: a stand alone unit, a rack controller or a bay """
+    def __init__(self,address,serial,model,kind,numChannels,notes,maxTravel,maxVoltage,settleTime,zeroTime):
+        self.address=address
+        self.serial=serial
+        self.model=model
+        self.kind=kind
+        self.notes=notes
+        self.numChannels=numChannels
+        self.zeroTime=zeroTime
+        self.parameters={}
+        self.headerParameters={}
+        self.bays=[]
+        if kind=="motor":
+            self.channels=dict((channelID,_MotorChannel(channelID)) for channelID in c.ALL_CHANNELS[:numChannels])
+        elif kind=="piezo":
+            self.channels=dict((channelID,_PiezoChannel(channelID,maxTravel,maxVoltage,settleTime)) for channelID in c.ALL_CHANNELS[:numChannels])
+        else:
+            self.channels={}
+
+    def info(self):
+        return (self.serial,self.model.encode(),16,0x00010203,self.notes.encode(),1,0,self.numChannels)
+
+    def parameter(self,setID,channelID):
+        """ Return the stored data packet of a SET message, defaulting to zeros, or None if the message has no fixed structure """
+        stored=self.parameters.get((setID,channelID))
+        if stored is not None:
+            return stored
+        if setID==c.MGMSG_MOT_SET_VELPARAMS:
+            return (channelID,0,DEFAULT_ACCELERATION,DEFAULT_VELOCITY)
+        if setID==c.MGMSG_MOT_SET_HOMEPARAMS:
+            return (channelID,2,1,DEFAULT_VELOCITY,0)
+        if setID==c.MGMSG_MOT_SET_MOVERELPARAMS:
+            return (channelID,DEFAULT_RELATIVE_DISTANCE)
+        if setID==c.MGMSG_MOT_SET_MOVEABSPARAMS:
+            return (channelID,0)
+        if setID==c.MGMSG_MOT_SET_JOGPARAMS:
+            return (channelID,2,DEFAULT_JOG_STEP,0,DEFAULT_ACCELERATION,DEFAULT_VELOCITY,2)
+        try:
+            packet=aptcodec.packetStruct(PARAMETER_MESSAGES[setID][1])
+        except Exception:
+            return None
+        return (channelID,)+packet.unpack(bytes(packet.size))[1:]
+
+    def kinematics(self,channelID,home=False):
+        """ Velocity and acceleration of a channel in encoder counts/s and counts/s/s """
+        velParams=self.parameter(c.MGMSG_MOT_SET_VELPARAMS,channelID)
+        acceleration=max(velParams[2],1)/(TDC001_SAMPLE_TIME**2*65536)
+        velocity=max(velParams[3],1)
+        if home:
+            velocity=max(self.parameter(c.MGMSG_MOT_SET_HOMEPARAMS,channelID)[3],1)
+        return velocity/(TDC001_SAMPLE_TIME*65536),acceleration
+
+    def handle(self,t,messageID,param1,param2,dataPacket):
+        """ Process a message from the host at time t and return a list of replies (messageID,param1,param2,dataPacket) """
+        channelID=param1 if dataPacket is None else dataPacket[0]
+        channel=self.channels.get(channelID)
+        if messageID==c.MGMSG_HW_REQ_INFO:
+            return [(c.MGMSG_HW_GET_INFO,0,0,self.info())]
+        if messageID==c.MGMSG_RACK_REQ_BAYUSED:
+            occupied=param1<len(self.bays) and self.bays[param1] is not None
+            return [(c.MGMSG_RACK_GET_BAYUSED,param1,c.BAY_OCCUPIED if occupied else c.BAY_EMPTY,None)]
+        if messageID==c.MGMSG_MOD_SET_CHANENABLESTATE:
+            if channel is not None: channel.enabled=(param2==c.CHAN_ENABLE_STATE_ENABLED)
+            return []
+        if messageID==c.MGMSG_MOD_REQ_CHANENABLESTATE:
+            if channel is None: return []
+            return [(c.MGMSG_MOD_GET_CHANENABLESTATE,channelID,c.CHAN_ENABLE_STATE_ENABLED if channel.enabled else c.CHAN_ENABLE_STATE_DISABLED,None)]
+        if channel is not None:
+            if self.kind=="motor":
+                replies=self._handleMotor(t,channel,messageID,param1,param2,dataPacket)
+            else:
+                replies=self._handlePiezo(t,channel,messageID,param1,param2,dataPacket)
+            if replies is not None:
+                return replies
+        return self._handleParameters(channelID,messageID,param1,param2,dataPacket)
+
+    def _handleParameters(self,channelID,messageID,param1,param2,dataPacket):
+        """ Store SET messages and answer the matching REQ messages with what was stored. Parameters set with a header only message are
+        returned in a header only message """
+        if messageID in PARAMETER_MESSAGES:
+            if dataPacket is None:
+                self.headerParameters[(messageID,param1)]=(param1,param2)
+            else:
+                self.parameters[(messageID,channelID)]=dataPacket
+        elif messageID in PARAMETER_REQUESTS:
+            setID,getID=PARAMETER_REQUESTS[messageID]
+            stored=self.headerParameters.get((setID,channelID))
+            if stored is not None:
+                return [(getID,stored[0],stored[1],None)]
+            dataPacket=self.parameter(setID,channelID)
+            if dataPacket is None:
+                return [(getID,channelID,0,None)]
+            # Fit the stored values to the structure of the GET message, in case the two are listed differently in PACKET_STRUCTS
+            numValues=len(aptcodec.packetStruct(getID).unpack(bytes(aptcodec.packetStruct(getID).size)))
+            return [(getID,0,0,(tuple(dataPacket)+(0,)*numValues)[:numValues])]
+        return []
+
+    def _completion(self,channel,t):
+        """ Data packet of the move completed/stopped messages """
+        position=int(round(channel.positionAt(t)))
+        return (channel.channelID,position,position,channel.statusAt(t))
+
+    def _handleMotor(self,t,channel,messageID,param1,param2,dataPacket):
+        channelID=channel.channelID
+        if messageID==c.MGMSG_MOT_REQ_POSCOUNTER:
+            return [(c.MGMSG_MOT_GET_POSCOUNTER,0,0,(channelID,int(round(channel.positionAt(t)))))]
+        if messageID==c.MGMSG_MOT_REQ_ENCCOUNTER:
+            return [(c.MGMSG_MOT_GET_ENCCOUNTER,0,0,(channelID,int(round(channel.positionAt(t)))))]
+        if messageID in (c.MGMSG_MOT_SET_POSCOUNTER,c.MGMSG_MOT_SET_ENCCOUNTER):
+            channel.stop(t)
+            channel.position=float(dataPacket[1])
+            return []
+        if messageID==c.MGMSG_MOT_REQ_DCSTATUSUPDATE:
+            return [self._statusUpdate(channel,t)]
+        if messageID==c.MGMSG_MOT_REQ_STATUSUPDATE:
+            return [(c.MGMSG_MOT_GET_STATUSUPDATE,0,0,self._completion(channel,t))]
+        if messageID in (c.MGMSG_MOT_MOVE_ABSOLUTE,c.MGMSG_MOT_MOVE_RELATIVE,c.MGMSG_MOT_MOVE_JOG,c.MGMSG_MOT_MOVE_HOME):
+            start=channel.positionAt(t)
+            if messageID==c.MGMSG_MOT_MOVE_ABSOLUTE:
+                target=(dataPacket or self.parameter(c.MGMSG_MOT_SET_MOVEABSPARAMS,channelID))[1]
+            elif messageID==c.MGMSG_MOT_MOVE_RELATIVE:
+                target=start+(dataPacket or self.parameter(c.MGMSG_MOT_SET_MOVERELPARAMS,channelID))[1]
+            elif messageID==c.MGMSG_MOT_MOVE_JOG:
+                step=self.parameter(c.MGMSG_MOT_SET_JOGPARAMS,channelID)[2]
+                target=start+(step if param2==c.MOTOR_JOG_FORWARD else -step)
+            else:
+                target=0.0
+            velocity,acceleration=self.kinematics(channelID,home=messageID==c.MGMSG_MOT_MOVE_HOME)
+            reply=c.MGMSG_MOT_MOVE_HOMED if messageID==c.MGMSG_MOT_MOVE_HOME else c.MGMSG_MOT_MOVE_COMPLETED
+            channel.stop(t)
+            channel.move=_Move(t,start,float(target),velocity,acceleration,reply)
+            return []
+        if messageID==c.MGMSG_MOT_MOVE_VELOCITY:
+            velocity,acceleration=self.kinematics(channelID)
+            channel.stop(t)
+            channel.move=_Move(t,channel.position,None,velocity,acceleration,c.MGMSG_MOT_MOVE_STOPPED,1 if param2==c.MOTOR_JOG_FORWARD else -1)
+            return []
+        if messageID==c.MGMSG_MOT_MOVE_STOP:
+            channel.stop(t)
+            return [(c.MGMSG_MOT_MOVE_STOPPED,0,0,self._completion(channel,t))]
+        return None
+
+    def _statusUpdate(self,channel,t):
+        move=channel.move
+        speed=move.speed(t) if move is not None else 0.0
+        return (c.MGMSG_MOT_GET_DCSTATUSUPDATE,0,0,(channel.channelID,int(round(channel.positionAt(t))),min(int(speed),0xFFFF),0,channel.statusAt(t)))
+
+    def _handlePiezo(self,t,channel,messageID,param1,param2,dataPacket):
+        channelID=channel.channelID
+        if messageID==c.MGMSG_PZ_SET_POSCONTROLMODE:
+            channel.controlMode=param2
+            return []
+        if messageID==c.MGMSG_PZ_REQ_POSCONTROLMODE:
+            return [(c.MGMSG_PZ_GET_POSCONTROLMODE,channelID,channel.controlMode,None)]
+        if messageID==c.MGMSG_PZ_SET_OUTPUTVOLTS:
+            if channel.controlMode==c.PIEZO_OPEN_LOOP_MODE and channel.lutStart is None:
+                channel.setTarget(t,dataPacket[1]*c.PIEZO_MAX_POS_REPR/c.PIEZO_MAX_VOLT_REPR)
+            return []
+        if messageID==c.MGMSG_PZ_SET_OUTPUTPOS:
+            if channel.controlMode!=c.PIEZO_OPEN_LOOP_MODE and channel.lutStart is None:
+                channel.setTarget(t,dataPacket[1])
+            return []
+        if messageID==c.MGMSG_PZ_REQ_OUTPUTVOLTS:
+            return [(c.MGMSG_PZ_GET_OUTPUTVOLTS,0,0,(channelID,int(round(channel.outputAt(t)*c.PIEZO_MAX_VOLT_REPR/c.PIEZO_MAX_POS_REPR))))]
+        if messageID==c.MGMSG_PZ_REQ_OUTPUTPOS:
+            return [(c.MGMSG_PZ_GET_OUTPUTPOS,0,0,(channelID,int(round(channel.outputAt(t)))))]
+        if messageID==c.MGMSG_PZ_REQ_MAXTRAVEL:
+            return [(c.MGMSG_PZ_GET_MAXTRAVEL,0,0,(channelID,channel.maxTravel))]
+        if messageID==c.MGMSG_PZ_REQ_OUTPUTMAXVOLTS:
+            return [(c.MGMSG_PZ_GET_OUTPUTMAXVOLTS,0,0,(channelID,channel.maxVoltage,0))]
+        if messageID==c.MGMSG_PZ_REQ_PZSTATUSBITS:
+            return [(c.MGMSG_PZ_GET_PZSTATUSBITS,0,0,(channelID,channel.statusAt(t)))]
+        if messageID==c.MGMSG_PZ_REQ_PZSTATUSUPDATE:
+            return [self._piezoStatusUpdate(channel,t)]
+        if messageID==c.MGMSG_PZ_SET_OUTPUTLUT:
+            channel.lut[dataPacket[1]]=dataPacket[2]
+            return []
+        if messageID==c.MGMSG_PZ_SET_OUTPUTLUTPARAMS:
+            channel.lutParams=dataPacket
+            return []
+        if messageID==c.MGMSG_PZ_REQ_OUTPUTLUT:
+            return [(c.MGMSG_PZ_GET_OUTPUTLUT,0,0,(channelID,param2,channel.lut.get(param2,0)))]
+        if messageID==c.MGMSG_PZ_START_LUTOUTPUT:
+            if channel.lutParams is not None:
+                channel.stopLut(t)
+                channel.lutStart=t
+            return []
+        if messageID==c.MGMSG_PZ_STOP_LUTOUTPUT:
+            channel.stopLut(t)
+            return []
+        if messageID==c.MGMSG_PZ_SET_ZERO:
+            channel.stopLut(t)
+            channel.setTarget(t,0)
+            channel.zeroUntil=t+self.zeroTime
+            return []
+        return None
+
+    def _piezoStatusUpdate(self,channel,t):
+        output=channel.outputAt(t)
+        return (c.MGMSG_PZ_GET_PZSTATUSUPDATE,0,0,(channel.channelID,int(round(output*c.PIEZO_MAX_VOLT_REPR/c.PIEZO_MAX_POS_REPR)),int(round(output)),channel.statusAt(t)))
+
+    def poll(self,t):
+        """ Return the (time,reply) tuples of the moves which finished by time t """
+        events=[]
+        if self.kind=="motor":
+            for channel in self.channels.values():
+                move=channel.move
+                if move is not None and move.duration is not None and move.t0+move.duration<=t:
+                    tEnd=move.t0+move.duration
+                    channel.stop(tEnd)
+                    if move.reply==c.MGMSG_MOT_MOVE_HOMED:
+                        channel.homed=True
+                        events.append((tEnd,(c.MGMSG_MOT_MOVE_HOMED,channel.channelID,0,None)))
+                    else:
+                        events.append((tEnd,(move.reply,0,0,self._completion(channel,tEnd))))
+        return events
+
+    def statusUpdates(self,t):
+        """ The status update messages pushed at time t when update messages are enabled """
+        if self.kind=="motor":
+            return [self._statusUpdate(channel,t) for channel in self.channels.values()]
+        if self.kind=="piezo":
+            return [self._piezoStatusUpdate(channel,t) for channel in self.channels.values()]
+        return []
+
+class SimulatedDevice(object):
+    """ Stand-in for pylibftdi.Device which simulates an APT controller (kind "motor" or "piezo") with numChannels channels,
+    or a rack with one controller of the given kind per bay (None for an empty bay) if serial has a bay type prefix.
+    latency and jitter (s) delay each reply by latency+uniform(0,jitter), and each byte sent to the host is dropped with probability dropRate.
+    Status update messages are pushed every updateInterval s after MGMSG_HW_START_UPDATEMSGS; if keepaliveTimeout (s) is given they stop
+    when no acknowledge message has been received for that long. If writeChunk is given each write accepts at most that many bytes """
+    def __init__(self,serial="83000001",model="TDC001",kind="motor",numChannels=1,bays=("motor","motor","motor"),notes=None,
+                 latency=0.0,jitter=0.0,dropRate=0.0,seed=None,maxTravel=200,maxVoltage=750,settleTime=0.005,zeroTime=1.0,
+                 updateInterval=0.1,keepaliveTimeout=None,writeChunk=None):
+        self.device_id=str(serial)
+        self.closed=False
+        self.baudrate=115200
+        self.ftdi_fn=_FtdiFunctions()
+        self.latency=latency
+        self.jitter=jitter
+        self.dropRate=dropRate
+        self.updateInterval=updateInterval
+        self.keepaliveTimeout=keepaliveTimeout
+        self.writeChunk=writeChunk
+        self._random=random.Random(seed)
+        self._input=bytearray()
+        self._output=bytearray()
+        self._scheduled=[]
+        self._sequence=0
+        self._lastDue=0.0
+        self._updatesFrom=None
+        self._lastAck=None
+        # Like a USB device, it can be written and read from different threads at once
+        self._lock=threading.Lock()
+        if notes is None:
+            notes="APT Piezo" if kind=="piezo" else "APT DC Motor Controller"
+        def controller(address,kind,numChannels,serial,model):
+            return _Controller(address,serial,model,kind,numChannels,notes,maxTravel,maxVoltage,settleTime,zeroTime)
+        if self.device_id[0:2] in c.BAY_TYPE_SERIAL_PREFIXES:
+            rack=controller(c.RACK_CONTROLLER_ID,None,len(bays),int(serial),model)
+            rack.bays=list(bays)
+            self.controllers={c.RACK_CONTROLLER_ID:rack}
+            for bay,bayKind in enumerate(bays):
+                if bayKind is not None:
+                    self.controllers[c.ALL_BAYS[bay]]=controller(c.ALL_BAYS[bay],bayKind,1,int(serial)+bay+1,model)
+        else:
+            self.controllers={c.GENERIC_USB_ID:controller(c.GENERIC_USB_ID,kind,numChannels,int(serial),model)}
+
+    @staticmethod
+    def listDevices():
+        """ The controller simulated with the default arguments, as listed by the "sim" transport backend (see apttransport) """
+        return [("Thorlabs","APT DC Motor Controller","83000001")]
+
+    def controller(self,address=c.GENERIC_USB_ID):
+        """ The simulated controller at the given address, to inspect or change its state """
+        return self.controllers[address]
+
+    def write(self,data):
+        with self._lock:
+            return self._write(data)
+
+    def _write(self,data):
+        if self.closed:
+            raise IOError("Simulated device is closed")
+        t=time.monotonic()
+        if self.writeChunk is not None:
+            data=data[:self.writeChunk]
+        self._input+=data
+        while len(self._input)>=c.NUM_HEADER_BYTES:
+            messageID,param1,param2,destID,sourceID,dataPacketLength=aptcodec.decodeHeader(self._input)
+            frameLength=c.NUM_HEADER_BYTES+dataPacketLength
+            if len(self._input)<frameLength:
+                break
+            dataPacket=aptcodec.decodeDataPacket(messageID,self._input[c.NUM_HEADER_BYTES:frameLength]) if dataPacketLength else None
+            del self._input[:frameLength]
+            self._handle(t,messageID,param1,param2,destID,dataPacket)
+        return len(data)
+
+    def read(self,length):
+        if self.closed:
+            raise IOError("Simulated device is closed")
+        t=time.monotonic()
+        with self._lock:
+            self._poll(t)
+            while self._scheduled and self._scheduled[0][0]<=t:
+                self._output+=heapq.heappop(self._scheduled)[2]
+            data=bytes(self._output[:length])
+            del self._output[:length]
+        return data
+
+    def flush(self,flags=None):
+        with self._lock:
+            self._input=bytearray()
+            self._output=bytearray()
+            self._scheduled=[]
+
+    def close(self):
+        self.closed=True
+
+    def _handle(self,t,messageID,param1,param2,destID,dataPacket):
+        if messageID==c.MGMSG_HW_START_UPDATEMSGS:
+            self._updatesFrom=t
+            self._lastAck=t
+            return
+        if messageID==c.MGMSG_HW_STOP_UPDATEMSGS:
+            self._updatesFrom=None
+            return
+        if messageID in (c.MGMSG_MOT_ACK_DCSTATUSUPDATE,c.MGMSG_PZ_ACK_PZSTATUSUPDATE):
+            self._lastAck=t
+            return
+        if len(self.controllers)==1:
+            controller=self.controllers[c.GENERIC_USB_ID]
+        else:
+            controller=self.controllers.get(destID)
+            if controller is None:
+                return
+        self._poll(t)
+        for reply in controller.handle(t,messageID,param1,param2,dataPacket):
+            self._send(t,controller.address,reply)
+
+    def _poll(self,t):
+        """ Generate the messages due by time t: completed moves and periodic status updates """
+        for address,controller in self.controllers.items():
+            for tEvent,reply in controller.poll(t):
+                self._send(tEvent,address,reply)
+        if self._updatesFrom is not None:
+            if self.keepaliveTimeout is not None and t-self._lastAck>self.keepaliveTimeout:
+                self._updatesFrom=None
+                return
+            while self._updatesFrom+self.updateInterval<=t:
+                self._updatesFrom+=self.updateInterval
+                for address,controller in self.controllers.items():
+                    for reply in controller.statusUpdates(self._updatesFrom):
+                        self._send(self._updatesFrom,address,reply)
+
+    def _send(self,t,sourceID,reply):
+        """ Schedule a reply to reach the host after the link latency, preserving the order of the frames """
+        messageID,param1,param2,dataPacket=reply
+        frame=aptcodec.encode(messageID,param1,param2,c.HOST_CONTROLLER_ID,sourceID,dataPacket)
+        if self.dropRate:
+            frame=bytes(byte for byte in frame if self._random.random()>=self.dropRate)
+        due=t+self.latency+(self._random.uniform(0,self.jitter) if self.jitter else 0.0)
+        due=max(due,self._lastDue)
+        self._lastDue=due
+        self._sequence+=1
+        heapq.heappush(self._scheduled,(due,self._sequence,frame))
@@ -0,0 +1,117 @@
+""" Transports carrying the APT frames between AptDevice and the controllers.
+A transport is any object with the subset of pylibftdi.Device used by AptDevice: device_id (the serial number string), closed,
+read(length) returning the bytes available (at most length, without blocking), write(data) returning the number of bytes written,
+flush() discarding the pending data both ways, close(), and optionally configure() to set up the link (baud rate, flow control).
+The backends are
+
+    "pylibftdi"  aptftdi.FtdiTransport: libftdi through pylibftdi
+    "serial"     aptserial.SerialTransport: the /dev/ttyUSB* device of the kernel's ftdi_sio driver through termios (Linux)
+    "sim"        aptsim.SimulatedDevice: simulated controllers
+
+and a backend is only imported when it is first selected, so that e.g. codec users never load libftdi. The backend used by default is
+c.TRANSPORT, set by the APTLIB_TRANSPORT environment variable. MemoryTransport, in memory pipes fed by the caller or by a responder
+function, has no controllers to find by serial number, so it isn't a backend: pass it as the device of AptDevice instead """
+from __future__ import print_function,division
+import importlib
+import threading
+from . import aptconsts as c
+from . import aptcodec
+
+# Backend name -> (module,class)
+BACKENDS={"pylibftdi":("aptftdi","FtdiTransport"),
+          "serial":("aptserial","SerialTransport"),
+          "sim":("aptsim","SimulatedDevice")}
+
+def transportClass(backend=None):
+    """ Import the backend (c.TRANSPORT if None) and return its transport class """
+    backend=backend or c.TRANSPORT
+    if backend not in BACKENDS:
+        raise ValueError("Unknown transport " + repr(backend) + "; expected one of " + ", ".join(sorted(BACKENDS)))
+    moduleName,className=BACKENDS[backend]
+    return getattr(importlib.import_module("."+moduleName,__package__),className)
+
+def listDevices(backend=None):
+    """ Return the (manufacturer,description,serial) strings of the controllers reachable through the backend """
+    cls=transportClass(backend)
+    return cls.listDevices() if hasattr(cls,"listDevices") else []
+
+def openTransport(serial,backend=None):
+    """ Open the controller with the serial number through the backend """
+    return transportClass(backend)(str(serial))
+
+def configure(device):
+    """ Set up the link of a transport for the APT protocol: its own configure() if it has one, otherwise the FTDI settings through the
+    ftdi_fn of a bare pylibftdi.Device """
+    if hasattr(device,"configure"):
+        device.configure()
+    else:
+        configureFtdi(device)
+
+def configureFtdi(device):
+    """ Initialize a pylibftdi.Device according to FTD2xx and APT requirements: 115200 baud, 8 data bits, 1 stop bit, no parity and RTS/CTS
+    flow control with RTS set """
+    device.baudrate = 115200
+    # Return exception if there is an error in ftdi function
+    def _checked_c(ret):
+        if not ret == 0:
+            raise Exception(device.ftdi_fn.ftdi_get_error_string())
+    _checked_c(device.ftdi_fn.ftdi_set_line_property( 8,  # number of bits
+                                                      1,  # number of stop bits
+                                                      0   # no parity
+                                                      ))
+    # From ftdi.h
+    SIO_RTS_CTS_HS = (0x1 << 8)
+    _checked_c(device.ftdi_fn.ftdi_setflowctrl(SIO_RTS_CTS_HS))
+    _checked_c(device.ftdi_fn.ftdi_setrts(1))
+
+class MemoryTransport(object):
+    """ Transport over in memory pipes. Frames written by the host accumulate in self.sent and, if responder is given, each complete frame
+    is passed to responder(frame) whose return value (bytes) is queued for the host to read. feed() queues bytes directly """
+    def __init__(self,serial="83000001",responder=None):
+        self.device_id=str(serial)
+        self.closed=False
+        self.responder=responder
+        self.sent=bytearray()
+        self._pending=bytearray()
+        self._output=bytearray()
+        self._lock=threading.Lock()
+
+    def feed(self,data):
+        """ Queue bytes for the host to read """
+        with self._lock:
+            self._output+=data
+
+    def write(self,data):
+        if self.closed:
+            raise IOError("Memory transport is closed")
+        with self._lock:
+            self.sent+=data
+            if self.responder is not None:
+                self._pending+=data
+                while len(self._pending)>=c.NUM_HEADER_BYTES:
+                    frameLength=c.NUM_HEADER_BYTES+aptcodec.decodeHeader(self._pending)[-1]
+                    if len(self._pending)<frameLength:
+                        break
+                    frame=bytes(self._pending[:frameLength])
+                    del self._pending[:frameLength]
+                    self._output+=self.responder(frame) or b""
+        return len(data)
+
+    def read(self,length):
+        if self.closed:
+            raise IOError("Memory transport is closed")
+        with self._lock:
+            data=bytes(self._output[:length])
+            del self._output[:length]
+        return data
+
+    def flush(self,flags=None):
+        with self._lock:
+            self._pending=bytearray()
+            self._output=bytearray()
+
+    def configure(self):
+        pass
+
+    def close(self):
+        self.closed=True
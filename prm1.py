@@ -6,16 +6,14 @@ class PRM1(AptMotor):
     PRM1 and the PRM1-Z8 controllers.
     """
 
-    def __init__(self,serial_number=None):
-        super(PRM1,self).__init__(hwser=serial_number,stageType='PRM1-Z8')
+    def __init__(self,serial_number=None,**kwargs):
+        super(PRM1,self).__init__(hwser=serial_number,stageType='PRM1-Z8',**kwargs)
 
     def goto(self,abs_pos,channel=0,wait=True):
-        self.MoveAbsoluteEnc(channel,abs_pos,wait=wait)
+        return self.MoveAbsoluteEnc(channel,abs_pos,wait=wait)
 
     def move(self,dist,channel=0,wait=True):
-        curpos = self.getPosition(channel)
-        newpos = curpos + dist
-        self.goto(newpos)
+        return self.moveBy(dist,channel,wait)
 
     def home(self,channel=0):
         self.zero(channel)
@@ -6,16 +6,14 @@ class Z8XX(AptMotor):
     Z8XX controllers.
     """
 
-    def __init__(self,serial_number=None):
-        super(Z8XX,self).__init__(hwser=serial_number,stageType='Z8XX')
+    def __init__(self,serial_number=None,**kwargs):
+        super(Z8XX,self).__init__(hwser=serial_number,stageType='Z8XX',**kwargs)
 
     def goto(self,abs_pos,channel=0,wait=True):
-        self.MoveAbsoluteEnc(channel,abs_pos,wait=wait)
+        return self.MoveAbsoluteEnc(channel,abs_pos,wait=wait)
 
     def move(self,dist,channel=0,wait=True):
-        curpos = self.getPosition(channel)
-        newpos = curpos + dist
-        self.goto(newpos)
+        return self.moveBy(dist,channel,wait)
 
     def home(self,channel=0):
         self.zero(channel)